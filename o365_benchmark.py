@@ -0,0 +1,804 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Offline benchmark for o365_ip_url_automation.py
+#
+# Runs the update script against a stand-in MS web service on 127.0.0.1 and a recording "tmsh" shim on PATH,
+# so that no BIG-IP and no access to endpoints.office.com is needed.  The endpoint list is a recorded endpoints
+# JSON (--endpoints) or a synthetic one, scaled up to the requested sizes.
+#
+# Reported per scenario: wall time per phase, tmsh invocations, tmsh command line sizes,
+# bytes written to the Data Group files and peak memory (each scenario runs in its own process).
+# The "fleet" scenario pushes the objects with o365_fleet.py to stand-in iControl REST devices of different latency.
+# The "pac" scenario also writes the PAC file, and compares its evaluation cost in node with a PAC file of the
+# usual dnsDomainIs()/shExpMatch()/isInNet() chain over the same endpoints.
+#
+# Usage: python o365_benchmark.py [--scale 1,10,100] [--scenario full,incremental] [--endpoints endpoints.json]
+#                                 [--set use_url=0] [--devices 8] [--device-latency 0.005] [--node node] [--json results.json]
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import struct
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import distutils.spawn
+import BaseHTTPServer
+import SocketServer
+
+#-----------------------------------------------------------------------
+# Benchmark Options
+#-----------------------------------------------------------------------
+
+# VERSIONs served by the stand-in web service
+version_base = "2020070100"
+version_next = "2020080100"
+
+# Size of the synthetic endpoint list at scale 1, about the size of the Worldwide instance
+synthetic_records = 100
+
+# Share of endpoint sets removed, changed and added between the two VERSIONs
+change_ratio = 0.02
+
+# Scenarios: name -> (VERSION applied beforehand or None, options of the measured run)
+# The measured run always applies version_next.
+dict_scenarios = {
+    "full":                   (None,         {}),
+    "full_unbatched":         (None,         {"tmsh_batch": 0}),
+    "incremental":            (version_base, {}),
+    "incremental_no_delta":   (version_base, {"use_delta_sync": 0}),
+    "incremental_unbatched":  (version_base, {"tmsh_batch": 0}),
+    "fleet":                  (None,         {}),
+    "pac":                    (None,         {"use_pac": 1}),
+}
+list_scenario_order = ["full", "full_unbatched", "incremental", "incremental_no_delta", "incremental_unbatched", "fleet", "pac"]
+
+# Phases timed in the update script: phase name -> function
+list_phases = [
+    ("failover check", "is_active"),
+    ("version check", "request_versions"),
+    ("fetch", "get_endpoint_set"),
+    ("parse", "parse_endpoints"),
+    ("build", "build_objects"),
+    ("apply", "apply_objects"),
+    ("save state", "save_state"),
+]
+
+# Options of the update script for every run
+dict_base_options = {
+    "use_url": 1,
+    "use_url_dg": 1,
+    "use_ipv4": 1,
+    "use_ipv6": 1,
+    "log_level": 1,
+    "http_retries": 0,
+}
+
+#-----------------------------------------------------------------------
+# Recording tmsh shim
+#-----------------------------------------------------------------------
+# Answers the failover status as ACTIVE, remembers created objects, echoes the batch markers
+# and appends one JSON line per invocation to $O365_BENCH_TMSH_LOG.
+tmsh_shim = r'''
+import os, re, sys, json, time
+time_start = time.time()
+file_state = os.environ["O365_BENCH_TMSH_STATE"]
+dict_state = {}
+if os.path.isfile(file_state):
+    dict_state = json.load(open(file_state))
+args = sys.argv[1:]
+if args and args[0] == "-q":
+    args = args[1:]
+script = args[1] if args and args[0] == "-c" else " ".join(args)
+list_commands = [c.strip() for c in re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)', script) if c.strip()]
+status = 0
+num_commands = 0
+for command in list_commands:
+    match = re.match(r'run util bash -c "echo (\S+)"', command)
+    if match:
+        sys.stdout.write(match.group(1) + "\n")
+        continue
+    num_commands += 1
+    words = command.replace("/", " ").split()
+    if words[0] in ("list", "show"):
+        if words[1:3] == ["cm", "failover-status"]:
+            sys.stdout.write("status ACTIVE\n")
+        elif " ".join(words[1:]) in dict_state:
+            sys.stdout.write(" ".join(words[1:]) + " { }\n")
+        else:
+            sys.stdout.write("01020036:3: The requested object (" + " ".join(words[1:]) + ") was not found.\n")
+            status = 1
+    elif words[0] == "create":
+        dict_state[" ".join(words[1:5])] = 1
+json.dump(dict_state, open(file_state, "w"))
+f = open(os.environ["O365_BENCH_TMSH_LOG"], "a")
+f.write(json.dumps({"bytes": len(script), "commands": num_commands, "seconds": time.time() - time_start}) + "\n")
+f.close()
+sys.exit(status)
+'''
+
+#-----------------------------------------------------------------------
+# Endpoint lists
+#-----------------------------------------------------------------------
+
+def synthetic_endpoints(num_records, seed):
+    # Endpoint sets shaped like the Worldwide instance: a few URLs and networks each, some wildcards
+    rnd = random.Random(seed)
+    list_domains = ["office.com", "office365.com", "microsoft.com", "outlook.com", "sharepoint.com", "lync.com",
+                    "live.com", "microsoftonline.com", "msocdn.com", "yammer.com", "onmicrosoft.com", "windows.net"]
+    list_service_areas = ["Exchange", "SharePoint", "Skype", "Common", "Yammer"]
+    list_records = []
+    for id in range(1, num_records + 1):
+        record = {"id": id,
+                  "serviceArea": rnd.choice(list_service_areas),
+                  "category": rnd.choice(["Optimize", "Allow", "Default", "Default"]),
+                  "required": rnd.random() < 0.6,
+                  "tcpPorts": "80,443"}
+        list_urls = []
+        for i in range(rnd.randint(0, 6)):
+            label = "s%d%s" % (id, "abcdefg"[i])
+            domain = rnd.choice(list_domains)
+            shape = rnd.random()
+            if shape < 0.3:
+                list_urls.append("*." + label + "." + domain)
+            elif shape < 0.35:
+                list_urls.append("*-" + label + ".s" + str(id) + "." + domain)
+            else:
+                list_urls.append(label + "." + domain)
+        if list_urls:
+            record["urls"] = list_urls
+        if record["category"] != "Default":
+            list_ips = []
+            for i in range(rnd.randint(0, 8)):
+                if rnd.random() < 0.6:
+                    prefix_len = rnd.randint(14, 28)
+                    value = rnd.randint(0, 2 ** 32 - 1) >> (32 - prefix_len) << (32 - prefix_len)
+                    list_ips.append(socket.inet_ntop(socket.AF_INET, struct.pack("!I", value)) + "/" + str(prefix_len))
+                else:
+                    prefix_len = rnd.randint(32, 64)
+                    value = (0x2603 << 112 | rnd.randint(0, 2 ** 112 - 1)) >> (128 - prefix_len) << (128 - prefix_len)
+                    list_ips.append(socket.inet_ntop(socket.AF_INET6, struct.pack("!QQ", value >> 64, value & (2 ** 64 - 1))) + "/" + str(prefix_len))
+            if list_ips:
+                record["ips"] = list_ips
+        list_records.append(record)
+    return list_records
+
+def shift_network(network, copy):
+    # Move a network into a distinct address range for each copy of a scaled endpoint list
+    address, prefix_len = network.split("/")
+    if ":" in address:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, address))
+        high = (high + (copy << 40)) % (2 ** 64)
+        return socket.inet_ntop(socket.AF_INET6, struct.pack("!QQ", high, low)) + "/" + prefix_len
+    value = struct.unpack("!I", socket.inet_pton(socket.AF_INET, address))[0]
+    value = (value + (copy << 24)) % (2 ** 32)
+    return socket.inet_ntop(socket.AF_INET, struct.pack("!I", value)) + "/" + prefix_len
+
+def shift_url(url, copy):
+    # "outlook.office.com" -> "outlook.office.c3.com" for copy 3
+    labels = url.split(".")
+    return ".".join(labels[:-1] + ["c" + str(copy), labels[-1]])
+
+def scale_endpoints(list_records, scale):
+    # Copies of the endpoint list with distinct ids, URLs and networks
+    list_scaled = []
+    id_step = max([record["id"] for record in list_records]) + 1
+    for copy in range(scale):
+        for record in list_records:
+            record = json.loads(json.dumps(record))
+            if copy > 0:
+                record["id"] = record["id"] + copy * id_step
+                for key in ("urls", "allowUrls", "defaultUrls"):
+                    if key in record:
+                        record[key] = [shift_url(url, copy) for url in record[key]]
+                if "ips" in record:
+                    record["ips"] = [shift_network(ip, copy) for ip in record["ips"]]
+            list_scaled.append(record)
+    return list_scaled
+
+def next_version(list_records, seed):
+    # Endpoint list of version_next and the "changes" records that lead there
+    rnd = random.Random(seed)
+    list_next = json.loads(json.dumps(list_records))
+    list_changes = []
+    num_changes = max(1, int(len(list_records) * change_ratio))
+    id_next = max([record["id"] for record in list_records]) + 1
+
+    def change(endpoint_set_id, disposition, impact):
+        dict_change = {"id": 100000 + len(list_changes), "endpointSetId": endpoint_set_id, "disposition": disposition,
+                       "version": version_next, "impact": impact}
+        list_changes.append(dict_change)
+        return dict_change
+
+    # Removed endpoint sets
+    for record in rnd.sample(list_next, num_changes):
+        list_next.remove(record)
+        change(record["id"], "remove", "RemovedSet")
+
+    # Changed endpoint sets: one URL added, one network added and one removed
+    for record in rnd.sample(list_next, num_changes):
+        dict_change = change(record["id"], "change", "AddedUrl")
+        url = "n%d.office.com" % record["id"]
+        record.setdefault("urls", []).append(url)
+        dict_change["add"] = {"effectiveDate": version_next[:8], "urls": [url]}
+        if record.get("ips"):
+            ip_removed = record["ips"].pop(0)
+            ip_added = shift_network(ip_removed, 255)
+            record["ips"].append(ip_added)
+            dict_change["add"]["ips"] = [ip_added]
+            dict_change["remove"] = {"ips": [ip_removed]}
+
+    # Added endpoint sets
+    for record in synthetic_endpoints(num_changes, seed + 1):
+        record["id"] = id_next
+        id_next += 1
+        list_next.append(record)
+        dict_change = change(record["id"], "add", "AddedSet")
+        dict_change["current"] = dict([(key, record[key]) for key in ("serviceArea", "category", "required", "tcpPorts")])
+        dict_change["add"] = {"effectiveDate": version_next[:8], "urls": record.get("urls", []), "ips": record.get("ips", [])}
+
+    return sorted(list_next, key=lambda record: record["id"]), list_changes
+
+#-----------------------------------------------------------------------
+# Stand-in MS web service
+#-----------------------------------------------------------------------
+
+class MsWebServiceStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), MsWebServiceHandler)
+        self.latest = version_base
+        self.dict_bodies = {}
+
+    def load(self, dict_endpoints, list_changes):
+        # Serialize once, so that serving does not show up in the measurement
+        self.dict_bodies = {}
+        for version in dict_endpoints:
+            self.dict_bodies["/endpoints/" + version] = json.dumps(dict_endpoints[version])
+        self.dict_bodies["/changes/" + version_base] = json.dumps(list_changes)
+        self.dict_bodies["/changes/" + version_next] = "[]"
+
+class MsWebServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        server = self.server
+        if path == "/version":
+            body = json.dumps([{"instance": instance, "latest": server.latest}
+                               for instance in ("Worldwide", "USGovDoD", "USGovGCCHigh", "China", "Germany")])
+        elif path.startswith("/endpoints/"):
+            body = server.dict_bodies.get("/endpoints/" + server.latest)
+        elif path.startswith("/changes/"):
+            body = server.dict_bodies.get("/changes/" + path.rsplit("/", 1)[1])
+        else:
+            body = None
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = '"%08x"' % (zlib.crc32(body) & 0xffffffff)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+#-----------------------------------------------------------------------
+# Stand-in iControl REST (fleet scenario)
+#-----------------------------------------------------------------------
+
+class IControlRestStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # One BIG-IP: keeps the uploaded files and the objects, and answers each request after "latency" seconds
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), IControlRestHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.dict_files = {}
+        self.dict_collections = {"/mgmt/tm/sys/file/data-group": {},
+                                 "/mgmt/tm/ltm/data-group/external": {},
+                                 "/mgmt/tm/sys/url-db/url-category": {}}
+
+class IControlRestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffered, so that a response goes out in one segment instead of waiting for delayed ACKs
+    wbufsize = -1
+
+    def reply(self, status, response):
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_rest(self, method):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(server.latency)
+        path = self.path.split("?")[0]
+        collection, name = path.rsplit("/", 1)
+        with server.lock:
+            if method == "POST" and path.startswith("/mgmt/shared/file-transfer/uploads/"):
+                start = int(self.headers["Content-Range"].split("-")[0])
+                server.dict_files[name] = server.dict_files.get(name, "")[:start] + body
+                return self.reply(200, {})
+            if method == "GET" and path == "/mgmt/tm/cm/failover-status":
+                return self.reply(200, {"entries": {"https://localhost/mgmt/tm/cm/failover-status/0": {
+                    "nestedStats": {"entries": {"status": {"description": "ACTIVE"}}}}}})
+            if method == "POST" and path in ("/mgmt/tm/sys/config", "/mgmt/tm/cm"):
+                return self.reply(200, json.loads(body))
+            if path in server.dict_collections:
+                dict_objects = server.dict_collections[path]
+                if method == "GET":
+                    return self.reply(200, {"items": [{"name": name, "partition": "Common"} for name in sorted(dict_objects)]})
+                if method == "POST":
+                    item = json.loads(body)
+                    if item["name"] in dict_objects:
+                        return self.reply(409, {"code": 409, "message": "The requested object already exists."})
+                    dict_objects[item["name"]] = item
+                    return self.reply(200, item)
+            if method == "PATCH" and collection in server.dict_collections and name.startswith("~Common~"):
+                dict_objects = server.dict_collections[collection]
+                if name[len("~Common~"):] in dict_objects:
+                    dict_objects[name[len("~Common~"):]].update(json.loads(body))
+                    return self.reply(200, dict_objects[name[len("~Common~"):]])
+        self.reply(404, {"code": 404, "message": "Object not found: " + path})
+
+    def do_GET(self):
+        self.handle_rest("GET")
+
+    def do_POST(self):
+        self.handle_rest("POST")
+
+    def do_PATCH(self):
+        self.handle_rest("PATCH")
+
+    def log_message(self, *args):
+        pass
+
+#-----------------------------------------------------------------------
+# PAC evaluation (pac scenario)
+#-----------------------------------------------------------------------
+# Runs FindProxyForURL of a PAC file over a list of hosts in node, with the PAC helper functions implemented as
+# in the browsers.  dnsResolve() does not resolve, it counts the calls that would wait for a DNS lookup, and returns
+# the broadcast address.
+pac_evaluator = r"""
+var fs = require("fs"), vm = require("vm");
+var args = JSON.parse(process.argv[2]);
+var hosts = JSON.parse(fs.readFileSync(args.hosts, "utf8"));
+var source = fs.readFileSync(args.pac, "utf8");
+var dns_lookups = 0;
+function convert_addr(ip) {
+  var bytes = ip.split(".");
+  return ((bytes[0] << 24) | (bytes[1] << 16) | (bytes[2] << 8) | bytes[3]) >>> 0;
+}
+function dnsResolve(host) {
+  if (/^\d+\.\d+\.\d+\.\d+$/.test(host)) {
+    return host;
+  }
+  dns_lookups++;
+  return "255.255.255.255";
+}
+var sandbox = {
+  dnsResolve: dnsResolve,
+  dnsDomainIs: function (host, domain) {
+    return host.length >= domain.length && host.substring(host.length - domain.length) == domain;
+  },
+  shExpMatch: function (url, pattern) {
+    pattern = pattern.replace(/\./g, "\\.").replace(/\*/g, ".*").replace(/\?/g, ".");
+    return new RegExp("^" + pattern + "$").test(url);
+  },
+  isInNet: function (host, pattern, mask) {
+    return (convert_addr(dnsResolve(host)) & convert_addr(mask)) >>> 0 == convert_addr(pattern);
+  }
+};
+var time_start = process.hrtime();
+vm.runInNewContext(source, sandbox);
+var time_load = process.hrtime(time_start);
+var find_proxy = sandbox.FindProxyForURL;
+
+// Calls over the hosts, round robin, for args.seconds.  The clock is read every 64 calls.
+var calls = 0, direct = 0, dns_calls = 0, host, lookups, elapsed;
+time_start = process.hrtime();
+do {
+  for (var i = 0; i < 64; i++) {
+    host = hosts[calls % hosts.length];
+    lookups = dns_lookups;
+    if (find_proxy("http://" + host + "/", host) == "DIRECT") {
+      direct++;
+    }
+    if (dns_lookups > lookups) {
+      dns_calls++;
+    }
+    calls++;
+  }
+  elapsed = process.hrtime(time_start);
+} while (elapsed[0] + elapsed[1] / 1e9 < args.seconds);
+console.log(JSON.stringify({
+  bytes: source.length,
+  load_ms: time_load[0] * 1e3 + time_load[1] / 1e6,
+  ns_per_call: (elapsed[0] * 1e9 + elapsed[1]) / calls,
+  calls: calls,
+  direct: direct / calls,
+  dns: dns_calls / calls
+}));
+"""
+
+def naive_pac(list_urls, list_networks, proxy):
+    # PAC file as often kept by hand: one dnsDomainIs()/shExpMatch() per URL and one isInNet() per IPv4 network.
+    # isInNet() resolves the host name.  IPv6 networks are left out, isInNet() does not take them.
+    list_tests = []
+    for url in sorted(set([url.lower() for url in list_urls])):
+        if "*" in url:
+            list_tests.append('shExpMatch(host, "' + url + '")')
+        else:
+            list_tests.append('dnsDomainIs(host, "' + url + '")')
+    list_nets = []
+    for network in sorted(set(list_networks)):
+        if ":" in network:
+            continue
+        address, prefix_len = (network.split("/", 1) + ["32"])[:2]
+        mask = socket.inet_ntop(socket.AF_INET, struct.pack("!I", (2 ** 32 - 1) >> (32 - int(prefix_len)) << (32 - int(prefix_len))))
+        list_nets.append('isInNet(host, "' + address + '", "' + mask + '")')
+    return "function FindProxyForURL(url, host) {\n" \
+        + "  if (" + " ||\n      ".join(list_tests or ["false"]) + ")\n    return \"DIRECT\";\n" \
+        + "  if (" + " ||\n      ".join(list_nets or ["false"]) + ")\n    return \"DIRECT\";\n" \
+        + "  return " + json.dumps(proxy) + ";\n}\n"
+
+def pac_hosts(list_urls, list_networks, seed):
+    # Hosts requested by the clients: O365 host names and addresses, and as many other host names and addresses
+    rnd = random.Random(seed)
+    list_hosts = []
+    for url in list_urls:
+        list_hosts.append(url.lower().replace("*", "x"))
+        list_hosts.append("www%d.example%d.com" % (rnd.randint(0, 99), rnd.randint(0, 9999)))
+    for network in list_networks:
+        if ":" not in network:
+            list_hosts.append(network.split("/")[0])
+            list_hosts.append(socket.inet_ntop(socket.AF_INET, struct.pack("!I", rnd.randint(0, 2 ** 32 - 1))))
+    rnd.shuffle(list_hosts)
+    return list_hosts[:10000]
+
+def evaluate_pac(node, directory, file_pac, file_hosts):
+    # Evaluation cost of a PAC file, measured in node
+    file_evaluator = os.path.join(directory, "pac_evaluator.js")
+    f = open(file_evaluator, "w")
+    f.write(pac_evaluator)
+    f.close()
+    proc = subprocess.Popen([node, file_evaluator, json.dumps({"pac": file_pac, "hosts": file_hosts, "seconds": 1.0})],
+                            stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError("PAC evaluation of " + file_pac + " failed")
+    return json.loads(output.strip().splitlines()[-1])
+
+#-----------------------------------------------------------------------
+# Measured run (child process)
+#-----------------------------------------------------------------------
+
+def run_child(spec):
+    # Run the update script once, in this process, and print the measurements as JSON
+    import resource
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import o365_ip_url_automation as o365
+
+    # Everything the script writes goes to the work directory of the scenario
+    work_directory = str(spec["work_directory"])
+    for name in dir(o365):
+        value = getattr(o365, name)
+        if isinstance(value, str) and value.startswith("/var/tmp/o365"):
+            setattr(o365, name, work_directory + value[len("/var/tmp/o365"):])
+    o365.log_dest_file = os.path.join(work_directory, "o365_update.log")
+    o365.file_o365_run_log = os.path.join(work_directory, "o365_update.json")
+    o365.ms_o365_scheme = "http"
+    o365.url_ms_o365_endpoints = o365.url_ms_o365_version = "127.0.0.1:" + str(spec["port"])
+    for name in spec["options"]:
+        setattr(o365, str(name), spec["options"][name])
+
+    lock = threading.Lock()
+    dict_phases = {}
+    list_objects = []
+
+    def timed(phase, function):
+        def wrapper(*args, **kwargs):
+            time_start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with lock:
+                    dict_phases[phase] = dict_phases.get(phase, 0.0) + time.time() - time_start
+        return wrapper
+
+    for phase, name in list_phases:
+        setattr(o365, name, timed(phase, getattr(o365, name)))
+    build_objects = o365.build_objects
+    o365.build_objects = lambda *args: list_objects.append(build_objects(*args)) or list_objects[-1]
+    list_endpoints = []
+    parse_endpoints = o365.parse_endpoints
+    o365.parse_endpoints = lambda *args: list_endpoints.append(parse_endpoints(*args)) or list_endpoints[-1]
+
+    list_devices = spec.get("devices")
+    list_device_results = []
+    if list_devices:
+        import o365_fleet
+        o365_fleet.fleet_scheme = "http"
+        o365_fleet.file_fleet_state = os.path.join(work_directory, "o365_fleet_state.json")
+
+    error = None
+    time_start = time.time()
+    try:
+        if list_devices:
+            o365.metrics_start()
+            list_device_results = o365_fleet.fleet_update(list_devices) or []
+            dict_phases["apply"] = o365.run_metrics["phases"].get("push", 0.0)
+        else:
+            o365.main()
+    except Exception, e:
+        # Still report how far the run got
+        error = e.__class__.__name__ + ": " + str(e)
+    wall = time.time() - time_start
+    for result in list_device_results:
+        if result["result"] == "failed":
+            error = result["device"] + ": " + str(result["error"])
+
+    # The same endpoints as the usual PAC file, and the hosts to evaluate both PAC files with
+    dict_pac_files = None
+    if o365.use_pac and list_endpoints:
+        endpoints = list_endpoints[-1]
+        dict_pac_files = {"optimised": o365.file_o365_pac,
+                          "naive": os.path.join(work_directory, "naive.pac"),
+                          "hosts": os.path.join(work_directory, "pac_hosts.json")}
+        f = open(dict_pac_files["naive"], "w")
+        f.write(naive_pac(endpoints["urls"], endpoints["ips4"] | endpoints["ips6"], o365.pac_proxy))
+        f.close()
+        f = open(dict_pac_files["hosts"], "w")
+        json.dump(pac_hosts(sorted(endpoints["urls"]), sorted(endpoints["ips4"]), spec["seed"]), f)
+        f.close()
+
+    dg_bytes = 0
+    dg_entries = 0
+    url_category_entries = 0
+    for objects in list_objects:
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            dg_bytes += len(dg_content)
+            dg_entries += dg_content.count("\n")
+        if objects["url_category_entries"] is not None:
+            url_category_entries += len(objects["url_category_entries"])
+
+    sys.stdout.write(json.dumps({
+        "wall": wall,
+        "error": error,
+        "phases": dict_phases,
+        "dg_bytes": dg_bytes,
+        "dg_entries": dg_entries,
+        "url_category_entries": url_category_entries,
+        "http_bytes": o365.http_stats["bytes_received"],
+        "script_phases": o365.run_metrics["phases"],
+        "entries": o365.run_metrics["entries"],
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "devices": [dict([(key, result[key]) for key in ("device", "result", "seconds", "requests", "bytes_sent")])
+                    for result in list_device_results],
+        "pac_files": dict_pac_files,
+    }) + "\n")
+
+def run_scenario(server, directory, scenario, version, options, list_devices=None, seed=1):
+    # One update run in a fresh process, applying the given VERSION.  Returns the measurements.
+    # With list_devices, the objects are pushed to them with o365_fleet.py instead.
+    file_tmsh_log = os.path.join(directory, "tmsh_invocations.json")
+    if os.path.isfile(file_tmsh_log):
+        os.remove(file_tmsh_log)
+    server.latest = version
+
+    dict_options = dict(dict_base_options)
+    dict_options.update(options)
+    spec = {"work_directory": os.path.join(directory, "work"), "port": server.server_address[1], "options": dict_options,
+            "devices": list_devices, "seed": seed}
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(directory, "bin") + os.pathsep + env.get("PATH", "")
+    env["O365_BENCH_TMSH_STATE"] = os.path.join(directory, "tmsh_state.json")
+    env["O365_BENCH_TMSH_LOG"] = file_tmsh_log
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)], stdout=subprocess.PIPE, env=env)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError("Scenario " + scenario + " failed.  See " + os.path.join(directory, "work", "o365_update.log"))
+    result = json.loads(output.strip().splitlines()[-1])
+
+    list_invocations = []
+    if os.path.isfile(file_tmsh_log):
+        list_invocations = [json.loads(line) for line in open(file_tmsh_log)]
+    result["tmsh_invocations"] = len(list_invocations)
+    result["tmsh_commands"] = sum([invocation["commands"] for invocation in list_invocations])
+    result["tmsh_bytes_max"] = max([invocation["bytes"] for invocation in list_invocations] + [0])
+    result["tmsh_bytes_total"] = sum([invocation["bytes"] for invocation in list_invocations])
+    result["tmsh_seconds"] = sum([invocation["seconds"] for invocation in list_invocations])
+    return result
+
+def prepare_directory(directory):
+    # Fresh work directory, tmsh state and tmsh shim
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(os.path.join(directory, "work"))
+    os.makedirs(os.path.join(directory, "bin"))
+    file_shim = os.path.join(directory, "bin", "tmsh")
+    f = open(file_shim, "w")
+    f.write("#!" + sys.executable + "\n" + tmsh_shim)
+    f.close()
+    os.chmod(file_shim, 0755)
+
+def report(list_results):
+    list_columns = [("scale", "%5s", lambda r: r["scale"]),
+                    ("scenario", "%-22s", lambda r: r["scenario"]),
+                    ("wall s", "%7.3f", lambda r: r["wall"])] \
+        + [(phase + " s", "%" + str(max(7, len(phase) + 2)) + ".3f", lambda r, phase=phase: r["phases"].get(phase, 0.0)) for phase, name in list_phases] \
+        + [("tmsh", "%5d", lambda r: r["tmsh_invocations"]),
+           ("tmsh cmds", "%9d", lambda r: r["tmsh_commands"]),
+           ("cmdline max", "%11d", lambda r: r["tmsh_bytes_max"]),
+           ("cmdline total", "%13d", lambda r: r["tmsh_bytes_total"]),
+           ("http bytes", "%10d", lambda r: r["http_bytes"]),
+           ("dg entries", "%10d", lambda r: r["dg_entries"]),
+           ("dg bytes", "%9d", lambda r: r["dg_bytes"]),
+           ("peak MB", "%7.1f", lambda r: r["peak_rss_kb"] / 1024.0)]
+    list_widths = [len(column_format % column_function(list_results[0])) if list_results else len(column_name)
+                   for column_name, column_format, column_function in list_columns]
+    list_widths = [max(width, len(column[0])) for width, column in zip(list_widths, list_columns)]
+    sys.stdout.write("  ".join([column[0].rjust(width) for width, column in zip(list_widths, list_columns)]) + "\n")
+    for result in list_results:
+        sys.stdout.write("  ".join([(column_format % column_function(result)).rjust(width)
+                                    for width, (column_name, column_format, column_function) in zip(list_widths, list_columns)]) + "\n")
+    for result in list_results:
+        if result["devices"]:
+            list_seconds = [device["seconds"] for device in result["devices"]]
+            sys.stdout.write("Scale " + str(result["scale"]) + " " + result["scenario"] + ": " + str(len(list_seconds)) + " devices, rollout "
+                             + "%.3f s, slowest device %.3f s, all devices %.3f s in total, %d requests, %d bytes sent\n"
+                             % (result["phases"].get("apply", 0.0), max(list_seconds), sum(list_seconds),
+                                sum([device["requests"] for device in result["devices"]]),
+                                sum([device["bytes_sent"] for device in result["devices"]])))
+    for result in list_results:
+        if result.get("pac"):
+            optimised, naive = result["pac"]["optimised"], result["pac"]["naive"]
+            sys.stdout.write("Scale " + str(result["scale"]) + " " + result["scenario"] + ": PAC file " + "%d bytes, load %.1f ms, FindProxyForURL %.3f us, %.0f%% DIRECT, %.0f%% with DNS lookup\n"
+                             % (optimised["bytes"], optimised["load_ms"], optimised["ns_per_call"] / 1000.0, optimised["direct"] * 100, optimised["dns"] * 100)
+                             + "Scale " + str(result["scale"]) + " " + result["scenario"] + ": usual PAC file " + "%d bytes, load %.1f ms, FindProxyForURL %.3f us, %.0f%% DIRECT, %.0f%% with DNS lookup\n"
+                             % (naive["bytes"], naive["load_ms"], naive["ns_per_call"] / 1000.0, naive["direct"] * 100, naive["dns"] * 100))
+        elif result.get("pac_files"):
+            sys.stdout.write("Scale " + str(result["scale"]) + " " + result["scenario"] + ": PAC evaluation skipped, node not found\n")
+    for result in list_results:
+        if result["error"]:
+            sys.stdout.write("Scale " + str(result["scale"]) + " " + result["scenario"] + " FAILED: " + result["error"] + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of o365_ip_url_automation.py.")
+    parser.add_argument("--scale", default="1,10,100", help="comma separated sizes of the endpoint list, as multiples of the base list (default 1,10,100)")
+    parser.add_argument("--scenario", default=",".join(list_scenario_order), help="comma separated scenarios: " + ", ".join(list_scenario_order))
+    parser.add_argument("--endpoints", help="recorded endpoints JSON to use as the base list, instead of a synthetic one")
+    parser.add_argument("--set", action="append", default=[], metavar="OPTION=VALUE", help="option of the update script for all runs, e.g. --set use_url=0")
+    parser.add_argument("--devices", type=int, default=8, help="stand-in iControl REST devices of the fleet scenario (default 8)")
+    parser.add_argument("--device-latency", type=float, default=0.005, help="mean seconds each stand-in device takes per request; "
+                        "spread evenly from 0 to twice this value over the devices (default 0.005)")
+    parser.add_argument("--node", default="node", help="node executable evaluating the PAC files of the pac scenario (default node)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic data")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the work directories")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+
+    list_scenarios = [scenario for scenario in args.scenario.split(",") if scenario]
+    for scenario in list_scenarios:
+        if scenario not in dict_scenarios:
+            parser.error("unknown scenario: " + scenario)
+
+    for option in args.set:
+        name, value = option.split("=", 1)
+        dict_base_options[name] = json.loads(value)
+
+    if args.endpoints:
+        f = open(args.endpoints, "r")
+        list_base = json.load(f)
+        f.close()
+    else:
+        list_base = synthetic_endpoints(synthetic_records, args.seed)
+
+    server = MsWebServiceStandIn()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    list_rest_servers = []
+    if "fleet" in list_scenarios:
+        for index in range(args.devices):
+            rest_server = IControlRestStandIn(args.device_latency * 2 * (index + 1) / args.devices)
+            thread = threading.Thread(target=rest_server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            list_rest_servers.append(rest_server)
+
+    node = None
+    if "pac" in list_scenarios:
+        node = distutils.spawn.find_executable(args.node)
+        if node is None:
+            sys.stderr.write("node not found, the PAC files are not evaluated\n")
+
+    directory_root = tempfile.mkdtemp(prefix="o365_benchmark_")
+    list_results = []
+    try:
+        for scale in [int(scale) for scale in args.scale.split(",")]:
+            list_records = scale_endpoints(list_base, scale)
+            list_next, list_changes = next_version(list_records, args.seed)
+            server.load({version_base: list_records, version_next: list_next}, list_changes)
+
+            for scenario in list_scenarios:
+                version_before, options = dict_scenarios[scenario]
+                directory = os.path.join(directory_root, str(scale), scenario)
+                prepare_directory(directory)
+                list_devices = None
+                if scenario == "fleet":
+                    # Fresh devices for each scale
+                    for rest_server in list_rest_servers:
+                        rest_server.dict_files.clear()
+                        for dict_objects in rest_server.dict_collections.values():
+                            dict_objects.clear()
+                    list_devices = [{"host": "127.0.0.1:" + str(rest_server.server_address[1]), "user": "admin", "password": "admin"}
+                                    for rest_server in list_rest_servers]
+                if version_before is not None:
+                    run_scenario(server, directory, scenario, version_before, options, list_devices)
+                result = run_scenario(server, directory, scenario, version_next, options, list_devices, args.seed)
+                if result.get("pac_files") and node:
+                    result["pac"] = {}
+                    for form in ("optimised", "naive"):
+                        result["pac"][form] = evaluate_pac(node, directory, result["pac_files"][form], result["pac_files"]["hosts"])
+                result["scale"] = scale
+                result["scenario"] = scenario
+                result["records"] = len(list_next)
+                list_results.append(result)
+                sys.stderr.write("scale " + str(scale) + " " + scenario + ": %.3f s" % result["wall"]
+                                 + (" FAILED" if result["error"] else "") + "\n")
+    finally:
+        server.shutdown()
+        for rest_server in list_rest_servers:
+            rest_server.shutdown()
+        if args.keep:
+            sys.stderr.write("Work directories kept in " + directory_root + "\n")
+        else:
+            shutil.rmtree(directory_root)
+
+    report(list_results)
+    if args.json:
+        f = open(args.json, "w")
+        json.dump(list_results, f, indent=1)
+        f.close()
+
+
+if __name__=='__main__':
+    main()
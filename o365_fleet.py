@@ -0,0 +1,447 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Office 365 IP Address and URL Web Service Automation for a fleet of BIG-IPs
+#
+# Fetches the endpoint lists and builds the Data Groups and URL categories once, with the options set in
+# o365_ip_url_automation.py, then pushes them to many BIG-IPs concurrently over iControl REST:
+# the Data Group files are uploaded and imported with source-path, the URL categories replaced, and the
+# configuration saved (and synced to the device group of HA pairs).  Objects whose content did not change
+# since the last successful push to a device are left alone.  Runs on any host with Python 2.7.9 or later.
+#
+# Usage: python o365_fleet.py --devices devices.json [--force]
+#
+# devices.json holds the list of devices:
+#   [{"host": "10.1.1.245", "user": "admin", "password": "secret"},
+#    {"host": "10.1.2.245:8443", "user": "admin", "password": "secret", "device_group": "device-group1"},
+#    {"host": "10.1.2.246:8443", "user": "admin", "password": "secret", "device_group": "device-group1"}]
+# "device_group": member of an HA pair.  Only the ACTIVE member is updated, and then synced to the group.
+#                 List all members, so that the update follows a failover.
+# "login_provider": log in for a token with this provider (e.g. "tmos", or a remote one) instead of basic auth.
+
+import os
+import sys
+import ssl
+import json
+import time
+import base64
+import random
+import socket
+import httplib
+import argparse
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import o365_ip_url_automation as o365
+
+#-----------------------------------------------------------------------
+# Fleet Options
+#-----------------------------------------------------------------------
+# The endpoint selection and the objects to build are the options of o365_ip_url_automation.py.
+
+fleet_devices = []              # Devices, as in devices.json.  Replaced by --devices
+fleet_max_workers = 10          # Devices updated concurrently
+
+# iControl REST connection
+fleet_scheme = "https"          # "https", or "http" for a local test server
+fleet_verify_tls = 0            # 0=accept the self-signed management certificate, 1=verify it against fleet_ca_file
+fleet_ca_file = ""              # CA bundle for fleet_verify_tls=1.  "" for the system CAs
+fleet_timeout = 120             # Seconds to wait for the connection and for each response ("save sys config" can take a while)
+fleet_retries = 2               # Retries of a request that got no response, or 502/503/504
+fleet_backoff = 2               # Seconds before the first retry, doubled for each further retry (with random jitter)
+fleet_upload_chunk = 1048576    # Bytes per upload request.  iControl REST accepts up to 1 MB
+
+# Files
+log_dest_file = "/var/log/o365_fleet"
+file_fleet_state = "/var/tmp/o365/o365_fleet_state.json"   # Device -> content hash of each object as of its last successful push
+file_fleet_report = "/var/log/o365_fleet.json"             # One JSON record per rollout, with the result of each device.  "" to disable
+
+# iControl REST file upload
+uri_upload = "/mgmt/shared/file-transfer/uploads/"
+directory_upload = "/var/config/rest/downloads/"
+
+
+#-----------------------------------------------------------------------
+# Implementation - Please do not modify
+#-----------------------------------------------------------------------
+
+class FleetError(Exception):
+    pass
+
+def log(lev, msg):
+    o365.log(lev, msg)
+
+def rest_name(name):
+    # URI form of an object name in /Common
+    return "~Common~" + name
+
+def rest_error(status, response):
+    # Readable error of an iControl REST response
+    if isinstance(response, dict) and response.get("message"):
+        return "HTTP " + str(status) + ": " + str(response["message"])
+    return "HTTP " + str(status)
+
+class IControlRestClient(object):
+    # iControl REST client for one BIG-IP.  Keeps one connection open for all requests to the device,
+    # and retries requests that got no response or a 502/503/504 with backoff.
+
+    def __init__(self, device):
+        self.device = device
+        self.host = device["host"]
+        self.conn = None
+        self.token = None
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def connect(self):
+        if fleet_scheme == "http":
+            self.conn = httplib.HTTPConnection(self.host, timeout=fleet_timeout)
+        else:
+            if fleet_verify_tls:
+                context = ssl.create_default_context(cafile=fleet_ca_file or None)
+            else:
+                context = ssl._create_unverified_context()
+            self.conn = httplib.HTTPSConnection(self.host, timeout=fleet_timeout, context=context)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def send(self, method, uri, body, dict_headers):
+        # Returns HTTP status and response body.  Raises FleetError if no response was received at all.
+        error = ""
+        for attempt in range(fleet_retries + 1):
+            if attempt > 0:
+                time.sleep(fleet_backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            try:
+                if self.conn is None:
+                    self.connect()
+                self.requests += 1
+                self.bytes_sent += len(body or "")
+                self.conn.request(method, uri, body, dict_headers)
+                res = self.conn.getresponse()
+                data = res.read()
+            except (socket.error, httplib.HTTPException), e:
+                error = str(e) or e.__class__.__name__
+                log(2, self.host + ": " + method + " " + uri + " failed: " + error + ".  Attempt " + str(attempt + 1) + " of " + str(fleet_retries + 1) + ".")
+                self.close()
+                continue
+
+            if res.getheader("connection", "").lower() == "close":
+                self.close()
+            if res.status in (502, 503, 504):
+                error = "HTTP " + str(res.status)
+                log(2, self.host + ": " + method + " " + uri + " returned " + error + ".  Attempt " + str(attempt + 1) + " of " + str(fleet_retries + 1) + ".")
+                continue
+            return res.status, data
+        raise FleetError(method + " " + uri + " failed: " + error)
+
+    def auth_headers(self):
+        if self.device.get("login_provider"):
+            if self.token is None:
+                self.login()
+            return {"X-F5-Auth-Token": self.token}
+        return {"Authorization": "Basic " + base64.b64encode(self.device["user"] + ":" + self.device["password"])}
+
+    def login(self):
+        body = json.dumps({"username": self.device["user"], "password": self.device["password"],
+                           "loginProviderName": self.device["login_provider"]})
+        status, data = self.send("POST", "/mgmt/shared/authn/login", body, {"Content-Type": "application/json"})
+        if status != 200:
+            raise FleetError("Login failed: HTTP " + str(status))
+        self.token = str(json.loads(data)["token"]["token"])
+
+    def request(self, method, uri, dict_body=None):
+        # JSON request.  Returns the status and the decoded response (None if there is none).
+        body = None
+        if dict_body is not None:
+            body = json.dumps(dict_body)
+        for attempt in range(2):
+            dict_headers = self.auth_headers()
+            dict_headers["Content-Type"] = "application/json"
+            status, data = self.send(method, uri, body, dict_headers)
+            # The token expired: log in again, once
+            if status == 401 and self.token is not None and attempt == 0:
+                self.token = None
+                continue
+            break
+        try:
+            response = json.loads(data) if data else None
+        except ValueError:
+            response = None
+        return status, response
+
+    def call(self, method, uri, dict_body, action):
+        # JSON request that must succeed.  Returns the decoded response.
+        status, response = self.request(method, uri, dict_body)
+        if status != 200:
+            raise FleetError(action + " failed: " + rest_error(status, response))
+        return response
+
+    def upload(self, file_name, content):
+        # Upload content to directory_upload + file_name, in chunks of fleet_upload_chunk bytes
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        total = len(content)
+        start = 0
+        while True:
+            chunk = content[start:start + fleet_upload_chunk]
+            end = start + len(chunk)
+            dict_headers = self.auth_headers()
+            dict_headers["Content-Type"] = "application/octet-stream"
+            dict_headers["Content-Range"] = str(start) + "-" + str(max(end - 1, 0)) + "/" + str(total)
+            status, data = self.send("POST", uri_upload + file_name, chunk, dict_headers)
+            if status != 200:
+                raise FleetError("Upload of " + file_name + " failed: HTTP " + str(status))
+            start = end
+            if start >= total:
+                break
+
+    def names(self, uri):
+        # Names of the objects of a collection in /Common
+        response = self.call("GET", uri + "?$select=name,partition", None, "Listing " + uri)
+        return set([str(item["name"]) for item in (response or {}).get("items", []) if item.get("partition", "Common") == "Common"])
+
+def find_failover_status(response):
+    # "ACTIVE", "STANDBY", ... from the nested stats of /mgmt/tm/cm/failover-status
+    if isinstance(response, dict):
+        if isinstance(response.get("status"), dict) and response["status"].has_key("description"):
+            return str(response["status"]["description"])
+        for value in response.values():
+            status = find_failover_status(value)
+            if status:
+                return status
+    return ""
+
+def load_fleet_state():
+    if not os.path.isfile(file_fleet_state):
+        return {}
+    try:
+        f = open(file_fleet_state, "r")
+        dict_state = json.load(f)
+        f.close()
+    except ValueError:
+        return {}
+    if not isinstance(dict_state, dict):
+        return {}
+    return dict_state
+
+def save_fleet_state(dict_state):
+    o365.write_file_atomic(file_fleet_state, json.dumps(dict_state))
+
+def apply_device(client, list_objects, result):
+    # Create or update the objects on one BIG-IP, then save & sync.
+    # result["fingerprints"] is kept up to date with the content in place.
+    device = client.device
+    host = client.host
+    dict_fingerprints = result["fingerprints"]
+    force = o365.force_o365_record_refresh == 1
+
+    # Existing objects, one request per object type
+    set_files = client.names("/mgmt/tm/sys/file/data-group")
+    set_dgs = client.names("/mgmt/tm/ltm/data-group/external")
+    set_categories = set()
+    if [objects for objects in list_objects if objects["url_category"] is not None]:
+        set_categories = client.names("/mgmt/tm/sys/url-db/url-category")
+
+    # Content hashes valid once the configuration is saved
+    list_changed = []
+    for objects in list_objects:
+        #-----------------------------------------------------------------------
+        # URL category: all entries replaced in one request
+        #-----------------------------------------------------------------------
+        if objects["url_category"] is not None:
+            category_name = objects["url_category"]
+            dict_url_category = objects["url_category_entries"]
+            key_category, fingerprint_category = o365.url_category_fingerprint(objects)
+
+            if category_name in set_categories and not force and dict_fingerprints.get(key_category) == fingerprint_category:
+                log(2, host + ": URL category " + category_name + " content is unchanged.  Skipping update.")
+            else:
+                dict_fingerprints.pop(key_category, None)
+                list_urls = [{"name": url, "type": dict_url_category[url]} for url in sorted(dict_url_category)]
+                if category_name in set_categories:
+                    client.call("PATCH", "/mgmt/tm/sys/url-db/url-category/" + rest_name(category_name), {"urls": list_urls},
+                                "Update of URL category " + category_name)
+                else:
+                    client.call("POST", "/mgmt/tm/sys/url-db/url-category", {"name": category_name, "displayName": category_name, "urls": list_urls},
+                                "Creation of URL category " + category_name)
+                log(2, host + ": URL category " + category_name + " updated with " + str(len(list_urls)) + " entries.")
+                list_changed.append((key_category, fingerprint_category))
+                result["objects"].append(category_name)
+
+        #-----------------------------------------------------------------------
+        # Data Group File uploaded and imported, and the external Data Group referencing it
+        #-----------------------------------------------------------------------
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            file_object = dg_name + "_object"
+            key_dg = "data-group " + file_object
+            fingerprint_dg = o365.content_fingerprint(dg_content)
+            if file_object in set_files and not force and dict_fingerprints.get(key_dg) == fingerprint_dg:
+                log(2, host + ": Data Group File " + file_object + " content is unchanged.  Skipping import.")
+            else:
+                dict_fingerprints.pop(key_dg, None)
+                upload_name = os.path.basename(dg_file_name)
+                client.upload(upload_name, dg_content)
+                source_path = "file:" + directory_upload + upload_name
+                if file_object in set_files:
+                    client.call("PATCH", "/mgmt/tm/sys/file/data-group/" + rest_name(file_object), {"sourcePath": source_path},
+                                "Import of Data Group File " + file_object)
+                else:
+                    client.call("POST", "/mgmt/tm/sys/file/data-group", {"name": file_object, "type": dg_type, "sourcePath": source_path},
+                                "Creation of Data Group File " + file_object)
+                log(2, host + ": Data Group File " + file_object + " imported from " + source_path + ".")
+                list_changed.append((key_dg, fingerprint_dg))
+                result["objects"].append(file_object)
+
+            if dg_name not in set_dgs:
+                client.call("POST", "/mgmt/tm/ltm/data-group/external", {"name": dg_name, "externalFileName": file_object},
+                            "Creation of Data Group " + dg_name)
+                log(2, host + ": Data Group " + dg_name + " created from " + file_object + ".")
+                result["objects"].append(dg_name)
+
+    if not result["objects"]:
+        log(1, host + ": No BIG-IP object changed.  Skipping configuration save and Config-Sync.")
+        result["result"] = "unchanged"
+        return
+
+    #-----------------------------------------------------------------------
+    # Save config, and Config-Sync the device group
+    #-----------------------------------------------------------------------
+    client.call("POST", "/mgmt/tm/sys/config", {"command": "save"}, "Configuration save")
+    for key, fingerprint in list_changed:
+        dict_fingerprints[key] = fingerprint
+    if device.get("device_group"):
+        client.call("POST", "/mgmt/tm/cm", {"command": "run", "utilCmdArgs": "config-sync to-group " + device["device_group"]},
+                    "Config-Sync to " + device["device_group"])
+    result["result"] = "updated"
+
+def push_device(device, list_objects, dict_fingerprints):
+    # Bring one BIG-IP up to date.  Never raises: the outcome is in the returned record.
+    host = device["host"]
+    result = {"device": host, "result": "failed", "objects": [], "error": None, "fingerprints": dict(dict_fingerprints)}
+    client = IControlRestClient(device)
+    time_start = time.time()
+    try:
+        if device.get("device_group"):
+            status = find_failover_status(client.call("GET", "/mgmt/tm/cm/failover-status", None, "Failover status check"))
+            if status != "ACTIVE":
+                log(1, host + ": Failover status is " + (status or "unknown") + ".  Skipping, the ACTIVE member of " + device["device_group"] + " is updated.")
+                result["result"] = "standby"
+                return result
+        apply_device(client, list_objects, result)
+    except FleetError, e:
+        result["error"] = str(e)
+        log(1, host + ": " + str(e))
+    except Exception, e:
+        result["error"] = e.__class__.__name__ + ": " + str(e)
+        log(1, host + ": Update failed: " + traceback.format_exc())
+    finally:
+        client.close()
+        result["seconds"] = time.time() - time_start
+        result["requests"] = client.requests
+        result["bytes_sent"] = client.bytes_sent
+    log(1, host + ": " + result["result"] + " in " + "%.2f" % result["seconds"] + " seconds"
+        + (" (" + ", ".join(result["objects"]) + ")" if result["objects"] else "") + ".")
+    return result
+
+def fleet_update(list_devices):
+    # Fetch the endpoint lists and build the objects once, then push them to all devices concurrently.
+    # Returns the result record of each device, or None if an endpoint list could not be downloaded.
+    guid = o365.get_guid()
+    dict_version_latest = o365.request_versions(guid)
+    if dict_version_latest is None:
+        log(1, "VERSION request to MS web service failed.  Using the stored endpoint lists if the download fails too.")
+        dict_version_latest = {}
+    o365.run_metrics["versions"] = dict_version_latest
+
+    # Every device needs the objects of all instances
+    built = o365.build_all_objects(guid, dict_version_latest, list(o365.ms_o365_instances))
+    if built is None:
+        return None
+    list_objects, dict_endpoint_sets = built
+
+    # The rollout takes as long as the slowest device, not the sum of all devices
+    dict_state = load_fleet_state()
+    with o365.timed("push"):
+        list_results = o365.run_concurrently(lambda device: push_device(device, list_objects, dict_state.get(device["host"], {})),
+                                             list_devices, fleet_max_workers)
+    for result in list_results:
+        dict_state[result["device"]] = result.pop("fingerprints")
+    save_fleet_state(dict_state)
+
+    # Remember the endpoint lists for the next incremental download
+    with o365.timed("save state"):
+        for instance in sorted(dict_endpoint_sets):
+            list_records, ms_o365_version_latest = dict_endpoint_sets[instance]
+            if ms_o365_version_latest != "":
+                o365.save_state(instance, ms_o365_version_latest, list_records)
+                o365.write_version(instance, ms_o365_version_latest)
+    return list_results
+
+def write_report(list_results, seconds):
+    # One JSON record per rollout
+    record = {"start": o365.run_metrics["start"],
+              "seconds": seconds,
+              "versions": o365.run_metrics["versions"],
+              "phases": o365.run_metrics["phases"],
+              "entries": o365.run_metrics["entries"],
+              "devices": list_results}
+    try:
+        f = open(file_fleet_report, "a")
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.close()
+    except IOError, e:
+        log(1, "Could not write fleet report " + file_fleet_report + ": " + str(e))
+
+def main():
+    parser = argparse.ArgumentParser(description="Push the Office 365 Data Groups and URL categories to many BIG-IPs over iControl REST.")
+    parser.add_argument("--devices", help="JSON file with the list of devices (see the top of this script)")
+    parser.add_argument("--force", action="store_true", help="push all objects to all devices, even if their content did not change")
+    args = parser.parse_args()
+
+    list_devices = fleet_devices
+    if args.devices:
+        f = open(args.devices, "r")
+        list_devices = json.load(f)
+        f.close()
+    if not list_devices:
+        parser.error("no devices given")
+    if args.force:
+        o365.force_o365_record_refresh = 1
+
+    o365.log_dest_file = log_dest_file
+    if not os.path.isdir(o365.work_directory):
+        os.mkdir(o365.work_directory)
+    o365.metrics_start()
+    time_start = time.time()
+    list_results = fleet_update(list_devices)
+    seconds = time.time() - time_start
+
+    if list_results is None:
+        log(1, "Rollout aborted: the endpoint lists could not be downloaded.")
+        o365.close_log()
+        sys.exit(1)
+
+    dict_counts = {}
+    for result in list_results:
+        dict_counts[result["result"]] = dict_counts.get(result["result"], 0) + 1
+        sys.stdout.write(("%-30s %-9s %7.2f s  %s" % (result["device"], result["result"], result["seconds"],
+                                                   result["error"] or ", ".join(result["objects"]))).rstrip() + "\n")
+    slowest = max(list_results, key=lambda result: result["seconds"])
+    summary = "Rollout to " + str(len(list_results)) + " devices in " + "%.2f" % seconds + " seconds: " \
+        + ", ".join([str(dict_counts[key]) + " " + key for key in sorted(dict_counts)]) \
+        + ".  Slowest device " + slowest["device"] + " " + "%.2f" % slowest["seconds"] + " seconds, all devices " \
+        + "%.2f" % sum([result["seconds"] for result in list_results]) + " seconds in total."
+    log(1, summary)
+    sys.stdout.write(summary + "\n")
+    if file_fleet_report:
+        write_report(list_results, seconds)
+    o365.close_web_clients()
+    o365.close_log()
+    if dict_counts.get("failed"):
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
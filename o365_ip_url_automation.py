@@ -2,14 +2,16 @@
 # -*- coding: utf-8 -*-
 # Office 365 IP Address and URL Web Service Automation for BIG-IP
 # https://docs.microsoft.com/en-us/Office365/Enterprise/office-365-ip-web-service
-# Version: 1.07
-# Last Modified: 16th July 2020
+# Version: 1.08
+# Last Modified: 17th October 2026
 # Original author: Makoto Omura, F5 Networks Japan G.K.
 #
 # v1.05: Updated for SSL Orchestrator by Kevin Stewart, SSA, F5 Networks
 # v1.06: Updated by Brett Smith, Principal Systems Engineer
 # v1.06: Ability to create data groups and/or URL categories. IPv4/IPv6 data group support only.
 # v1.07: Updated to properly pass "*" to tmsh command (by M.O. 9 July 2020)
+# v1.08: Incremental updates, batched tmsh, multiple instances, daemon mode, metrics, filters, Data Group values,
+#        snapshots & rollback, PAC file, o365_fleet.py and o365_matcher.py (17 October 2026)
 #
 # This Sample Software provided by the author is for illustrative
 # purposes only which provides customers with programming information
@@ -27,13 +29,29 @@
 
 import httplib
 import urllib
+import zlib
+import time
+import random
 import uuid
 import os
 import re
 import json
-import commands
+import hashlib
+import socket
+import binascii
+import bisect
+import subprocess
 import datetime
 import sys
+import threading
+import Queue
+import traceback
+import argparse
+import fcntl
+import contextlib
+import cProfile
+import pstats
+import resource
 
 #-----------------------------------------------------------------------
 # User Options - Configure as desired
@@ -44,6 +62,10 @@ use_url = 0     # Create custom category for URL based proxy bypassing - require
 use_url_dg = 1  # Create data group for URL based proxy bypassing: 0=do not use, 1=use
 use_ipv4 = 1    # Create data group for IPv4 based routing: 0=do not use, 1=use
 use_ipv6 = 0    # Create data group for IPv6 based routing: 0=do not use, 1=use
+use_pac = 0     # Create PAC file for the clients, returning DIRECT for O365 hosts & addresses and pac_proxy otherwise: 0=do not use, 1=use
+
+# PAC file
+pac_proxy = "PROXY proxy.example.com:3128"  # Returned by the PAC file for everything else, e.g. "PROXY proxy1:3128; PROXY proxy2:3128"
 
 # O365 "SeviceArea" (application) to consume
 care_common = 1     # "Common": 0=do not care, 1=care
@@ -52,22 +74,56 @@ care_skype = 1      # "Skype": 0=do not care, 1=care
 care_sharepoint = 1 # "SharePoint": 0=do not care, 1=care
 care_yammer = 1     # "Yammer": 0=do not care, 1=care
 
+# Endpoint filter, overriding the care_* options above when not empty.  Rules are tried in order for each endpoint set,
+# and the first rule that matches decides: "action": "include" (default) or "exclude".  Endpoint sets matching no rule are left out.
+# A rule matches when all its keys match:
+#   "serviceArea": ["Exchange", ...], "category": ["Optimize", "Allow", "Default"],
+#   "required": True/False, "expressRoute": True/False,
+#   "tcpPorts": [443, ...], "udpPorts": [3478, ...] (any of the ports is used by the endpoint set)
+# Example - only Optimize & Allow endpoints, leaving Default traffic to the normal route:
+#   endpoint_filter_rules = [{"category": ["Optimize", "Allow"]}]
+endpoint_filter_rules = []
+
+# URL Data Group reduction
+url_dg_reduce = 1           # Drop entries already covered by a shorter domain suffix (e.g. outlook.office.com by office.com): 0=do not reduce, 1=reduce
+url_dg_label_boundary = 0   # Write entries as ".office.com" so that they do not match "xoffice.com" (but "*.office.com" then matches "office.com" too).  Set static::o365_label_boundary 1 in the iRule: 0=off, 1=on
+
+# IPv4/IPv6 Data Group aggregation
+ip_aggregate = 1                        # Collapse overlapping & adjacent networks into the smallest equivalent set: 0=do not aggregate, 1=aggregate
+ip_aggregate_max_entries = 0            # Merge further into supernets until this many entries are left per address family: 0=no limit.  Not with dg_value_mode = 1
+ip_aggregate_max_overcoverage = 0.0     # Addresses the supernets may add, as ratio to the addresses listed by Microsoft (e.g. 0.05 = 5%)
+
+# Data Group values
+# 1 writes each entry with the value "ids;category;tcpPorts;udpPorts" (e.g. "46,56;O;80,443;3478-3481"), merged over
+# the endpoint sets listing the entry.  Category is O(ptimize), A(llow) or D(efault), the strongest when merged.
+# Entries are reduced/aggregated only with entries of the same category and ports.  Use o365_proxy_bypass_port_irule.tcl.
+dg_value_mode = 0   # 0=entries only ("office.com := 1", "network 13.107.6.152/31"), 1=entries with values
+
 # Action if O365 endpoint list is not updated
 force_o365_record_refresh = 0   # 0=do not update, 1=update (for test/debug purpose)
 
+# Incremental update using the web service "changes" method
+use_delta_sync = 1  # 0=always download the full endpoint list and rebuild, 1=apply only the changes since the last applied VERSION
+
+# Snapshots of the endpoint sets and objects of each update, to compare (--diff-snapshots) and re-apply (--rollback)
+snapshot_keep = 10  # Snapshots kept: 0=do not keep snapshots
+
+# Daemon mode (--daemon): poll the VERSION only, and update when it changes
+daemon_poll_interval = 3600     # Seconds between VERSION checks.  Microsoft asks to check at most once an hour
+daemon_poll_jitter = 0.1        # Random spread of the interval, as ratio (0.1 = +/-10%)
+daemon_backoff_max = 86400      # The interval is doubled for each consecutive failure, up to this many seconds
+
 # BIG-IP HA Configuration
 device_group_name = "device-group1"     # Name of Sync-Failover Device Group.  Required for HA paired BIG-IP.
 ha_config = 0                           # 0=stand alone, 1=HA paired
 
 # Log configuration
 log_level = 1   # 0=none, 1=normal, 2=verbose
+profile_run = 0 # 1=profile each run with cProfile, written to file_o365_profile
 
-# Microsoft Web Service URIs (enable only one webservice version)
-uri_ms_o365_endpoints = "/endpoints/Worldwide?ClientRequestId="
-#uri_ms_o365_endpoints = "/endpoints/USGovDoD?ClientRequestId="
-#uri_ms_o365_endpoints = "/endpoints/USGovGCCHigh?ClientRequestId="
-#uri_ms_o365_endpoints = "/endpoints/China?ClientRequestId="
-#uri_ms_o365_endpoints = "/endpoints/Germany?ClientRequestId="
+# Microsoft Web Service instances to consume: one or more of "Worldwide", "USGovDoD", "USGovGCCHigh", "China", "Germany"
+ms_o365_instances = ["Worldwide"]
+ms_o365_instance_output = 0     # 0=merge all instances into the same Data Groups/URL category, 1=separate Data Groups/URL category per instance (name + "_" + instance)
 
 
 #-----------------------------------------------------------------------
@@ -85,8 +141,19 @@ ipv6_dg = "o365_ipv6_dg"
 # Work directory, file name for guid & version management
 work_directory = "/var/tmp/o365"
 file_name_guid = "/var/tmp/o365/guid.txt"
-file_ms_o365_version = "/var/tmp/o365/o365_version.txt"
+file_ms_o365_version = "/var/tmp/o365/o365_version_%s.txt"     # %s = instance
+file_ms_o365_version_v107 = "/var/tmp/o365/o365_version.txt"   # v1.07 and earlier, read for the first instance until its own file is written
+file_o365_state = "/var/tmp/o365/o365_state_%s.json"            # %s = instance
+file_o365_url_category_state = "/var/tmp/o365/o365_url_category.json"
+file_o365_fingerprints = "/var/tmp/o365/o365_fingerprints.json"
+file_o365_daemon_lock = "/var/tmp/o365/o365_daemon.lock"
+directory_o365_snapshots = "/var/tmp/o365/snapshots"
+file_o365_pin = "/var/tmp/o365/o365_pin.json"       # Written by --rollback: updates are skipped until --unpin
+file_o365_profile = "/var/tmp/o365/o365_update.prof"
+file_o365_pac = "/var/tmp/o365/o365_proxy.pac"       # Written only when the content changed
 log_dest_file = "/var/log/o365_update"
+file_o365_run_log = "/var/log/o365_update.json"     # One JSON record per run (phase timings, entry counts, tmsh status).  "" to disable
+file_o365_prometheus = ""                           # Prometheus textfile collector file, e.g. "/var/lib/node_exporter/textfile/o365_update.prom".  "" to disable
 dg_file_name_urls = "/var/tmp/o365/o365_urls.txt"
 dg_file_name_ip4 = "/var/tmp/o365/o365_ip4.txt"
 dg_file_name_ip6 = "/var/tmp/o365/o365_ip6.txt"
@@ -95,44 +162,2011 @@ dg_file_name_ip6 = "/var/tmp/o365/o365_ip6.txt"
 url_ms_o365_endpoints = "endpoints.office.com"
 url_ms_o365_version = "endpoints.office.com"
 uri_ms_o365_version = "/version?ClientRequestId="
+uri_ms_o365_endpoints = "/endpoints/"
+uri_ms_o365_changes = "/changes/"
+
+# Microsoft Web Service connection
+ms_o365_scheme = "https"    # "https", or "http" for a local test server
+http_timeout = 30           # Seconds to wait for the connection and for each read
+http_retries = 3            # Retries of a failed request
+http_backoff = 2            # Seconds before the first retry, doubled for each further retry (with random jitter)
+http_backoff_max = 60       # Maximum seconds between retries
+ms_o365_max_workers = 5     # Instances requested concurrently
+file_o365_http_cache = "/var/tmp/o365/o365_http_cache.json"
+
+# tmsh execution
+tmsh_command = "tmsh"           # tmsh executable, full path or looked up in PATH
+tmsh_batch = 1                  # 0=one tmsh process per command, 1=run queued commands in as few tmsh processes as possible
+tmsh_max_script_bytes = 65536   # Maximum size of the command line given to one tmsh process
+url_category_chunk_entries = 500    # Maximum URL category entry changes per tmsh command
+url_category_chunk_bytes = 32768    # Maximum size of one URL category tmsh command
 
 
 #-----------------------------------------------------------------------
 # Implementation - Please do not modify
 #-----------------------------------------------------------------------
-list_urls_to_bypass = []
-list_urls_to_bypass_fin = []
-string_urls_to_bypass_fin = ""
-list_ips4_to_pbr = []
-list_ips6_to_pbr = []
 failover_state = ""
+compiled_endpoint_filter = None
+tmsh_invocations = 0
+web_clients = threading.local()
+http_stats_lock = threading.Lock()
+http_cache_lock = threading.Lock()     # The cache index is read, changed and written by the threads of several instances
+http_stats = {"requests": 0, "retries": 0, "not_modified": 0, "bytes_received": 0, "bytes_decoded": 0, "seconds": 0.0}
+log_file = None
+log_lock = threading.Lock()
+metrics_lock = threading.Lock()
+run_metrics = {"phases": {}, "entries": {}, "versions": {}, "tmsh": [], "tmsh_failed": 0, "tmsh_rejected": 0}
 
 def log(lev, msg):
+    # Messages are buffered, and written when the run ends (close_log).  Level 1 messages are written at once,
+    # so that they are not lost if the process is killed.
+    global log_file
     if log_level >= lev:
         log_string = "{0:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now()) + " " + msg + "\n"
-        f = open(log_dest_file, "a")
-        f.write(log_string)
-        f.flush()
-        f.close()
+        with log_lock:
+            if log_file is None:
+                log_file = open(log_dest_file, "a", 65536)
+            log_file.write(log_string)
+            if lev <= 1:
+                log_file.flush()
     return
 
-def main():
+def close_log():
+    # Reopened by the next message, so that a rotated log file is not written to
+    global log_file
+    with log_lock:
+        if log_file is not None:
+            log_file.close()
+            log_file = None
+
+def metrics_start():
+    # Begin the record of one run
+    global run_metrics
+    run_metrics = {"start": time.time(),
+                   "phases": {},
+                   "entries": {},
+                   "versions": {},
+                   "tmsh": [],
+                   "tmsh_failed": 0,
+                   "tmsh_rejected": 0,
+                   "http_start": dict(http_stats)}
+
+def add_phase_time(phase, seconds):
+    with metrics_lock:
+        run_metrics["phases"][phase] = run_metrics["phases"].get(phase, 0.0) + seconds
+
+@contextlib.contextmanager
+def timed(phase):
+    # with timed("fetch"): ...  adds the duration to the phase of the current run
+    time_start = time.time()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.time() - time_start)
+
+def count_entries(object_name, stage, count):
+    # Number of entries of an object at a stage: "input", "unique" (after dedupe) and "output" (after reduction/aggregation)
+    with metrics_lock:
+        run_metrics["entries"].setdefault(object_name, {})[stage] = count
+
+def metrics_finish(result):
+    # Complete the record of the run, and write it to the JSON run log and the Prometheus textfile
+    run_metrics["end"] = time.time()
+    run_metrics["result"] = result
+    run_metrics["success"] = result in ("updated", "unchanged", "standby") and run_metrics["tmsh_failed"] == 0
+    dict_http_start = run_metrics.pop("http_start")
+    run_metrics["http"] = dict([(key, http_stats[key] - dict_http_start[key]) for key in http_stats])
+    log(1, "Run " + result + " in " + "%.2f" % (run_metrics["end"] - run_metrics["start"]) + " seconds: "
+        + ", ".join([phase + " %.2f" % run_metrics["phases"][phase] for phase in sorted(run_metrics["phases"])]))
+
+    if file_o365_run_log:
+        try:
+            f = open(file_o365_run_log, "a")
+            f.write(json.dumps(run_metrics, sort_keys=True) + "\n")
+            f.close()
+        except IOError, e:
+            log(1, "Could not write run log " + file_o365_run_log + ": " + str(e))
+    if file_o365_prometheus:
+        try:
+            write_prometheus(run_metrics)
+        except (IOError, OSError), e:
+            log(1, "Could not write Prometheus textfile " + file_o365_prometheus + ": " + str(e))
+
+def prometheus_labels(dict_labels):
+    return "{" + ",".join([key + '="' + str(dict_labels[key]).replace("\\", "\\\\").replace('"', '\\"') + '"' for key in sorted(dict_labels)]) + "}"
+
+def write_prometheus(record):
+    # Textfile for the node_exporter textfile collector.  Written to a temporary file and renamed,
+    # so that the collector never reads a partial file.
+    last_success = 0
+    if os.path.isfile(file_o365_prometheus):
+        f = open(file_o365_prometheus, "r")
+        for line in f:
+            if line.startswith("o365_update_last_success_timestamp_seconds "):
+                last_success = float(line.split()[1])
+        f.close()
+    if record["success"]:
+        last_success = record["end"]
+
+    list_lines = []
+    def metric(name, help, list_samples):
+        list_lines.append("# HELP " + name + " " + help)
+        list_lines.append("# TYPE " + name + " gauge")
+        for dict_labels, value in list_samples:
+            list_lines.append(name + (prometheus_labels(dict_labels) if dict_labels else "") + " " + repr(float(value)))
+
+    metric("o365_update_last_run_timestamp_seconds", "End of the last O365 update run.", [({}, record["end"])])
+    metric("o365_update_last_success_timestamp_seconds", "End of the last successful O365 update run.", [({}, last_success)])
+    metric("o365_update_success", "1 if the last O365 update run succeeded.", [({}, int(record["success"]))])
+    metric("o365_update_duration_seconds", "Duration of the last O365 update run.", [({}, record["end"] - record["start"])])
+    metric("o365_update_phase_duration_seconds", "Duration of each phase of the last O365 update run.",
+           [({"phase": phase}, record["phases"][phase]) for phase in sorted(record["phases"])])
+    metric("o365_update_entries", "Entries of each object before and after dedupe and reduction/aggregation.",
+           [({"object": object_name, "stage": stage}, record["entries"][object_name][stage])
+            for object_name in sorted(record["entries"]) for stage in sorted(record["entries"][object_name])])
+    metric("o365_update_version", "VERSION of the endpoint list of each instance.",
+           [({"instance": instance}, record["versions"][instance]) for instance in sorted(record["versions"])])
+    metric("o365_update_tmsh_invocations", "tmsh processes started by the last O365 update run.", [({}, len(record["tmsh"]))])
+    metric("o365_update_tmsh_failed_commands", "tmsh commands that failed in the last O365 update run.", [({}, record["tmsh_failed"])])
+    metric("o365_update_url_category_rejected_entries", "URL category entries rejected by tmsh and skipped in the last O365 update run.",
+           [({}, record["tmsh_rejected"])])
+    metric("o365_update_http_requests", "Requests to the MS web service in the last O365 update run.", [({}, record["http"]["requests"])])
+    metric("o365_update_http_bytes_received", "Bytes received from the MS web service in the last O365 update run.", [({}, record["http"]["bytes_received"])])
+
+    write_file_atomic(file_o365_prometheus, "\n".join(list_lines) + "\n")
+
+def run_instrumented(function):
+    # Run one update with a metrics record, and with cProfile if profile_run is enabled.
+    # Returns the result of function: "updated", "unchanged", "standby" or "failed".
+    metrics_start()
+    profiler = None
+    if profile_run:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    result = "failed"
+    try:
+        result = function()
+        return result
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(file_o365_profile)
+            f = open(file_o365_profile + ".txt", "w")
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+            f.close()
+            log(1, "Profile written to " + file_o365_profile + " and " + file_o365_profile + ".txt.")
+            # Peak resident set size of the process so far, in kilobytes on Linux
+            run_metrics["memory_peak_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            log(1, "Peak resident memory: " + str(run_metrics["memory_peak_kb"]) + " KB.")
+        metrics_finish(result)
+        close_log()
+
+def tmsh_exec(script, dict_marker_times=None):
+    # Run one tmsh process for one or more ";" separated commands.  Returns exit status and output.
+    # The output is read as it arrives.  dict_marker_times, if given, receives the arrival time of each marker line.
+    global tmsh_invocations
+    tmsh_invocations += 1
+    time_start = time.time()
+    proc = subprocess.Popen([tmsh_command, "-q", "-c", script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    list_lines = []
+    for line in iter(proc.stdout.readline, ""):
+        list_lines.append(line)
+        if dict_marker_times is not None and line.startswith("__o365_tmsh_"):
+            dict_marker_times[line.strip()] = time.time()
+    proc.wait()
+    with metrics_lock:
+        run_metrics["tmsh"].append({"status": proc.returncode, "bytes": len(script), "seconds": time.time() - time_start})
+    return proc.returncode, "".join(list_lines)
+
+def tmsh_failed(output):
+    # tmsh errors start with a message code ("01020036:3: ...") or a parser error
+    return re.search('^([0-9a-fA-F]{8}:[0-9]+:|Syntax Error:|Data Input Error:)', output, re.M) is not None
+
+class TmshBatch(object):
+    # Collects tmsh commands and runs them in as few tmsh processes as possible.
+    # A marker is echoed after each command, so that the output can be told apart per command.
+    # If tmsh stops at a failing command, the remaining commands are run in the next tmsh process.
+    # The time of a command is taken from the arrival of its marker, as far as tmsh flushes its output.
+
+    def __init__(self):
+        self.commands = []
+        self.phases = []
+        self.results = []
+        self.seconds = []
+
+    def add(self, command, phase=None):
+        # Queue a command.  Returns its index for ok() and output().  Its time is added to phase, if given.
+        self.commands.append(command)
+        self.phases.append(phase)
+        return len(self.commands) - 1
+
+    def ok(self, index):
+        return self.results[index][0]
+
+    def output(self, index):
+        return self.results[index][1]
+
+    def marker(self, index):
+        return "__o365_tmsh_" + str(index) + "__"
+
+    def run(self):
+        self.results = [(False, "")] * len(self.commands)
+        self.seconds = [0.0] * len(self.commands)
+        index = 0
+        while index < len(self.commands):
+            time_start = time.time()
+            if not tmsh_batch:
+                status, output = tmsh_exec(self.commands[index])
+                self.results[index] = (status == 0 and not tmsh_failed(output), output.strip())
+                self.seconds[index] = time.time() - time_start
+                index += 1
+                continue
+
+            # Pack as many commands as fit in one tmsh command line
+            list_script = []
+            script_size = 0
+            end = index
+            while end < len(self.commands):
+                part = self.commands[end] + "; run util bash -c \"echo " + self.marker(end) + "\""
+                if list_script and script_size + len(part) + 2 > tmsh_max_script_bytes:
+                    break
+                list_script.append(part)
+                script_size += len(part) + 2
+                end += 1
+            dict_marker_times = {}
+            status, output = tmsh_exec("; ".join(list_script), dict_marker_times)
+            time_end = time.time()
+
+            # Split the output at the markers.  A command without marker is where tmsh stopped.
+            position = 0
+            while index < end:
+                marker_position = output.find(self.marker(index) + "\n", position)
+                if marker_position < 0:
+                    output_command = output[position:].strip()
+                    self.results[index] = (False, output_command)
+                    self.seconds[index] = time_end - time_start
+                    index += 1
+                    break
+                output_command = output[position:marker_position].strip()
+                self.results[index] = (not tmsh_failed(output_command), output_command)
+                time_marker = dict_marker_times.get(self.marker(index), time_end)
+                self.seconds[index] = time_marker - time_start
+                time_start = time_marker
+                position = marker_position + len(self.marker(index)) + 1
+                index += 1
+
+        for index in range(len(self.commands)):
+            if self.phases[index] is not None:
+                add_phase_time(self.phases[index], self.seconds[index])
+
+def count_http_stats(key, value):
+    with http_stats_lock:
+        http_stats[key] += value
+
+class MsWebServiceClient(object):
+    # HTTP client for one MS web service host.  Keeps one connection open for all requests, asks for gzip,
+    # sends conditional requests (ETag / Last-Modified) and retries failures with backoff.
+
+    def __init__(self, host):
+        self.host = host
+        self.conn = None
+
+    def connect(self):
+        if ms_o365_scheme == "http":
+            self.conn = httplib.HTTPConnection(self.host, timeout=http_timeout)
+        else:
+            self.conn = httplib.HTTPSConnection(self.host, timeout=http_timeout)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def iter_body(self, res, f_copy=None):
+        # Generator: the response body in chunks, decompressed on the fly, and also written to f_copy if given
+        if res.getheader("content-encoding", "").lower() == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+        while True:
+            chunk = res.read(65536)
+            if not chunk:
+                break
+            count_http_stats("bytes_received", len(chunk))
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            count_http_stats("bytes_decoded", len(chunk))
+            if f_copy is not None:
+                f_copy.write(chunk)
+            yield chunk
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            count_http_stats("bytes_decoded", len(chunk))
+            if f_copy is not None:
+                f_copy.write(chunk)
+            yield chunk
+
+    def read_body(self, chunks, consume):
+        # Hand the chunks to consume, and read what it left, so that the connection can be reused
+        if consume is None:
+            result = "".join(chunks)
+        else:
+            result = consume(chunks)
+        for chunk in chunks:
+            pass
+        return result
+
+    def get(self, uri, use_cache=True, consume=None):
+        # Returns HTTP status and body.  "304 Not Modified" is returned as 200 with the cached body.
+        # Status is 0 if no response was received at all.
+        # With consume, the body of a 200 response is not read as a whole, but handed over in chunks to consume,
+        # e.g. read_json_array, and its result is returned instead of the body.
+        dict_cache = {}
+        if use_cache:
+            dict_cache = load_http_cache().get(uri, {})
+        # A conditional request only makes sense with the cached body at hand
+        if not os.path.isfile(dict_cache.get("body_file", "")):
+            dict_cache = {}
+
+        dict_headers = {"Accept-Encoding": "gzip"}
+        if dict_cache.get("etag"):
+            dict_headers["If-None-Match"] = dict_cache["etag"]
+        if dict_cache.get("last_modified"):
+            dict_headers["If-Modified-Since"] = dict_cache["last_modified"]
+
+        status = 0
+        body = ""
+        for attempt in range(http_retries + 1):
+            if attempt > 0:
+                count_http_stats("retries", 1)
+                delay = min(http_backoff_max, http_backoff * (2 ** (attempt - 1)))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+            time_start = time.time()
+            file_copy = None
+            complete = False
+            try:
+                if self.conn is None:
+                    self.connect()
+                count_http_stats("requests", 1)
+                self.conn.request('GET', uri, headers=dict_headers)
+                res = self.conn.getresponse()
+                status = res.status
+                if status == 200 and use_cache and (res.getheader("etag") or res.getheader("last-modified")):
+                    # The body goes to the cache as it is read
+                    file_copy = http_cache_body_file(uri) + ".tmp" + str(os.getpid()) + "_" + str(threading.current_thread().ident)
+                    f = open(file_copy, "w")
+                    try:
+                        body = self.read_body(self.iter_body(res, f), consume)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    finally:
+                        f.close()
+                elif status == 200:
+                    body = self.read_body(self.iter_body(res), consume)
+                else:
+                    body = self.read_body(self.iter_body(res), None)
+                complete = True
+            except (socket.error, httplib.HTTPException), e:
+                log(1, "Request to MS web service " + self.host + " failed: " + str(e) + ".  Attempt " + str(attempt + 1) + " of " + str(http_retries + 1) + ".")
+                self.close()
+                status = 0
+                continue
+            except:
+                # The rest of the response is not read, so the connection can not be reused
+                self.close()
+                raise
+            finally:
+                count_http_stats("seconds", time.time() - time_start)
+                if file_copy is not None and not complete and os.path.isfile(file_copy):
+                    os.remove(file_copy)
+
+            if res.getheader("connection", "").lower() == "close":
+                self.close()
+
+            if status == 304 and dict_cache.has_key("body_file") and os.path.isfile(dict_cache["body_file"]):
+                count_http_stats("not_modified", 1)
+                log(2, "Request to MS web service " + uri + " not modified.  Using cached response.")
+                f = open(dict_cache["body_file"], "r")
+                body = self.read_body(iter(lambda: f.read(65536), ""), consume)
+                f.close()
+                return 200, body
+            if status == 304 and dict_cache:
+                # The cached body is gone: forget it, and request the body once more, unconditionally
+                log(1, "Request to MS web service " + uri + " not modified, but the cached response is missing.  Requesting it again.")
+                drop_http_cache(uri)
+                return self.get(uri, use_cache, consume)
+            if status in (429, 500, 502, 503, 504):
+                log(1, "Request to MS web service " + self.host + " returned " + str(status) + ".  Attempt " + str(attempt + 1) + " of " + str(http_retries + 1) + ".")
+                continue
+            if file_copy is not None:
+                save_http_cache(uri, res.getheader("etag"), res.getheader("last-modified"), file_copy)
+            return status, body
+
+        return status, body
+
+def iter_json_array(chunks):
+    # Incremental parser of a JSON array: yields each element as soon as the chunks read so far hold all of it,
+    # so that neither the response nor its text is kept as a whole.
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    expect = "["     # "[", "element" (or "]" right after "["), or "," (or "]")
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position == len(buffer):
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("JSON array is truncated")
+            buffer = chunk
+            position = 0
+            continue
+
+        char = buffer[position]
+        if expect == "[":
+            if char != "[":
+                raise ValueError("JSON array expected, found " + repr(buffer[position:position + 20]))
+            position += 1
+            expect = "first"
+        elif char == "]" and expect in ("first", ","):
+            return
+        elif expect == ",":
+            if char != ",":
+                raise ValueError("\",\" or \"]\" expected in JSON array, found " + repr(buffer[position:position + 20]))
+            position += 1
+            expect = "element"
+        else:
+            # An element is complete when it is followed by "," or "]" (or white space).  Otherwise it may go on in the
+            # next chunk: a split string, or a number "12" of "123" or "1.5" of "1.5e3".
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                end = None
+            if end is None or end == len(buffer) or buffer[end] not in ",] \t\r\n":
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    buffer = buffer[position:] + chunk
+                    position = 0
+                    continue
+                if end is None:
+                    raise ValueError("JSON array is truncated or not valid")
+            yield element
+            position = end
+            expect = ","
+
+def read_json_array(chunks):
+    # The elements of a JSON array read in chunks, parsed as the chunks arrive
+    return list(iter_json_array(chunks))
+
+def load_http_cache():
+    # URI -> ETag, Last-Modified and file holding the body of the last 200 response
+    if not os.path.isfile(file_o365_http_cache):
+        return {}
+    try:
+        f = open(file_o365_http_cache, "r")
+        dict_cache = json.load(f)
+        f.close()
+    except ValueError:
+        return {}
+    if not isinstance(dict_cache, dict):
+        return {}
+    return dict_cache
+
+def http_cache_body_file(uri):
+    return os.path.join(work_directory, "o365_http_cache_" + hashlib.sha1(uri).hexdigest()[:16] + ".json")
+
+def drop_http_cache(uri):
+    with http_cache_lock:
+        dict_cache = load_http_cache()
+        if dict_cache.pop(uri, None) is not None:
+            write_file_atomic(file_o365_http_cache, json.dumps(dict_cache))
+
+def save_http_cache(uri, etag, last_modified, file_body):
+    # file_body holds the body as read, and is renamed to the cache file of the URI
+    body_file = http_cache_body_file(uri)
+    os.rename(file_body, body_file)
+    with http_cache_lock:
+        dict_cache = load_http_cache()
+        dict_cache[uri] = {"etag": etag, "last_modified": last_modified, "body_file": body_file}
+        write_file_atomic(file_o365_http_cache, json.dumps(dict_cache))
+
+def ms_web_service_get(host, uri, use_cache=True, consume=None):
+    # Send a GET request to the MS web service, reusing the connection to the host.  Returns HTTP status and response body,
+    # or what consume made of the body (see MsWebServiceClient.get).
+    # Each thread has its own connections
+    if not hasattr(web_clients, "clients"):
+        web_clients.clients = {}
+    if not web_clients.clients.has_key(host):
+        web_clients.clients[host] = MsWebServiceClient(host)
+    return web_clients.clients[host].get(uri, use_cache, consume)
+
+def close_web_clients():
+    # Close the connections of this thread
+    if hasattr(web_clients, "clients"):
+        for client in web_clients.clients.values():
+            client.close()
+
+def run_concurrently(function, list_args, max_workers):
+    # Call function for each item of list_args in a pool of up to max_workers threads.
+    # Returns the results in the order of list_args.  An exception in any call is raised again here.
+    # A single item, or a single worker, runs in this thread, so that it reuses the connections of this thread.
+    list_results = [None] * len(list_args)
+    list_errors = []
+    queue_work = Queue.Queue()
+    for index in range(len(list_args)):
+        queue_work.put(index)
+
+    def work():
+        while True:
+            try:
+                index = queue_work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                list_results[index] = function(list_args[index])
+            except Exception, e:
+                log(1, "Worker failed for " + str(list_args[index]) + ": " + traceback.format_exc())
+                list_errors.append(e)
+
+    def worker():
+        # The connections of a worker end with it
+        try:
+            work()
+        finally:
+            close_web_clients()
+
+    if len(list_args) <= 1 or max_workers <= 1:
+        work()
+    else:
+        list_threads = []
+        for i in range(min(max_workers, len(list_args))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            list_threads.append(thread)
+        for thread in list_threads:
+            thread.join()
+    if list_errors:
+        raise list_errors[0]
+    return list_results
+
+def write_file_atomic(file_name, content):
+    # Write a temporary file next to the file and rename it over the file, so that a reader (or the next run
+    # after a crash) sees either the old or the new content, never a partial one
+    file_temp = file_name + ".tmp" + str(os.getpid()) + "_" + str(threading.current_thread().ident)
+    f = open(file_temp, "w")
+    f.write(content)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(file_temp, file_name)
+
+def read_version_previous(instance):
+    # Read version of previously received record of the instance.
+    # The first instance falls back to the VERSION file of v1.07, so that an upgrade does not update again.
+    file_version = file_ms_o365_version % instance
+    if not os.path.isfile(file_version) and instance == ms_o365_instances[0] and os.path.isfile(file_ms_o365_version_v107):
+        file_version = file_ms_o365_version_v107
+    if os.path.isfile(file_version):
+        f = open(file_version, "r")
+        f_content = f.readline()
+        f.close()
+        # Check if the VERSION record format is valid
+        if re.match('[0-9]{10}', f_content):
+            log(2, "Valid previous VERSION found in " + file_version + ".")
+            if file_version == file_ms_o365_version_v107:
+                write_version(instance, f_content.strip())
+                log(1, "Previous VERSION " + f_content.strip() + " of " + file_version + " copied to " + file_ms_o365_version % instance + ".")
+            return f_content
+    ms_o365_version_previous = "1970010200"
+    write_version(instance, ms_o365_version_previous)
+    log(1, "Valid previous VERSION was not found.  Wrote dummy value in " + file_ms_o365_version % instance + ".")
+    return ms_o365_version_previous
+
+def write_version(instance, version):
+    write_file_atomic(file_ms_o365_version % instance, version)
+
+def load_state(instance):
+    # Read the endpoint set of the last applied VERSION of the instance.
+    # Returns None if the state file is missing or not usable.
+    file_state = file_o365_state % instance
+    if not os.path.isfile(file_state):
+        return None
+    try:
+        f = open(file_state, "r")
+        state = json.load(f)
+        f.close()
+    except ValueError:
+        return None
+    if not isinstance(state, dict) \
+        or not re.match('[0-9]{10}$', str(state.get("version", ""))) \
+        or not isinstance(state.get("endpoints"), list):
+        return None
+    return state
+
+def save_state(instance, version, list_records):
+    # Remember what has been applied, as the base for the next incremental update
+    write_file_atomic(file_o365_state % instance, json.dumps({"version": version,
+                                                              "instance": instance,
+                                                              "endpoints": list_records}))
+
+def load_url_category_state():
+    # URL category name -> entries applied by the previous run
+    if not os.path.isfile(file_o365_url_category_state):
+        return {}
+    try:
+        f = open(file_o365_url_category_state, "r")
+        dict_state = json.load(f)
+        f.close()
+    except ValueError:
+        return {}
+    if not isinstance(dict_state, dict):
+        return {}
+    return dict_state
+
+def save_url_category_state(dict_state):
+    write_file_atomic(file_o365_url_category_state, json.dumps(dict_state))
+
+def content_fingerprint(content):
+    # Hash of the content of a BIG-IP object, to tell whether it needs to be imported again
+    if isinstance(content, unicode):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def load_fingerprints():
+    # Read the content hash of each BIG-IP object as of its last successful import
+    if not os.path.isfile(file_o365_fingerprints):
+        return {}
+    try:
+        f = open(file_o365_fingerprints, "r")
+        dict_fingerprints = json.load(f)
+        f.close()
+    except ValueError:
+        return {}
+    if not isinstance(dict_fingerprints, dict):
+        return {}
+    return dict_fingerprints
+
+def save_fingerprints(dict_fingerprints):
+    write_file_atomic(file_o365_fingerprints, json.dumps(dict_fingerprints))
+
+def url_category_fingerprint(objects):
+    # Fingerprint key and hash of the URL category of the objects.
+    # The VERSION entry alone does not make the category content change.
+    dict_url_category = objects["url_category_entries"]
+    version_entry = "https://" + objects["url_category_version"] + "/"
+    return ("url-category " + objects["url_category"],
+            content_fingerprint("\n".join(sorted([url + " " + dict_url_category[url] for url in dict_url_category if url != version_entry]))))
+
+def apply_endpoint_changes(list_records, list_changes):
+    # Patch a stored endpoint set with the records returned by the "changes" method.
+    # Returns the patched endpoint set, or None if the changes do not fit the stored set.
+    dict_records = {}
+    for record in list_records:
+        dict_records[record["id"]] = record
+
+    for change in sorted(list_changes, key=lambda c: (c.get("version", ""), c.get("id", 0))):
+        if not change.has_key("endpointSetId") or not change.has_key("disposition"):
+            return None
+        endpoint_set_id = change["endpointSetId"]
+        disposition = str(change["disposition"]).lower()
+        record = dict_records.get(endpoint_set_id)
+        dict_current = change.get("current", {})
+
+        # Endpoint set removed as a whole
+        if disposition == "remove":
+            if record is None:
+                return None
+            del dict_records[endpoint_set_id]
+            continue
+
+        # New endpoint set.  Without its serviceArea it can not be filtered, so give up.
+        if record is None:
+            if disposition != "add" or not dict_current.has_key("serviceArea"):
+                return None
+            record = {"id": endpoint_set_id}
+            dict_records[endpoint_set_id] = record
+
+        for key in dict_current:
+            record[key] = dict_current[key]
+
+        dict_add = change.get("add", {})
+        for key in ("urls", "ips"):
+            for value in dict_add.get(key, []):
+                if value not in record.setdefault(key, []):
+                    record[key].append(value)
+
+        dict_remove = change.get("remove", {})
+        for value in dict_remove.get("urls", []):
+            for key in ("urls", "allowUrls", "defaultUrls"):
+                if value in record.get(key, []):
+                    record[key].remove(value)
+        for value in dict_remove.get("ips", []):
+            if value in record.get("ips", []):
+                record["ips"].remove(value)
+
+    return [dict_records[key] for key in sorted(dict_records)]
+
+def parse_port_ranges(ports):
+    # "80,443,3478-3481" -> [(80, 80), (443, 443), (3478, 3481)]
+    list_ranges = []
+    for part in str(ports).split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            list_ranges.append((int(first), int(last)))
+        else:
+            list_ranges.append((int(part), int(part)))
+    return list_ranges
+
+def compile_endpoint_filter():
+    # Turn endpoint_filter_rules (or the care_* options) into a list of (description, action, list of tests).
+    # Each test takes an endpoint set and returns True if it matches.
+    list_rules = endpoint_filter_rules
+    if not list_rules:
+        list_service_areas = []
+        for care, service_area in ((care_common, "Common"), (care_exchange, "Exchange"), (care_skype, "Skype"),
+                                   (care_sharepoint, "SharePoint"), (care_yammer, "Yammer")):
+            if care:
+                list_service_areas.append(service_area)
+        list_rules = [{"serviceArea": list_service_areas, "action": "include"}]
+
+    list_filter = []
+    for rule in list_rules:
+        list_tests = []
+        list_description = []
+        for key in sorted(rule):
+            value = rule[key]
+            if key == "action":
+                if value not in ("include", "exclude"):
+                    raise ValueError("Endpoint filter rule " + str(rule) + ": action must be \"include\" or \"exclude\"")
+                continue
+            if key in ("serviceArea", "category", "tcpPorts", "udpPorts") and not isinstance(value, (list, tuple)):
+                # A single "Optimize" would be taken for a set of letters
+                raise ValueError("Endpoint filter rule " + str(rule) + ": " + key + " must be a list")
+            if key in ("serviceArea", "category"):
+                set_values = set([str(item).lower() for item in value])
+                list_tests.append(lambda record, key=key, set_values=set_values: str(record.get(key, "")).lower() in set_values)
+                list_description.append(key + "=" + ",".join(value))
+            elif key in ("required", "expressRoute"):
+                list_tests.append(lambda record, key=key, value=bool(value): bool(record.get(key, False)) == value)
+                list_description.append(key + "=" + str(bool(value)).lower())
+            elif key in ("tcpPorts", "udpPorts"):
+                list_ports = [int(port) for port in value]
+                def test(record, key=key, list_ports=list_ports):
+                    for first, last in parse_port_ranges(record.get(key, "")):
+                        for port in list_ports:
+                            if first <= port <= last:
+                                return True
+                    return False
+                list_tests.append(test)
+                list_description.append(key + "=" + ",".join([str(port) for port in list_ports]))
+            else:
+                raise ValueError("Endpoint filter rule " + str(rule) + ": unknown key " + key)
+        action = rule.get("action", "include")
+        list_filter.append((action + " " + (" ".join(list_description) or "all"), action, list_tests))
+    return list_filter
+
+def endpoint_filter():
+    # Compiled once per process
+    global compiled_endpoint_filter
+    if compiled_endpoint_filter is None:
+        compiled_endpoint_filter = compile_endpoint_filter()
+    return compiled_endpoint_filter
+
+def url_dg_entry(url):
+    # Data Group entry of a lower case URL: everything up to a wildcard label is dropped.
+    # "*.office.com" -> ".office.com", "autodiscover.*.onmicrosoft.com" -> ".onmicrosoft.com", "*-admin.sharepoint.com" -> ".sharepoint.com"
+    position = url.rfind("*")
+    if position < 0:
+        return url
+    position = url.find(".", position)
+    if position < 0:
+        return ""
+    return url[position:]
+
+def parse_endpoints(records):
+    # Normalise, classify and deduplicate the URLs and IP addresses of the endpoint sets selected by the endpoint filter,
+    # in one pass over the endpoint sets.  records may be a list or any iterable, e.g. iter_json_array() over a response.
+    # The first matching rule decides.  Endpoint sets matching no rule are left out.
+    # Returns a dict, used for all objects built from the endpoint sets:
+    #   "urls": lower case URLs as listed ("*.office.com"), "url_entries": their Data Group entries (".office.com"),
+    #   "ips4", "ips6": networks, "details": Data Group entry or network -> value detail (dg_value_mode only),
+    #   "counts": URLs, IPv4 and IPv6 networks before dedupe
+    endpoints = {"urls": set(), "url_entries": set(), "ips4": set(), "ips6": set(), "details": {},
+                 "counts": {"urls": 0, "ips4": 0, "ips6": 0}}
+    set_urls = endpoints["urls"]
+    set_url_entries = endpoints["url_entries"]
+    set_ips4 = endpoints["ips4"]
+    set_ips6 = endpoints["ips6"]
+    dict_details = endpoints["details"]
+    dict_url_entries = {}
+    list_filter = endpoint_filter()
+    list_counts = [[0, 0, 0] for rule in list_filter]   # endpoint sets, URLs, IPs per rule
+    count_unmatched = 0
+    count_urls = 0
+    count_ips4 = 0
+    count_ips6 = 0
+
+    # Process for each record(id) of the endpoint JSON data
+    for dict_o365_record in records:
+        rule_index = None
+        for index, (description, action, list_tests) in enumerate(list_filter):
+            if all([test(dict_o365_record) for test in list_tests]):
+                rule_index = index
+                break
+        if rule_index is None:
+            count_unmatched += 1
+            continue
+
+        # "urls", "allowUrls" and "defaultUrls" if existent in each record
+        list_counts[rule_index][0] += 1
+        for key in ('urls', 'allowUrls', 'defaultUrls'):
+            list_counts[rule_index][1] += len(dict_o365_record.get(key, ()))
+        list_counts[rule_index][2] += len(dict_o365_record.get('ips', ()))
+        if list_filter[rule_index][1] != "include":
+            continue
+
+        detail = None
+        if dg_value_mode:
+            detail = endpoint_detail(dict_o365_record)
+
+        for key in ('urls', 'allowUrls', 'defaultUrls'):
+            for url in dict_o365_record.get(key, ()):
+                count_urls += 1
+                url = url.lower()
+                entry = dict_url_entries.get(url)
+                if entry is None:
+                    entry = dict_url_entries[url] = url_dg_entry(url)
+                    set_urls.add(url)
+                    set_url_entries.add(entry)
+                # Data Group value of each entry, merged when several endpoint sets list it
+                if detail is not None:
+                    dict_details[entry] = merge_details(dict_details.get(entry), detail)
+
+        for ip in dict_o365_record.get('ips', ()):
+            if ":" in ip:
+                count_ips6 += 1
+                set_ips6.add(ip)
+            else:
+                count_ips4 += 1
+                set_ips4.add(ip)
+            if detail is not None:
+                dict_details[ip] = merge_details(dict_details.get(ip), detail)
+
+    endpoints["counts"] = {"urls": count_urls, "ips4": count_ips4, "ips6": count_ips6}
+    for index, (description, action, list_tests) in enumerate(list_filter):
+        endpoint_sets, urls, ips = list_counts[index]
+        log(1, "Endpoint filter rule " + str(index + 1) + " (" + description + "): " + str(endpoint_sets) + " endpoint sets, "
+            + str(urls) + " URLs, " + str(ips) + " IPs " + ("kept" if action == "include" else "dropped") + ".")
+        count_entries("endpoint filter rule " + str(index + 1), "endpoint sets", endpoint_sets)
+        count_entries("endpoint filter rule " + str(index + 1), "urls", urls)
+        count_entries("endpoint filter rule " + str(index + 1), "ips", ips)
+    log(2, "Endpoint filter: " + str(count_unmatched) + " endpoint sets matched no rule.")
+    return endpoints
+
+def merge_port_ranges(list_ranges):
+    # Sort and merge overlapping & adjacent port ranges
+    list_merged = []
+    for first, last in sorted(list_ranges):
+        if list_merged and first <= list_merged[-1][1] + 1:
+            if last > list_merged[-1][1]:
+                list_merged[-1] = (list_merged[-1][0], last)
+        else:
+            list_merged.append((first, last))
+    return list_merged
+
+def format_port_ranges(list_ranges):
+    # [(80, 80), (3478, 3481)] -> "80,3478-3481"
+    return ",".join([str(first) if first == last else str(first) + "-" + str(last) for first, last in list_ranges])
+
+def endpoint_detail(record):
+    # Data Group value of an endpoint set: (set of ids, category rank, TCP port ranges, UDP port ranges)
+    # The category rank is 0 for Optimize, 1 for Allow and 2 for Default.
+    rank = {"optimize": 0, "allow": 1}.get(str(record.get("category", "")).lower(), 2)
+    return (set([record.get("id")]), rank, merge_port_ranges(parse_port_ranges(record.get("tcpPorts", ""))),
+            merge_port_ranges(parse_port_ranges(record.get("udpPorts", ""))))
+
+def merge_details(detail_a, detail_b):
+    # Value of an entry listed by both: all ids, the strongest category and all ports
+    if detail_a is None:
+        return detail_b
+    return (detail_a[0] | detail_b[0], min(detail_a[1], detail_b[1]), merge_port_ranges(detail_a[2] + detail_b[2]),
+            merge_port_ranges(detail_a[3] + detail_b[3]))
+
+def format_detail(detail):
+    # Data Group value "ids;category;tcpPorts;udpPorts"
+    return ",".join([str(id) for id in sorted(detail[0])]) + ";" + "OAD"[detail[1]] + ";" + format_port_ranges(detail[2]) \
+        + ";" + format_port_ranges(detail[3])
+
+def detail_group(detail):
+    # Entries with the same category and ports may be reduced/aggregated together
+    return format_detail(detail).split(";", 1)[1]
+
+def reduce_url_suffixes(list_urls, log_result=True):
+    # Drop Data Group entries that a shorter entry already covers on a label boundary.
+    # "office.com" covers the domain and its subdomains, ".office.com" (from "*.office.com") the subdomains only.
+    # The entries are put in a trie of reversed labels: com -> office -> outlook.  The flag key None holds
+    # 1 for "domain" and 2 for ".domain" entries.  Anything below a flagged node is covered by it.
+    trie = {}
+    for url in set(list_urls):
+        labels = url.lstrip(".").split(".")
+        if labels == [""]:
+            continue
+        node = trie
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        if url.startswith("."):
+            node[None] = node.get(None, 0) | 2
+        else:
+            node[None] = node.get(None, 0) | 1
+
+    list_reduced = []
+    list_stack = [(trie, [])]
+    while list_stack:
+        node, labels = list_stack.pop()
+        if node.get(None, 0) & 1:
+            list_reduced.append(".".join(reversed(labels)))
+        elif node.get(None, 0) & 2:
+            list_reduced.append("." + ".".join(reversed(labels)))
+        else:
+            for label in node:
+                if label is not None:
+                    list_stack.append((node[label], labels + [label]))
+
+    list_reduced.sort()
+    if log_result:
+        log(1, "URL Data Group reduction: " + str(len(set(list_urls))) + " -> " + str(len(list_reduced)) + " entries")
+    return list_reduced
+
+def ip_network_to_int(network):
+    # "address/prefix" (IPv4 or IPv6) -> (address as integer with host bits cleared, prefix length, address bits)
+    if "/" in network:
+        address, prefix_len = network.split("/", 1)
+    else:
+        address, prefix_len = network, None
+    if ":" in address:
+        family, bits = socket.AF_INET6, 128
+    else:
+        family, bits = socket.AF_INET, 32
+    if prefix_len is None:
+        prefix_len = bits
+    prefix_len = int(prefix_len)
+    value = int(binascii.hexlify(socket.inet_pton(family, address.strip())), 16)
+    value = value >> (bits - prefix_len) << (bits - prefix_len)
+    return value, prefix_len, bits
+
+def ip_int_to_network(value, prefix_len, bits):
+    # Reverse of ip_network_to_int()
+    if bits == 128:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    return socket.inet_ntop(family, binascii.unhexlify("%0*x" % (bits // 4, value))) + "/" + str(prefix_len)
+
+def ip_range_to_blocks(first, last, bits):
+    # Smallest list of CIDR blocks (first address, prefix length) that covers first..last exactly
+    list_blocks = []
+    while first <= last:
+        # Largest block aligned on "first" that does not go beyond "last"
+        if first == 0:
+            size = 1 << bits
+        else:
+            size = first & -first
+        while first + size - 1 > last:
+            size >>= 1
+        list_blocks.append((first, bits - size.bit_length() + 1))
+        first += size
+    return list_blocks
+
+def ip_merge_ranges(list_blocks, bits):
+    # Merge overlapping & adjacent blocks into sorted, disjoint [first address, last address] ranges
+    list_ranges = []
+    for first, prefix_len in sorted(list_blocks):
+        last = first + (1 << (bits - prefix_len)) - 1
+        if list_ranges and first <= list_ranges[-1][1] + 1:
+            if last > list_ranges[-1][1]:
+                list_ranges[-1][1] = last
+        else:
+            list_ranges.append([first, last])
+    return list_ranges
+
+def ip_collapse_blocks(list_blocks, bits):
+    # Merge overlapping & adjacent blocks, and return the smallest equivalent set of blocks
+    list_collapsed = []
+    for first, last in ip_merge_ranges(list_blocks, bits):
+        list_collapsed.extend(ip_range_to_blocks(first, last, bits))
+    return list_collapsed
+
+def ip_supernet_blocks(list_blocks, bits, max_entries, max_extra):
+    # Replace neighbouring blocks by their common supernet, cheapest first (fewest addresses added),
+    # until max_entries is reached or the added addresses would exceed max_extra.
+    # Returns the blocks and the number of addresses added.
+    extra_total = 0
+    while len(list_blocks) > max_entries:
+        list_first = [first for first, prefix_len in list_blocks]
+        # Running total of block sizes, to count the addresses already covered within a supernet
+        list_size_sum = [0]
+        for first, prefix_len in list_blocks:
+            list_size_sum.append(list_size_sum[-1] + (1 << (bits - prefix_len)))
+
+        best = None
+        for i in range(len(list_blocks) - 1):
+            first = list_blocks[i][0]
+            last = list_blocks[i + 1][0] + (1 << (bits - list_blocks[i + 1][1])) - 1
+            prefix_len = bits - (first ^ last).bit_length()
+            super_first = first >> (bits - prefix_len) << (bits - prefix_len)
+            super_size = 1 << (bits - prefix_len)
+            start = bisect.bisect_left(list_first, super_first)
+            end = bisect.bisect_left(list_first, super_first + super_size)
+            extra = super_size - (list_size_sum[end] - list_size_sum[start])
+            if best is None or extra < best[0]:
+                best = (extra, start, end, super_first, prefix_len)
+
+        extra, start, end, super_first, prefix_len = best
+        if extra_total + extra > max_extra:
+            break
+        extra_total += extra
+        list_blocks = ip_collapse_blocks(list_blocks[:start] + [(super_first, prefix_len)] + list_blocks[end:], bits)
+    return list_blocks, extra_total
+
+def aggregate_networks(list_networks, family_name):
+    # Collapse the networks of one address family.  Returns the networks to write in the Data Group.
+    if not list_networks:
+        return []
+    list_blocks = []
+    for network in set(list_networks):
+        value, prefix_len, bits = ip_network_to_int(network)
+        list_blocks.append((value, prefix_len))
+
+    list_blocks = ip_collapse_blocks(list_blocks, bits)
+    num_collapsed = len(list_blocks)
+
+    extra = 0
+    if ip_aggregate_max_entries > 0 and len(list_blocks) > ip_aggregate_max_entries:
+        num_addresses = sum([1 << (bits - prefix_len) for value, prefix_len in list_blocks])
+        list_blocks, extra = ip_supernet_blocks(list_blocks, bits, ip_aggregate_max_entries,
+                                                int(num_addresses * ip_aggregate_max_overcoverage))
+        if len(list_blocks) > ip_aggregate_max_entries:
+            log(1, family_name + " aggregation: could not reach " + str(ip_aggregate_max_entries) + " entries within the allowed over-coverage.")
+
+    num_before = len(set(list_networks))
+    log(1, family_name + " aggregation: " + str(num_before) + " -> " + str(len(list_blocks)) + " entries ("
+        + str(100 - len(list_blocks) * 100 // num_before) + "% smaller, " + str(num_collapsed) + " after exact collapse, "
+        + str(extra) + " addresses added by supernets)")
+    return [ip_int_to_network(value, prefix_len, bits) for value, prefix_len in list_blocks]
+
+def build_url_dg_values(set_entries, dict_endpoint_details):
+    # URL Data Group entries with values.  Returns a sorted list of (entry, value).
+    dict_details = dict([(key, dict_endpoint_details[key]) for key in set_entries])
+
+    # Reduce within the entries of the same category and ports only, so that no host changes its value
+    if url_dg_reduce:
+        dict_groups = {}
+        for key in dict_details:
+            dict_groups.setdefault(detail_group(dict_details[key]), []).append(key)
+        list_kept = []
+        for list_keys in dict_groups.values():
+            list_kept.extend(reduce_url_suffixes(list_keys, False))
+        log(1, "URL Data Group reduction: " + str(len(dict_details)) + " -> " + str(len(list_kept)) + " entries in "
+            + str(len(dict_groups)) + " value groups")
+        dict_details = dict([(key, dict_details[key]) for key in list_kept])
+
+    # "office.com" and "*.office.com" both become ".office.com", which matches office.com and its subdomains
+    if url_dg_label_boundary:
+        dict_boundary = {}
+        for key in dict_details:
+            key_boundary = "." + key.lstrip(".")
+            dict_boundary[key_boundary] = merge_details(dict_boundary.get(key_boundary), dict_details[key])
+        dict_details = dict_boundary
+
+    # A host matching an entry also matches the shorter entries it ends with.  Each entry takes in the values of
+    # the entries covering it (shortest first), so the value of any single match is complete.
+    # ".office.com" is covered by "office.com" too.
+    for key in sorted(dict_details, key=len):
+        for position in range(len(key)):
+            if key[position] == ".":
+                for key_covering in (key[position:], key[position + 1:]):
+                    if key_covering != key and key_covering in dict_details:
+                        dict_details[key] = merge_details(dict_details[key], dict_details[key_covering])
+    return [(key, format_detail(dict_details[key])) for key in sorted(dict_details)]
+
+def build_ip_dg_values(list_networks, dict_endpoint_details, family_name):
+    # IPv4/IPv6 Data Group entries with values.  Returns a sorted list of (network, value).
+    if not list_networks:
+        return []
+    dict_groups = {}
+    for network in set(list_networks):
+        value, prefix_len, bits = ip_network_to_int(network)
+        detail = dict_endpoint_details[network]
+        dict_groups.setdefault(detail_group(detail), []).append((value, prefix_len, detail))
+
+    # Collapse within the networks of the same category and ports only.  The ids of a collapsed block are
+    # those of the networks it is made of.  No supernets: their addresses would get the ports of networks they are not in.
+    if ip_aggregate and ip_aggregate_max_entries > 0:
+        log(1, family_name + " aggregation: ip_aggregate_max_entries does not apply with dg_value_mode = 1.  Networks are collapsed exactly only.")
+    dict_blocks = {}
+    for list_group in dict_groups.values():
+        if ip_aggregate:
+            list_blocks = ip_collapse_blocks([(value, prefix_len) for value, prefix_len, detail in list_group], bits)
+        else:
+            list_blocks = sorted(set([(value, prefix_len) for value, prefix_len, detail in list_group]))
+        list_first = [first for first, prefix_len in list_blocks]
+        for value, prefix_len, detail in list_group:
+            block = list_blocks[bisect.bisect_right(list_first, value) - 1]
+            dict_blocks[block] = merge_details(dict_blocks.get(block), detail)
+
+    # Address lookups return the value of the longest match, so each network takes in the values of the
+    # networks containing it.  The stack holds the enclosing networks, innermost last.
+    list_values = []
+    list_stack = []
+    for first, prefix_len in sorted(dict_blocks):
+        last = first + (1 << (bits - prefix_len)) - 1
+        while list_stack and list_stack[-1][0] < first:
+            list_stack.pop()
+        detail = dict_blocks[(first, prefix_len)]
+        if list_stack:
+            detail = merge_details(list_stack[-1][1], detail)
+        list_stack.append((last, detail))
+        list_values.append((ip_int_to_network(first, prefix_len, bits), format_detail(detail)))
+
+    log(1, family_name + " Data Group values: " + str(len(set(list_networks))) + " -> " + str(len(list_values)) + " entries in "
+        + str(len(dict_groups)) + " value groups")
+    return list_values
+
+def build_url_category_entries(version, list_urls):
+    # URL category entries (URL -> match type).  The VERSION is kept as an entry of its own.
+    dict_entries = {"https://" + version + "/": "exact-match"}
+    for url in set(list_urls):
+        # Force URL to lower case
+        url = url.lower()
+
+        # If URL contains an asterisk, set as a glob-match URL, otherwise exact-match.
+        # Both HTTPS and HTTP category lookups use "https://", with the subtle difference that the HTTP URLs match an entry with no trailing forward slash"
+        if "*" in url:
+            match_type = "glob-match"
+        else:
+            match_type = "exact-match"
+        dict_entries["https://" + url + "/"] = match_type
+        dict_entries["https://" + url] = match_type
+    return dict_entries
+
+def url_category_entry_name(url):
+    # Glob entries are quoted with any asterisk characters escaped, so that tmsh takes them literally
+    if "*" in url:
+        return "\"" + url.replace("*", "\\*") + "\""
+    return url
+
+# PAC file.  Plain ES3, evaluated by the browsers for every request: one hash lookup per label of the host name,
+# and a binary search over the address ranges for IP literals only.  No DNS lookups.
+pac_template = """// Office 365 proxy bypass, generated by o365_ip_url_automation.py
+// %(domains)d domains, %(ranges4)d IPv4 ranges, %(ranges6)d IPv6 ranges
+
+var o365_proxy = %(proxy)s;
+
+// Domain -> 1: the domain and its subdomains, 2: the subdomains only
+var o365_domains = {%(table)s};
+
+// Sorted, disjoint address ranges: first and last address as numbers (IPv4) or 32 hex digits (IPv6)
+var o365_ip4_first = [%(ip4_first)s];
+var o365_ip4_last = [%(ip4_last)s];
+var o365_ip6_first = [%(ip6_first)s];
+var o365_ip6_last = [%(ip6_last)s];
+
+function o365_in_ranges(value, list_first, list_last) {
+  var low = 0, high = list_first.length - 1, middle;
+  while (low <= high) {
+    middle = (low + high) >> 1;
+    if (value < list_first[middle]) {
+      high = middle - 1;
+    } else if (value > list_last[middle]) {
+      low = middle + 1;
+    } else {
+      return true;
+    }
+  }
+  return false;
+}
+
+function o365_ip4(host) {
+  var parts = /^(\\d{1,3})\\.(\\d{1,3})\\.(\\d{1,3})\\.(\\d{1,3})$/.exec(host);
+  if (!parts || parts[1] > 255 || parts[2] > 255 || parts[3] > 255 || parts[4] > 255) {
+    return -1;
+  }
+  return ((parts[1] * 256 + +parts[2]) * 256 + +parts[3]) * 256 + +parts[4];
+}
+
+function o365_ip6(host) {
+  var halves = host.split("::"), head, tail, groups, hex = "", i;
+  head = halves[0] ? halves[0].split(":") : [];
+  tail = halves.length == 2 && halves[1] ? halves[1].split(":") : [];
+  if (halves.length > 2 || (halves.length == 1 && head.length != 8) || head.length + tail.length > 7 + (halves.length == 1)) {
+    return "";
+  }
+  groups = head;
+  for (i = head.length + tail.length; i < 8; i++) {
+    groups.push("0");
+  }
+  groups = groups.concat(tail);
+  for (i = 0; i < 8; i++) {
+    if (!/^[0-9a-f]{1,4}$/.test(groups[i])) {
+      return "";
+    }
+    hex += ("000" + groups[i]).slice(-4);
+  }
+  return hex;
+}
+
+function FindProxyForURL(url, host) {
+  var name = host.toLowerCase(), code, value, i;
+  if (name.indexOf(":") >= 0) {
+    value = o365_ip6(name.replace(/^\\[|\\]$/g, "").split("%%")[0]);
+    return value && o365_in_ranges(value, o365_ip6_first, o365_ip6_last) ? "DIRECT" : o365_proxy;
+  }
+  if (name.charAt(name.length - 1) == ".") {
+    name = name.substring(0, name.length - 1);
+  }
+  // Top level domains are not numeric, so a host name ending with a digit is an IPv4 address
+  code = name.charCodeAt(name.length - 1);
+  if (code >= 48 && code <= 57) {
+    value = o365_ip4(name);
+    return value >= 0 && o365_in_ranges(value, o365_ip4_first, o365_ip4_last) ? "DIRECT" : o365_proxy;
+  }
+  if (o365_domains[name] === 1) {
+    return "DIRECT";
+  }
+  for (i = name.indexOf("."); i >= 0; i = name.indexOf(".")) {
+    name = name.substring(i + 1);
+    if (o365_domains[name] === 1 || o365_domains[name] === 2) {
+      return "DIRECT";
+    }
+  }
+  return o365_proxy;
+}
+"""
+
+def pac_ranges(list_networks):
+    # Networks -> sorted, disjoint [first, last] address ranges, and the address bits (32 or 128)
+    list_blocks = []
+    bits = 32
+    for network in set(list_networks):
+        value, prefix_len, bits = ip_network_to_int(network)
+        list_blocks.append((value, prefix_len))
+    return ip_merge_ranges(list_blocks, bits), bits
+
+def build_pac(endpoints):
+    # PAC file returning DIRECT for the URLs and networks of parse_endpoints(), and pac_proxy otherwise.
+    # The URLs are reduced like the URL Data Group, and looked up by domain suffix in a hash table.
+    list_domains = reduce_url_suffixes(endpoints["url_entries"], log_result=False)
+    list_table = []
+    for domain in list_domains:
+        if domain.startswith("."):
+            list_table.append(json.dumps(domain[1:]) + ":2")
+        else:
+            list_table.append(json.dumps(domain) + ":1")
+
+    list_ranges4, bits = pac_ranges(endpoints["ips4"])
+    list_ranges6, bits = pac_ranges(endpoints["ips6"])
+    count_entries("pac", "domains", len(list_domains))
+    count_entries("pac", "ipv4 ranges", len(list_ranges4))
+    count_entries("pac", "ipv6 ranges", len(list_ranges6))
+    log(1, "PAC file: " + str(len(list_domains)) + " domains, " + str(len(list_ranges4)) + " IPv4 ranges, "
+        + str(len(list_ranges6)) + " IPv6 ranges")
+    return pac_template % {
+        "domains": len(list_domains),
+        "ranges4": len(list_ranges4),
+        "ranges6": len(list_ranges6),
+        "proxy": json.dumps(pac_proxy),
+        "table": ",\n".join(list_table),
+        "ip4_first": ",".join(["%d" % first for first, last in list_ranges4]),
+        "ip4_last": ",".join(["%d" % last for first, last in list_ranges4]),
+        "ip6_first": ",".join(['"%032x"' % first for first, last in list_ranges6]),
+        "ip6_last": ",".join(['"%032x"' % last for first, last in list_ranges6]),
+    }
+
+def write_pac(file_name, content):
+    # Write the PAC file only when its content changed, so that clients and web servers keep their cached copy
+    if os.path.isfile(file_name):
+        f = open(file_name, "r")
+        content_previous = f.read()
+        f.close()
+        if content_previous == content:
+            log(2, "PAC file " + file_name + " unchanged.")
+            return
+    write_file_atomic(file_name, content)
+    log(1, "PAC file " + file_name + " written.")
+
+def get_endpoint_set(instance, guid, ms_o365_version_latest):
+    # Endpoint set of the instance at its latest VERSION.  Taken from the stored state if that is current,
+    # patched with the "changes" method if possible, and downloaded in full otherwise.
+    # Returns the endpoint set and its VERSION, or None if the ENDPOINTS request failed.
+    state = load_state(instance)
+
+    if state is not None and force_o365_record_refresh == 0 and state["version"] == ms_o365_version_latest:
+        log(2, instance + ": Stored endpoint set is at the latest VERSION " + ms_o365_version_latest + ".")
+        return state["endpoints"], ms_o365_version_latest
+
+    # -----------------------------------------------------------------------
+    # Request O365 endpoint changes since the last applied VERSION, and patch the stored endpoint set
+    # -----------------------------------------------------------------------
+    if use_delta_sync and force_o365_record_refresh == 0 and state is not None:
+        request_string = uri_ms_o365_changes + instance + "/" + state["version"] + "?ClientRequestId=" + guid
+        with timed("fetch"):
+            status, list_changes = ms_web_service_get(url_ms_o365_endpoints, request_string, False, read_json_array)
+
+        if not status == 200:
+            log(1, instance + ": CHANGES request to MS web service failed. Falling back to full ENDPOINTS request.")
+        else:
+            list_change_versions = [str(change.get("version", "")) for change in list_changes]
+            # The changes must lead exactly to the latest VERSION, otherwise the stored set can not be trusted
+            if not list_changes \
+                or (ms_o365_version_latest != "" and max(list_change_versions) != ms_o365_version_latest):
+                log(1, instance + ": CHANGES since VERSION " + state["version"] + " do not match latest VERSION. Falling back to full ENDPOINTS request.")
+            else:
+                with timed("apply changes"):
+                    list_records = apply_endpoint_changes(state["endpoints"], list_changes)
+                if list_records is None:
+                    log(1, instance + ": CHANGES since VERSION " + state["version"] + " do not fit the stored endpoint set. Falling back to full ENDPOINTS request.")
+                else:
+                    log(1, instance + ": Applied " + str(len(list_changes)) + " CHANGES since VERSION " + state["version"] + " to the stored endpoint set.")
+                    return list_records, max(list_change_versions)
+
+    # -----------------------------------------------------------------------
+    # Request O365 endpoints list & put it in dictionary
+    # -----------------------------------------------------------------------
+    with timed("fetch"):
+        status, list_records = ms_web_service_get(url_ms_o365_endpoints, uri_ms_o365_endpoints + instance + "?ClientRequestId=" + guid,
+                                                  True, read_json_array)
+
+    if not status == 200:
+        log(1, instance + ": ENDPOINTS request to MS web service failed.")
+        return None
+    log(2, instance + ": ENDPOINTS request to MS web service was successful.")
+    return list_records, ms_o365_version_latest
+
+def output_file_name(file_name, suffix):
+    # "/var/tmp/o365/o365_urls.txt" -> "/var/tmp/o365/o365_urls_usgovdod.txt"
+    root, extension = os.path.splitext(file_name)
+    return root + suffix + extension
+
+def build_objects(label, suffix, list_records, ms_o365_version_latest, write_files=True):
+    # Generate the URL category entries and Data Group files for an endpoint set.
+    # suffix is appended to every object and file name ("" when all instances are merged).
+    # With write_files False the Data Group content is only returned, not written.
+    objects = {"label": label, "url_category": None, "url_category_entries": None, "dgs": [], "pac": None}
+
+    # One pass over the endpoint sets, for all objects
+    with timed("parse"):
+        endpoints = parse_endpoints(list_records)
+    dict_counts = endpoints["counts"]
+    log(1, "Number of ENDPOINTS to import (" + label + ") : URL:" + str(dict_counts["urls"]) + ", IPv4 host/net:" + str(dict_counts["ips4"])
+        + ", IPv6 host/net:" + str(dict_counts["ips6"]))
+
+    # -----------------------------------------------------------------------
+    # O365 endpoint URLs re-formatted to fit into custom URL category
+    # -----------------------------------------------------------------------
+    if use_url:
+        objects["url_category"] = o365_categories + suffix
+        objects["url_category_version"] = ms_o365_version_latest
+        with timed("url category build"):
+            objects["url_category_entries"] = build_url_category_entries(ms_o365_version_latest, endpoints["urls"])
+        count_entries(objects["url_category"], "input", dict_counts["urls"])
+        count_entries(objects["url_category"], "output", len(objects["url_category_entries"]))
+
+    # -----------------------------------------------------------------------
+    # O365 endpoints URL asterisk removal and re-format to fit into Data Group
+    # -----------------------------------------------------------------------
+    if use_url_dg:
+        with timed("url data group build"):
+            if dg_value_mode:
+                list_urls_dg = build_url_dg_values(endpoints["url_entries"], endpoints["details"])
+            else:
+                # URL sort, and drop entries covered by a shorter domain suffix
+                if url_dg_reduce:
+                    list_urls_dg = reduce_url_suffixes(endpoints["url_entries"])
+                else:
+                    list_urls_dg = sorted(endpoints["url_entries"])
+
+                # The iRule matches ".host" ends_with ".office.com" when static::o365_label_boundary is enabled.
+                # "office.com" and "*.office.com" both become ".office.com", which matches office.com and its subdomains.
+                if url_dg_label_boundary:
+                    list_urls_dg = list(sorted(set(["." + url.lstrip(".") for url in list_urls_dg])))
+        count_entries(urls_dg + suffix, "input", dict_counts["urls"])
+        count_entries(urls_dg + suffix, "unique", len(endpoints["url_entries"]))
+        count_entries(urls_dg + suffix, "output", len(list_urls_dg))
+
+        # Generate file for External Data Group
+        if dg_value_mode:
+            dg_content = "".join([str(url) + " := \"" + value + "\",\n" for url, value in list_urls_dg])
+        else:
+            dg_content = "".join([str(url) + " := 1,\n" for url in list_urls_dg])
+        objects["dgs"].append((urls_dg + suffix, "string", output_file_name(dg_file_name_urls, suffix), dg_content))
+
+    # -----------------------------------------------------------------------
+    # IPv4 and IPv6 addresses saved into text files separately
+    # -----------------------------------------------------------------------
+    for use_ip, family_name, key, dg_name, dg_file_name in ((use_ipv4, "IPv4", "ips4", ipv4_dg, dg_file_name_ip4),
+                                                            (use_ipv6, "IPv6", "ips6", ipv6_dg, dg_file_name_ip6)):
+        if not use_ip:
+            continue
+        set_networks = endpoints[key]
+        # Sort, or aggregate
+        with timed(family_name.lower() + " data group build"):
+            if dg_value_mode:
+                list_ips = build_ip_dg_values(set_networks, endpoints["details"], family_name)
+            elif ip_aggregate:
+                list_ips = aggregate_networks(set_networks, family_name)
+            else:
+                list_ips = sorted(set_networks)
+        count_entries(dg_name + suffix, "input", dict_counts[key])
+        count_entries(dg_name + suffix, "unique", len(set_networks))
+        count_entries(dg_name + suffix, "output", len(list_ips))
+
+        # Write IP list
+        if dg_value_mode:
+            dg_content = "".join(["network " + str(ip) + " := \"" + value + "\",\n" for ip, value in list_ips])
+        else:
+            dg_content = "".join(["network " + str(ip) + ",\n" for ip in list_ips])
+        objects["dgs"].append((dg_name + suffix, "ip", output_file_name(dg_file_name, suffix), dg_content))
+
+    # -----------------------------------------------------------------------
+    # PAC file from the same URLs and networks
+    # -----------------------------------------------------------------------
+    if use_pac:
+        with timed("pac build"):
+            objects["pac"] = (output_file_name(file_o365_pac, suffix), build_pac(endpoints))
+
+    if not write_files:
+        return objects
+
+    with timed("data group write"):
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            write_file_atomic(dg_file_name, dg_content)
+    if objects["pac"] is not None:
+        with timed("pac write"):
+            write_pac(*objects["pac"])
+
+    return objects
+
+def url_category_clause(action, url, match_type):
+    # One entry change of a "modify sys url-db url-category" command
+    if action == "delete":
+        return "urls delete { " + url_category_entry_name(url) + " }"
+    return "urls add { " + url_category_entry_name(url) + " { type " + match_type + " } }"
+
+def url_category_command(category_name, chunk):
+    return "modify sys url-db url-category " + category_name + " " + " ".join([url_category_clause(*change) for change in chunk])
+
+def url_category_chunks(list_changes):
+    # Split (action, url, match type) changes into chunks of at most url_category_chunk_entries entries
+    # and url_category_chunk_bytes bytes, each applied by one tmsh command
+    list_chunks = []
+    chunk = []
+    chunk_size = 0
+    for change in list_changes:
+        clause_size = len(url_category_clause(*change)) + 1
+        if chunk and (len(chunk) >= url_category_chunk_entries or chunk_size + clause_size > url_category_chunk_bytes):
+            list_chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(change)
+        chunk_size += clause_size
+    if chunk:
+        list_chunks.append(chunk)
+    return list_chunks
+
+def retry_url_category_chunks(list_failed):
+    # Retry failed URL category chunks, split in halves each round, until single entries are left.
+    # list_failed holds (category name, chunk).  Returns the chunks applied, and the entries rejected by tmsh.
+    list_applied = []
+    list_rejected = []
+    while list_failed:
+        batch_retry = TmshBatch()
+        dict_op_chunk = {}
+        for category_name, chunk in list_failed:
+            if len(chunk) == 1:
+                list_rejected.append((category_name, chunk[0]))
+                continue
+            for half in (chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]):
+                op = batch_retry.add(url_category_command(category_name, half), "url category " + category_name)
+                dict_op_chunk[op] = (category_name, half)
+        if not batch_retry.commands:
+            break
+        batch_retry.run()
+
+        list_failed = []
+        for op in sorted(dict_op_chunk):
+            category_name, chunk = dict_op_chunk[op]
+            if batch_retry.ok(op):
+                log(2, "URL category " + category_name + ": retried chunk of " + str(len(chunk)) + " entries applied.")
+                list_applied.append((category_name, chunk))
+            else:
+                log(2, "URL category " + category_name + ": retried chunk of " + str(len(chunk)) + " entries failed: " + batch_retry.output(op))
+                list_failed.append((category_name, chunk))
+
+    for category_name, (action, url, match_type) in list_rejected:
+        log(1, "URL category " + category_name + ": tmsh rejected " + action + " of entry " + url + ".  Skipping it.")
+    return list_applied, list_rejected
+
+def apply_objects(list_objects):
+    # Create or update the URL categories and Data Groups built by build_objects(), then save & sync.
+    # Returns the URL category entries in place afterwards (category name -> entries) for the next incremental update.
+    dict_url_category_state = {}
+    if force_o365_record_refresh == 0:
+        dict_url_category_state = load_url_category_state()
+
+    # -----------------------------------------------------------------------
+    # Check which BIG-IP objects already exist, all in one tmsh call
+    # -----------------------------------------------------------------------
+    batch_list = TmshBatch()
+    dict_op_list_category = {}
+    dict_op_list_dg = {}
+    for objects in list_objects:
+        if objects["url_category"] is not None:
+            dict_op_list_category[objects["url_category"]] = batch_list.add("list sys url-db url-category " + objects["url_category"])
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            dict_op_list_dg[dg_name] = (batch_list.add("list sys file data-group " + dg_name + "_object"),
+                                        batch_list.add("list ltm data-group external " + dg_name))
+    with timed("list objects"):
+        batch_list.run()
+
+    # Changes, save & config-sync are collected here and run in one tmsh call at the end
+    batch_apply = TmshBatch()
+
+    # Objects whose content did not change since the last successful import are left alone
+    dict_fingerprints = load_fingerprints()
+    dict_op_fingerprint = {}
+    list_category_fingerprints = []
+
+    # URL category name -> entries before the changes, create/replace operations, chunk operations, fingerprint
+    dict_category_updates = {}
+
+    for objects in list_objects:
+        # -----------------------------------------------------------------------
+        # O365 endpoint URLs re-formatted to fit into custom URL category
+        # -----------------------------------------------------------------------
+        if objects["url_category"] is not None:
+            category_name = objects["url_category"]
+            dict_url_category = objects["url_category_entries"]
+            version_entry = "https://" + objects["url_category_version"] + "/"
+            list_op_category = []
+
+            # Entries applied by the previous run, if they are known
+            dict_url_category_previous = dict_url_category_state.get(category_name)
+
+            key_category, fingerprint_category = url_category_fingerprint(objects)
+
+            if "was not found" in batch_list.output(dict_op_list_category[category_name]):
+                list_op_category.append(batch_apply.add("create sys url-db url-category " + category_name + " display-name " + category_name, "url category " + category_name))
+                log(2, "O365 custom URL category not found. Creating new O365 custom category: " + category_name)
+                dict_url_category_previous = None
+
+            if dict_url_category_previous is not None and dict_fingerprints.get(key_category) == fingerprint_category:
+                log(1, "O365 custom URL category content is unchanged. Skipping update: " + category_name)
+                dict_url_category_state[category_name] = dict_url_category_previous
+            else:
+                if dict_url_category_previous is None:
+                    # Clean out existing URL category - add the latest version as first entry
+                    list_op_category.append(batch_apply.add("modify sys url-db url-category " + category_name + " urls replace-all-with { " + version_entry + " { type exact-match } }", "url category " + category_name))
+                    log(2, "O365 custom URL category entries replaced with VERSION entry: " + category_name)
+                    dict_url_category_previous = {version_entry: "exact-match"}
+                else:
+                    log(2, "O365 custom URL category exists. Updating changed entries only: " + category_name)
+
+                # Remove entries that are gone or changed their match type, then add new entries
+                list_changes = []
+                for url in sorted(dict_url_category_previous):
+                    if dict_url_category.get(url) != dict_url_category_previous[url]:
+                        log(2, "Deleting entry: " + url)
+                        list_changes.append(("delete", url, dict_url_category_previous[url]))
+                for url in sorted(dict_url_category):
+                    if dict_url_category_previous.get(url) != dict_url_category[url]:
+                        log(2, "Creating " + dict_url_category[url] + " entry for: " + url)
+                        list_changes.append(("add", url, dict_url_category[url]))
+
+                # Import the URL entries in chunks of bounded size, each one tmsh command
+                dict_op_chunk = {}
+                list_chunks = url_category_chunks(list_changes)
+                for chunk in list_chunks:
+                    dict_op_chunk[batch_apply.add(url_category_command(category_name, chunk), "url category " + category_name)] = chunk
+                if list_chunks:
+                    log(1, "O365 custom URL category " + category_name + ": " + str(len(list_changes)) + " entry changes in " + str(len(list_chunks)) + " chunks.")
+                else:
+                    log(1, "O365 custom URL category is already up to date: " + category_name)
+
+                dict_category_updates[category_name] = {"previous": dict_url_category_previous,
+                                                        "ops": list_op_category,
+                                                        "chunks": dict_op_chunk,
+                                                        "applied": [],
+                                                        "entries": dict_url_category,
+                                                        "fingerprint": (key_category, fingerprint_category)}
+
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            op_list_file, op_list_dg = dict_op_list_dg[dg_name]
+
+            #-----------------------------------------------------------------------
+            # Data Group File update
+            #-----------------------------------------------------------------------
+            # The object appears in WebUI: System › File Management : Data Group File List >> xxx_object
+            # Name of the Data Group is given in urls_dg, ipv4_dg, ipv6_dg
+            # Name of the Data Group File is the Data Group name + "_object"
+
+            # Create or update Data Group File from text file (given for variables "dg_file_name_*")
+            key_dg = "data-group " + dg_name + "_object"
+            fingerprint_dg = content_fingerprint(dg_content)
+            if "was not found" in batch_list.output(op_list_file):
+                op = batch_apply.add("create sys file data-group " + dg_name + "_object type " + dg_type + " source-path file:" + dg_file_name, "import " + dg_name)
+                dict_op_fingerprint[op] = (key_dg, fingerprint_dg)
+                log(2, "Data Group File " + dg_name + "_object was not found.  Creating from " + dg_file_name + ".")
+            elif force_o365_record_refresh == 0 and dict_fingerprints.get(key_dg) == fingerprint_dg:
+                log(1, "Data Group File " + dg_name + "_object content is unchanged.  Skipping import from " + dg_file_name + ".")
+            else:
+                op = batch_apply.add("modify sys file data-group " + dg_name + "_object source-path file:" + dg_file_name, "import " + dg_name)
+                dict_op_fingerprint[op] = (key_dg, fingerprint_dg)
+                log(2, "Data Group File " + dg_name + "_object was found.  Updating from " + dg_file_name + ".")
+
+            #-----------------------------------------------------------------------
+            # Make sure Data Group exists that corresponds to File update
+            #-----------------------------------------------------------------------
+            # The object appears in WebUI: Local Traffic >> iRules : Data Group List >> (External File) xxx
+            # The object needs to exist, but does not have to be explicitly updated by this script
+
+            if "was not found" in batch_list.output(op_list_dg):
+                batch_apply.add("create ltm data-group external " + dg_name + " external-file-name " + dg_name + "_object", "import " + dg_name)
+                log(2, "Data Group " + dg_name + " was not found.  Creating it from " + dg_name + "_object")
+
+    if not batch_apply.commands:
+        log(1, "No BIG-IP object changed.  Skipping configuration save and Config-Sync.")
+        return dict_url_category_state
 
+    #-----------------------------------------------------------------------
+    # Save config
+    #-----------------------------------------------------------------------
+    log(1, "Saving BIG-IP Configuration.")
+    op_save = batch_apply.add("save sys config", "save")
+
+
+    #-----------------------------------------------------------------------
+    # Initiate Config Sync: Device to Group
+    #-----------------------------------------------------------------------
+    if ha_config == 1:
+        log(1, "Initiating Config-Sync.")
+        op_sync = batch_apply.add("run cm config-sync to-group " + device_group_name, "sync")
+
+    #-----------------------------------------------------------------------
+    # Run all changes, then check the results of each command
+    #-----------------------------------------------------------------------
+    batch_apply.run()
+    saved = batch_apply.ok(op_save)
+
+    # Chunk results.  Failed chunks are retried on their own, so that one bad URL does not hold back the others.
+    list_failed_chunks = []
+    for category_name in sorted(dict_category_updates):
+        category_update = dict_category_updates[category_name]
+        for op in category_update["ops"]:
+            if batch_apply.output(op):
+                log(2, "URL DB update result: " + batch_apply.output(op))
+        list_op_chunks = sorted(category_update["chunks"])
+        for number, op in enumerate(list_op_chunks):
+            chunk = category_update["chunks"][op]
+            if batch_apply.ok(op):
+                log(2, "URL category " + category_name + ": chunk " + str(number + 1) + " of " + str(len(list_op_chunks)) + " (" + str(len(chunk)) + " entries) applied.")
+                category_update["applied"].append(chunk)
+            else:
+                log(1, "URL category " + category_name + ": chunk " + str(number + 1) + " of " + str(len(list_op_chunks)) + " (" + str(len(chunk)) + " entries) failed: " + batch_apply.output(op))
+                list_failed_chunks.append((category_name, chunk))
+
+    if list_failed_chunks:
+        list_applied, list_rejected = retry_url_category_chunks(list_failed_chunks)
+        for category_name, chunk in list_applied:
+            dict_category_updates[category_name]["applied"].append(chunk)
+        # Entries tmsh keeps rejecting are skipped, and do not fail the run.  They are tried again by the next update.
+        run_metrics["tmsh_rejected"] += len(list_rejected)
+
+        # Save (and sync) again to include what the retries applied
+        if list_applied:
+            batch_save = TmshBatch()
+            op_save_retry = batch_save.add("save sys config", "save")
+            if ha_config == 1:
+                batch_save.add("run cm config-sync to-group " + device_group_name, "sync")
+            batch_save.run()
+            saved = batch_save.ok(op_save_retry)
+            for op in range(len(batch_save.commands)):
+                if batch_save.output(op):
+                    log(2, batch_save.output(op))
+
+    # Entries now in place.  Without a known starting point, force a full rebuild of the URL category next time.
+    for category_name in dict_category_updates:
+        category_update = dict_category_updates[category_name]
+        key_category, fingerprint_category = category_update["fingerprint"]
+        if not all([batch_apply.ok(op) for op in category_update["ops"]]):
+            dict_url_category_state.pop(category_name, None)
+            dict_fingerprints.pop(key_category, None)
+            continue
+        dict_url_category_applied = dict(category_update["previous"])
+        for chunk in category_update["applied"]:
+            for action, url, match_type in chunk:
+                if action == "delete" and dict_url_category_applied.get(url) == match_type:
+                    del dict_url_category_applied[url]
+        for chunk in category_update["applied"]:
+            for action, url, match_type in chunk:
+                if action == "add":
+                    dict_url_category_applied[url] = match_type
+        dict_url_category_state[category_name] = dict_url_category_applied
+        if dict_url_category_applied == category_update["entries"]:
+            list_category_fingerprints.append((key_category, fingerprint_category))
+        else:
+            dict_fingerprints.pop(key_category, None)
+
+    list_op_chunks = []
+    for category_name in dict_category_updates:
+        list_op_chunks.extend(dict_category_updates[category_name]["chunks"].keys())
+    for op in range(len(batch_apply.commands)):
+        if not batch_apply.ok(op) and op not in list_op_chunks:
+            log(1, "tmsh command failed: " + batch_apply.commands[op] + " : " + batch_apply.output(op))
+            run_metrics["tmsh_failed"] += 1
+
+    if batch_apply.output(op_save):
+        log(2, batch_apply.output(op_save))
+    if ha_config == 1 and batch_apply.output(op_sync):
+        log(2, batch_apply.output(op_sync))
+
+    # Remember the content of successfully imported objects.  Without a saved config, import all again next time.
+    if saved:
+        for op in dict_op_fingerprint:
+            key, fingerprint = dict_op_fingerprint[op]
+            if batch_apply.ok(op):
+                dict_fingerprints[key] = fingerprint
+            else:
+                dict_fingerprints.pop(key, None)
+        for key, fingerprint in list_category_fingerprints:
+            dict_fingerprints[key] = fingerprint
+    else:
+        dict_fingerprints = {}
+    save_fingerprints(dict_fingerprints)
+
+    return dict_url_category_state
+
+#-----------------------------------------------------------------------
+# Snapshots
+#-----------------------------------------------------------------------
+# Each snapshot is a JSON manifest in directory_o365_snapshots.  The endpoint sets and object contents it refers
+# to are stored gzip compressed under their SHA-256 in the "objects" subdirectory, so that content shared by
+# several snapshots is stored once.
+
+def snapshot_blob_write(content):
+    # Store content under its hash, if it is not stored yet.  Returns the hash.
+    if isinstance(content, unicode):
+        content = content.encode("utf-8")
+    digest = hashlib.sha256(content).hexdigest()
+    file_blob = os.path.join(directory_o365_snapshots, "objects", digest + ".gz")
+    if not os.path.isfile(file_blob):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        write_file_atomic(file_blob, compressor.compress(content) + compressor.flush())
+    return digest
+
+def snapshot_blob_read(digest):
+    f = open(os.path.join(directory_o365_snapshots, "objects", digest + ".gz"), "r")
+    content = zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+    f.close()
+    if hashlib.sha256(content).hexdigest() != digest:
+        raise ValueError("Snapshot object " + digest + " is corrupt")
+    return content
+
+def snapshot_save(manifest):
+    write_file_atomic(os.path.join(directory_o365_snapshots, manifest["id"] + ".json"), json.dumps(manifest, sort_keys=True, indent=1))
+
+def snapshot_list():
+    # Manifests of all snapshots, oldest first
+    if not os.path.isdir(directory_o365_snapshots):
+        return []
+    list_manifests = []
+    for file_name in os.listdir(directory_o365_snapshots):
+        if file_name.endswith(".json"):
+            try:
+                f = open(os.path.join(directory_o365_snapshots, file_name), "r")
+                list_manifests.append(json.load(f))
+                f.close()
+            except ValueError:
+                log(1, "Snapshot " + file_name + " is not readable.  Ignored.")
+    return sorted(list_manifests, key=lambda manifest: (manifest["created"], manifest["id"]))
+
+def snapshot_load(snapshot_id):
+    # Manifest of the snapshot with this id, or id prefix
+    list_matches = [manifest for manifest in snapshot_list() if manifest["id"].startswith(snapshot_id)]
+    if len(list_matches) != 1:
+        raise ValueError("Snapshot " + snapshot_id + (" not found" if not list_matches else " is ambiguous"))
+    return list_matches[0]
+
+def snapshot_create(list_objects, dict_endpoint_sets):
+    # Store the endpoint sets and the objects built from them.  Returns the snapshot id.
+    if not os.path.isdir(os.path.join(directory_o365_snapshots, "objects")):
+        os.makedirs(os.path.join(directory_o365_snapshots, "objects"))
+    manifest = {"created": time.time(), "result": "built", "versions": {}, "endpoints": {}, "objects": []}
+    for instance in sorted(dict_endpoint_sets):
+        list_records, version = dict_endpoint_sets[instance]
+        manifest["versions"][instance] = version
+        manifest["endpoints"][instance] = snapshot_blob_write(json.dumps(list_records, sort_keys=True))
+    for objects in list_objects:
+        snapshot_objects = {"label": objects["label"],
+                            "url_category": objects["url_category"],
+                            "url_category_version": objects.get("url_category_version"),
+                            "url_category_entries": None,
+                            "url_category_count": 0,
+                            "dgs": []}
+        if objects["url_category_entries"] is not None:
+            snapshot_objects["url_category_entries"] = snapshot_blob_write(json.dumps(objects["url_category_entries"], sort_keys=True))
+            snapshot_objects["url_category_count"] = len(objects["url_category_entries"])
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            snapshot_objects["dgs"].append({"name": dg_name, "type": dg_type, "file": dg_file_name,
+                                            "content": snapshot_blob_write(dg_content), "entries": dg_content.count("\n")})
+        manifest["objects"].append(snapshot_objects)
+    manifest["id"] = time.strftime("%Y%m%d-%H%M%S", time.localtime(manifest["created"])) + "-" \
+        + content_fingerprint(json.dumps([manifest["endpoints"], manifest["objects"]], sort_keys=True))[:8]
+    snapshot_save(manifest)
+    snapshot_prune()
+    log(1, "Snapshot " + manifest["id"] + " saved in " + directory_o365_snapshots + ".")
+    return manifest["id"]
+
+def snapshot_mark(snapshot_id, result):
+    manifest = snapshot_load(snapshot_id)
+    manifest["result"] = result
+    snapshot_save(manifest)
+
+def snapshot_prune():
+    # Keep the last snapshot_keep snapshots, and the objects they refer to
+    list_manifests = snapshot_list()
+    for manifest in list_manifests[:max(0, len(list_manifests) - snapshot_keep)]:
+        os.remove(os.path.join(directory_o365_snapshots, manifest["id"] + ".json"))
+        log(2, "Snapshot " + manifest["id"] + " removed.")
+    set_digests = set()
+    for manifest in list_manifests[max(0, len(list_manifests) - snapshot_keep):]:
+        set_digests.update(manifest["endpoints"].values())
+        for snapshot_objects in manifest["objects"]:
+            set_digests.add(snapshot_objects["url_category_entries"])
+            set_digests.update([dg["content"] for dg in snapshot_objects["dgs"]])
+    directory_objects = os.path.join(directory_o365_snapshots, "objects")
+    for file_name in os.listdir(directory_objects):
+        if file_name.endswith(".gz") and file_name[:-len(".gz")] not in set_digests:
+            os.remove(os.path.join(directory_objects, file_name))
+
+def snapshot_restore(manifest):
+    # The objects (as build_objects() returns them) and the endpoint sets of a snapshot
+    list_objects = []
+    for snapshot_objects in manifest["objects"]:
+        objects = {"label": snapshot_objects["label"],
+                   "url_category": snapshot_objects["url_category"],
+                   "url_category_entries": None,
+                   "dgs": []}
+        if snapshot_objects["url_category_entries"] is not None:
+            dict_entries = json.loads(snapshot_blob_read(snapshot_objects["url_category_entries"]))
+            objects["url_category_entries"] = dict([(str(url), str(dict_entries[url])) for url in dict_entries])
+            objects["url_category_version"] = str(snapshot_objects["url_category_version"])
+        for dg in snapshot_objects["dgs"]:
+            objects["dgs"].append((str(dg["name"]), str(dg["type"]), str(dg["file"]), snapshot_blob_read(dg["content"])))
+        list_objects.append(objects)
+    dict_endpoint_sets = {}
+    for instance in manifest["endpoints"]:
+        dict_endpoint_sets[str(instance)] = (json.loads(snapshot_blob_read(manifest["endpoints"][instance])), str(manifest["versions"][instance]))
+    return list_objects, dict_endpoint_sets
+
+def list_snapshots():
+    for manifest in snapshot_list():
+        list_counts = []
+        for snapshot_objects in manifest["objects"]:
+            if snapshot_objects["url_category"] is not None:
+                list_counts.append(snapshot_objects["url_category"] + " " + str(snapshot_objects["url_category_count"]))
+            list_counts.extend([dg["name"] + " " + str(dg["entries"]) for dg in snapshot_objects["dgs"]])
+        sys.stdout.write(manifest["id"] + "  " + "{0:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.fromtimestamp(manifest["created"]))
+                         + "  " + manifest["result"].ljust(7) + "  "
+                         + ", ".join([instance + " " + manifest["versions"][instance] for instance in sorted(manifest["versions"])])
+                         + "  (" + ", ".join(list_counts) + ")\n")
+
+def diff_snapshots(snapshot_id_a, snapshot_id_b):
+    # Changes from snapshot a to snapshot b: VERSIONs, endpoint sets, and the entries of each object
+    manifest_a = snapshot_load(snapshot_id_a)
+    manifest_b = snapshot_load(snapshot_id_b)
+    write = sys.stdout.write
+    write("Snapshot " + manifest_a["id"] + " -> " + manifest_b["id"] + "\n")
+    for instance in sorted(set(manifest_a["versions"]) | set(manifest_b["versions"])):
+        write(instance + ": VERSION " + manifest_a["versions"].get(instance, "-") + " -> " + manifest_b["versions"].get(instance, "-") + "\n")
+        if manifest_a["endpoints"].get(instance) == manifest_b["endpoints"].get(instance):
+            continue
+        dict_sets = []
+        for manifest in (manifest_a, manifest_b):
+            list_records = []
+            if manifest["endpoints"].has_key(instance):
+                list_records = json.loads(snapshot_blob_read(manifest["endpoints"][instance]))
+            dict_sets.append(dict([(record["id"], record) for record in list_records]))
+        dict_records_a, dict_records_b = dict_sets
+        list_added = sorted(set(dict_records_b) - set(dict_records_a))
+        list_removed = sorted(set(dict_records_a) - set(dict_records_b))
+        list_changed = sorted([id for id in set(dict_records_a) & set(dict_records_b) if dict_records_a[id] != dict_records_b[id]])
+        write("  Endpoint sets added: " + (", ".join([str(id) for id in list_added]) or "none") + "\n")
+        write("  Endpoint sets removed: " + (", ".join([str(id) for id in list_removed]) or "none") + "\n")
+        write("  Endpoint sets changed: " + (", ".join([str(id) for id in list_changed]) or "none") + "\n")
+
+    # Entries of each object, by object name
+    dict_entries = [{}, {}]
+    for index, manifest in enumerate((manifest_a, manifest_b)):
+        for snapshot_objects in manifest["objects"]:
+            if snapshot_objects["url_category_entries"] is not None:
+                dict_url_category = json.loads(snapshot_blob_read(snapshot_objects["url_category_entries"]))
+                dict_entries[index][snapshot_objects["url_category"]] = set([url + " " + dict_url_category[url] for url in dict_url_category
+                                                                             if url != "https://" + snapshot_objects["url_category_version"] + "/"])
+            for dg in snapshot_objects["dgs"]:
+                dict_entries[index][dg["name"]] = set([line.strip().rstrip(",") for line in snapshot_blob_read(dg["content"]).splitlines() if line.strip()])
+    for name in sorted(set(dict_entries[0]) | set(dict_entries[1])):
+        set_a = dict_entries[0].get(name, set())
+        set_b = dict_entries[1].get(name, set())
+        write(name + ": " + str(len(set_a)) + " -> " + str(len(set_b)) + " entries\n")
+        for entry in sorted(set_a - set_b):
+            write("  - " + entry + "\n")
+        for entry in sorted(set_b - set_a):
+            write("  + " + entry + "\n")
+
+def read_pin():
+    # Snapshot pinned by --rollback, or None
+    if not os.path.isfile(file_o365_pin):
+        return None
+    f = open(file_o365_pin, "r")
+    pin = json.load(f)
+    f.close()
+    return pin
+
+def rollback(snapshot_id):
+    # Re-apply the objects of a snapshot, without the MS web service.  Further updates are skipped until --unpin.
+    manifest = snapshot_load(snapshot_id)
+    if not is_active():
+        return "standby"
+    log(1, "Rolling back to snapshot " + manifest["id"] + ": " + ", ".join([instance + " " + manifest["versions"][instance] for instance in sorted(manifest["versions"])]) + ".")
+    list_objects, dict_endpoint_sets = snapshot_restore(manifest)
+    for objects in list_objects:
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            write_file_atomic(dg_file_name, dg_content)
+
+    dict_url_category_state = apply_objects(list_objects)
+    with timed("save state"):
+        save_url_category_state(dict_url_category_state)
+    if run_metrics["tmsh_failed"]:
+        log(1, "Rollback to snapshot " + manifest["id"] + " failed.")
+        return "failed"
+
+    for instance in sorted(dict_endpoint_sets):
+        list_records, ms_o365_version = dict_endpoint_sets[instance]
+        if re.match('[0-9]{10}$', ms_o365_version):
+            save_state(instance, ms_o365_version, list_records)
+            write_version(instance, ms_o365_version)
+    write_file_atomic(file_o365_pin, json.dumps({"snapshot": manifest["id"], "versions": manifest["versions"], "pinned": time.time()}))
+    log(1, "Rolled back to snapshot " + manifest["id"] + ".  Updates are skipped until --unpin.")
+    return "updated"
+
+def unpin():
+    if os.path.isfile(file_o365_pin):
+        os.remove(file_o365_pin)
+        log(1, "Snapshot unpinned.  The next run updates to the latest VERSION.")
+    close_log()
+
+def is_active():
     # -----------------------------------------------------------------------
     # Check if this BIG-IP is ACTIVE for the traffic group (= traffic_group_name)
     # -----------------------------------------------------------------------
-    result = commands.getoutput("tmsh show /cm failover-status field-fmt")
+    with timed("failover check"):
+        status, result = tmsh_exec("show /cm failover-status field-fmt")
 
     if ("status ACTIVE" in result)\
         or (ha_config == 0):
-        failover_state = "active"       # For future use
         log(1, "This BIG-IP is ACTIVE. Initiating O365 update.")
+        return True
     else:
-        failover_state = "non-active"   # For future use
         log(1, "This BIG-IP is STANDBY. Aborting O365 update.")
-        sys.exit(0)
-
+        return False
 
+def get_guid():
     # -----------------------------------------------------------------------
     # GUID management
     # -----------------------------------------------------------------------
@@ -161,314 +2195,277 @@ def main():
         f.flush()
         f.close()
         log(1, "Generated a new GUID, and saved it to " + file_name_guid + ".")
+    return guid
 
-
-    # -----------------------------------------------------------------------
-    # O365 endpoints list version check
-    # -----------------------------------------------------------------------
-    # Read version of previously received record
-    if os.path.isfile(file_ms_o365_version):
-        f = open(file_ms_o365_version, "r")
-        f_content = f.readline()
-        f.close()
-        # Check if the VERSION record format is valid
-        if re.match('[0-9]{10}', f_content):
-            ms_o365_version_previous = f_content
-            log(2, "Valid previous VERSION found in " + file_ms_o365_version + ".")
-        else:
-            ms_o365_version_previous = "1970010200"
-            f = open(file_ms_o365_version, "w")
-            f.write(ms_o365_version_previous)
-            f.flush()
-            f.close()
-            log(1, "Valid previous VERSION was not found.  Wrote dummy value in " + file_ms_o365_version + ".")
-    else:
-        ms_o365_version_previous = "1970010200"
-        f = open(file_ms_o365_version, "w")
-        f.write(ms_o365_version_previous)
-        f.flush()
-        f.close()
-        log(1, "Valid previous VERSION was not found.  Wrote dummy value in " + file_ms_o365_version + ".")
-
-
+def request_versions(guid):
     # -----------------------------------------------------------------------
     # O365 endpoints list VERSION check
     # -----------------------------------------------------------------------
-    request_string = uri_ms_o365_version + guid
-    conn = httplib.HTTPSConnection(url_ms_o365_version)
-    conn.request('GET', request_string)
-    res = conn.getresponse()
+    # One VERSION request returns the latest VERSION of every instance.
+    # Returns instance -> latest VERSION, or None if the request failed.
+    with timed("version check"):
+        status, body = ms_web_service_get(url_ms_o365_version, uri_ms_o365_version + guid)
 
-    if not res.status == 200:
-        # MS O365 version request failed
-        log(1, "VERSION request to MS web service failed.  Assuming VERSIONs did not match, and proceed.")
-        dict_o365_version = {}
-    else:
-        # MS O365 version request succeeded
-        log(2, "VERSION request to MS web service was successful.")
-        dict_o365_version = json.loads(res.read())
+    if not status == 200:
+        return None
+
+    # MS O365 version request succeeded
+    log(2, "VERSION request to MS web service was successful.")
+    dict_o365_version = json.loads(body)
 
-    ms_o365_version_latest = ""
+    dict_version_latest = {}
     for record in dict_o365_version:
         if record.has_key('instance'):
-            if record["instance"] == "Worldwide" and record.has_key("latest"):
+            if record["instance"] in ms_o365_instances and record.has_key("latest"):
                 latest = record["latest"]
                 if re.match('[0-9]{10}', latest):
-                    ms_o365_version_latest = latest
-                    f = open(file_ms_o365_version, "w")
-                    f.write(ms_o365_version_latest)
-                    f.flush()
-                    f.close()
-
-    log(2, "Previous VERSION is " + ms_o365_version_previous)
-    log(2, "Latest VERSION is " + ms_o365_version_latest)
-
-    if ms_o365_version_latest == ms_o365_version_previous and force_o365_record_refresh == 0:
-        log(1, "You already have the latest MS O365 URL/IP Address list: " + ms_o365_version_latest + ". Aborting operation.")
-        sys.exit(0)
+                    dict_version_latest[str(record["instance"])] = str(latest)
+    return dict_version_latest
 
+def build_all_objects(guid, dict_version_latest, list_instances_changed):
+    # Download the endpoint sets and build the objects for the changed instances.
+    # Returns the objects and instance -> (endpoint set, VERSION), or None if an endpoint set could not be downloaded.
 
     # -----------------------------------------------------------------------
-    # Request O365 endpoints list & put it in dictionary
+    # Request the endpoint sets of all instances concurrently
     # -----------------------------------------------------------------------
-    request_string = uri_ms_o365_endpoints + guid
-    conn = httplib.HTTPSConnection(url_ms_o365_endpoints)
-    conn.request('GET', request_string)
-    res = conn.getresponse()
-
-    if not res.status == 200:
-        log(1, "ENDPOINTS request to MS web service failed. Aborting operation.")
-        sys.exit(0)
+    # Instances merged into one set of objects, or one set of objects per changed instance
+    if ms_o365_instance_output == 1:
+        list_groups = [("_" + instance.lower(), [instance]) for instance in list_instances_changed]
     else:
-        log(2, "ENDPOINTS request to MS web service was successful.")
-        dict_o365_all = json.loads(res.read())
-
-    # Process for each record(id) of the endpoint JSON data
-    for dict_o365_record in dict_o365_all:
-        service_area = str(dict_o365_record['serviceArea'])
-        id = str(dict_o365_record['id'])
-
-        if (care_common and service_area == "Common") \
-            or (care_exchange and service_area == "Exchange") \
-            or (care_sharepoint and service_area == "SharePoint") \
-            or (care_skype and service_area == "Skype") \
-            or (care_yammer and service_area == "Yammer"):
-
-            if use_url or use_url_dg:
-                # Append "urls" if existent in each record
-                if dict_o365_record.has_key('urls'):
-                    list_urls = list(dict_o365_record['urls'])
-                    for url in list_urls:
-                        list_urls_to_bypass.append(url)
-
-                # Append "allowUrls" if existent in each record
-                if dict_o365_record.has_key('allowUrls'):
-                    list_allow_urls = list(dict_o365_record['allowUrls'])
-                    for url in list_allow_urls:
-                        list_urls_to_bypass.append(url)
-
-                # Append "defaultUrls" if existent in each record
-                if dict_o365_record.has_key('defaultUrls'):
-                    list_default_urls = dict_o365_record['defaultUrls']
-                    for url in list_default_urls:
-                        list_urls_to_bypass.append(url)
-
-            if use_ipv4 or use_ipv6:
-                # Append "ips" if existent in each record
-                if dict_o365_record.has_key('ips'):
-                    list_ips = list(dict_o365_record['ips'])
-                    for ip in list_ips:
-                        if re.match('^.+:', ip):
-                            list_ips6_to_pbr.append(ip)
-                        else:
-                            list_ips4_to_pbr.append(ip)
-
-    num_list_urls_to_bypass = len(list_urls_to_bypass)
-    num_list_ips4_to_pbr = len(list_ips4_to_pbr)
-    num_list_ips6_to_pbr = len(list_ips6_to_pbr)
-    log(1, "Number of ENDPOINTS to import : URL:" + str(num_list_urls_to_bypass) + ", IPv4 host/net:" + str(num_list_ips4_to_pbr) + ", IPv6 host/net:" + str(num_list_ips6_to_pbr))
+        list_groups = [("", list(ms_o365_instances))]
 
+    list_instances_needed = []
+    for suffix, list_group_instances in list_groups:
+        for instance in list_group_instances:
+            if instance not in list_instances_needed:
+                list_instances_needed.append(instance)
 
-    # -----------------------------------------------------------------------
-    # O365 endpoint URLs re-formatted to fit into custom URL category
-    # -----------------------------------------------------------------------
-    if use_url:
-        # Initialize the url string
-        str_urls_to_bypass = ""
-
-        # Create new or clean out existing URL category - add the latest version as first entry
-        result = commands.getoutput("tmsh list sys url-db url-category " + o365_categories)
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /sys url-db url-category " + o365_categories + " display-name " + o365_categories)
-            result3 = commands.getoutput("tmsh modify /sys url-db url-category " + o365_categories + " urls replace-all-with { https://" + ms_o365_version_latest + " { type exact-match } }")
-            log(2, "O365 custom URL category not found. Created new O365 custom category: " + o365_categories)
-        else:
-            result2 = commands.getoutput("tmsh modify /sys url-db url-category " + o365_categories + " urls replace-all-with { https://" + ms_o365_version_latest + "/ { type exact-match } }")
-            log(2, "O365 custom URL caegory exists. Clearing entries for new data: " + o365_categories) 
-    
-        # Remove duplicate URLs in the list
-        urls_undup = list(set(list_urls_to_bypass))
-    
-        # Loop through URLs and insert into URL category    
-        for url in urls_undup:
-            # Force URL to lower case
-            url = url.lower()
-
-            # If URL starts with an asterisk, set as a glob-match URL, otherwise exact-match. Send to a string.
-            if "*" in url:
-                log(2, "Creating glob-match entries for: " + url)
-                # Escaping any asterisk characters
-                url_processed = re.sub('\*', '\\\\\*', url)
-                # Both HTTPS and HTTP category lookups use "https://", with the subtle difference that the HTTP URLs match an entry with no trailing forward slash"
-                str_urls_to_bypass = str_urls_to_bypass + " urls add { \"https://" + url_processed + "/\" { type glob-match } } urls add { \"https://" + url_processed + "\" { type glob-match } }"
-            else:
-                log(2, "Creating exact-match entries for: " + url)
-                # Both HTTPS and HTTP category lookups use "https://", with the subtle difference that the HTTP URLs match an entry with no trailing forward slash"
-                str_urls_to_bypass = str_urls_to_bypass + " urls add { https://" + url + "/ { type exact-match } } urls add { https://" + url + " { type exact-match } }"
+    list_endpoint_sets = run_concurrently(lambda instance: get_endpoint_set(instance, guid, dict_version_latest.get(instance, "")),
+                                          list_instances_needed, ms_o365_max_workers)
+    dict_endpoint_sets = {}
+    for instance, endpoint_set in zip(list_instances_needed, list_endpoint_sets):
+        if endpoint_set is None:
+            log(1, "ENDPOINTS request to MS web service failed for " + instance + ". Aborting operation.")
+            return None
+        dict_endpoint_sets[instance] = endpoint_set
 
-        # Import the URL entries
-        result = commands.getoutput("tmsh modify /sys url-db url-category " + o365_categories + str_urls_to_bypass)
-        log(2, "URL DB update result: " + result)
 
     # -----------------------------------------------------------------------
-    # O365 endpoints URL asterisk removal and re-format to fit into Data Group
+    # Build the URL categories & Data Groups
     # -----------------------------------------------------------------------
-    if use_url_dg:
-        # Process asterisk nicely.  Force lower case letter.
-        for url in list_urls_to_bypass:
-            url_processed = re.sub('^.*[*][^.]*', '', url).lower()
-            list_urls_to_bypass_fin.append(url_processed)
-
-        # URL sort & dedupe. Generate file for External Data Group
-        fout = open(dg_file_name_urls, 'w')
-        for url in (list(sorted(set(list_urls_to_bypass_fin)))):
-            fout.write(str(url) + " := 1,\n")
-        fout.flush()
-        fout.close()
-
-        #-----------------------------------------------------------------------
-        # Data Group File update
-        #-----------------------------------------------------------------------
-        # The object appears in WebUI: System › File Management : Data Group File List >> xxx_object
-        # Name of the Data Group is given in urls_dg
-        # Name of the Data Group File is urls_dg + "_object"
-
-        result = commands.getoutput("tmsh list sys file data-group " + urls_dg + "_object")
-        # Create or update Data Group File from text file (given for variable "dg_file_name_urls")
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /sys file data-group " + urls_dg + "_object type string source-path file:" + dg_file_name_urls)
-            log(2, "Data Group File " + urls_dg + "_object was not found.  Created from " + dg_file_name_urls + ".")
-        else:
-            result2 = commands.getoutput("tmsh modify /sys file data-group " + urls_dg + "_object source-path file:" + dg_file_name_urls)
-            log(2, "Data Group File " + urls_dg + "_object was found.  Updated from " + dg_file_name_urls + ".")
+    list_objects = []
+    for suffix, list_group_instances in list_groups:
+        list_records = []
+        list_versions = []
+        for instance in list_group_instances:
+            list_records.extend(dict_endpoint_sets[instance][0])
+            list_versions.append(dict_endpoint_sets[instance][1])
+        list_objects.append(build_objects(", ".join(list_group_instances), suffix, list_records, max(list_versions)))
+    return list_objects, dict_endpoint_sets
+
+def update(guid, dict_version_latest, list_instances_changed):
+    # Download, build and apply the objects for the changed instances.
+    # Returns False if an endpoint set could not be downloaded, or a tmsh command failed.
+    result = build_all_objects(guid, dict_version_latest, list_instances_changed)
+    if result is None:
+        return False
+    list_objects, dict_endpoint_sets = result
+
+    snapshot_id = None
+    if snapshot_keep > 0:
+        with timed("snapshot"):
+            try:
+                snapshot_id = snapshot_create(list_objects, dict_endpoint_sets)
+            except (IOError, OSError), e:
+                log(1, "Could not save snapshot in " + directory_o365_snapshots + ": " + str(e))
+
+    dict_url_category_state = apply_objects(list_objects)
+    failed = run_metrics["tmsh_failed"] > 0
+    if snapshot_id is not None:
+        snapshot_mark(snapshot_id, "failed" if failed else "applied")
 
-        #-----------------------------------------------------------------------
-        # Make sure Data Group exists that corresponds to File update
-        #-----------------------------------------------------------------------
-        # The object appears in WebUI: Local Traffic >> iRules : Data Group List >> (External File) xxx
-        # The object needs to exist, but does not have to be explicitly updated by this script
+    #-----------------------------------------------------------------------
+    # Remember the applied VERSION for the next incremental update
+    #-----------------------------------------------------------------------
+    # The URL category entries in place are always recorded.  The endpoint sets only once everything is applied.
+    with timed("save state"):
+        if not failed:
+            for instance in sorted(dict_endpoint_sets):
+                list_records, ms_o365_version_latest = dict_endpoint_sets[instance]
+                if re.match('[0-9]{10}$', ms_o365_version_latest):
+                    save_state(instance, ms_o365_version_latest, list_records)
+                    log(2, "Saved applied VERSION " + ms_o365_version_latest + " in " + file_o365_state % instance + ".")
+        save_url_category_state(dict_url_category_state)
+
+    log(2, "Number of tmsh invocations so far: " + str(tmsh_invocations))
+    log(2, "MS web service: " + str(http_stats["requests"]) + " requests, " + str(http_stats["retries"]) + " retries, "
+        + str(http_stats["not_modified"]) + " not modified, " + str(http_stats["bytes_received"]) + " bytes received ("
+        + str(http_stats["bytes_decoded"]) + " decoded), " + "%.2f" % http_stats["seconds"] + " seconds")
+    if failed:
+        log(1, "O365 URL/IP address update failed: " + str(run_metrics["tmsh_failed"]) + " tmsh commands failed.  Retrying with the next run.")
+        return False
+    if run_metrics["tmsh_rejected"]:
+        log(1, "Completed O365 URL/IP address update process.  " + str(run_metrics["tmsh_rejected"]) + " URL category entries rejected by tmsh were skipped.")
+    else:
+        log(1, "Completed O365 URL/IP address update process.")
+    return True
 
-        result = commands.getoutput("tmsh list /ltm data-group external " + urls_dg)
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /ltm data-group external " + urls_dg + " external-file-name " + urls_dg + "_object")
-            log(2, "Data Group " + urls_dg + " was not found.  Creating it from " + urls_dg + "_object")
+def main():
+    run_instrumented(update_once)
 
-    # -----------------------------------------------------------------------
-    # IPv4 addresses saved into text files separately
-    # -----------------------------------------------------------------------
-    # Process IP dictionaries
-    if use_ipv4:
-        # Write IPv4 list
-        fout = open(dg_file_name_ip4, 'w')
-        for ip4 in (list(sorted(set(list_ips4_to_pbr)))):
-            fout.write("network " + str(ip4) + ",\n")
-        fout.flush()
-        fout.close()
-
-        #-----------------------------------------------------------------------
-        # Data Group File update
-        #-----------------------------------------------------------------------
-        # The object appears in WebUI: System › File Management : Data Group File List >> xxx_object
-        # Name of the Data Group is given in ipv4_dg
-        # Name of the Data Group File is ipv4_dg + "_object"
-
-        result = commands.getoutput("tmsh list sys file data-group " + ipv4_dg + "_object")
-        # Create or update Data Group File from text file (given for variable "dg_file_name_ip4")
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /sys file data-group " + ipv4_dg + "_object type ip source-path file:" + dg_file_name_ip4)
-            log(2, "Data Group File " + ipv4_dg + "_object was not found.  Created from " + dg_file_name_ip4 + ".")
-        else:
-            result2 = commands.getoutput("tmsh modify /sys file data-group " + ipv4_dg + "_object source-path file:" + dg_file_name_ip4)
-            log(2, "Data Group File " + ipv4_dg + "_object was found.  Updated from " + dg_file_name_ip4 + ".")
+def update_once():
+    # One run: check the VERSION, and update the objects of the changed instances
+    pin = read_pin()
+    if pin is not None:
+        log(1, "Pinned to snapshot " + pin["snapshot"] + " by --rollback.  Skipping update until --unpin.")
+        return "unchanged"
 
-        #-----------------------------------------------------------------------
-        # Make sure Data Group exists that corresponds to File update
-        #-----------------------------------------------------------------------
-        # The object appears in WebUI: Local Traffic >> iRules : Data Group List >> (External File) xxx
-        # The object needs to exist, but does not have to be explicitly updated by this script
+    if not is_active():
+        return "standby"
 
-        result = commands.getoutput("tmsh list /ltm data-group external " + ipv4_dg)
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /ltm data-group external " + ipv4_dg + " external-file-name " + ipv4_dg + "_object")
-            log(2, "Data Group " + ipv4_dg + " was not found.  Creating it from " + ipv4_dg + "_object")
+    guid = get_guid()
 
-    # -----------------------------------------------------------------------
-    # IPv6 addresses saved into text files separately
-    # -----------------------------------------------------------------------
-    # Process IP dictionaries
-    if use_ipv6:
-        # Write IPv6 list
-        fout = open(dg_file_name_ip6, 'w')
-        for ip6 in (list(sorted(set(list_ips6_to_pbr)))):
-            fout.write("network " + str(ip6) + ",\n")
-        fout.flush()
-        fout.close()
-
-        #-----------------------------------------------------------------------
-        # Data Group File update
-        #-----------------------------------------------------------------------
-        # The object appears in WebUI: System › File Management : Data Group File List >> xxx_object
-        # Name of the Data Group is given in ipv6_dg
-        # Name of the Data Group File is ipv6_dg + "_object"
-
-        result = commands.getoutput("tmsh list sys file data-group " + ipv6_dg + "_object")
-        # Create or update Data Group File from text file (given for variable "dg_file_name_ip6")
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /sys file data-group " + ipv6_dg + "_object type ip source-path file:" + dg_file_name_ip6)
-            log(2, "Data Group File " + ipv6_dg + "_object was not found.  Created from " + dg_file_name_ip6 + ".")
+    dict_version_latest = request_versions(guid)
+    if dict_version_latest is None:
+        # MS O365 version request failed
+        log(1, "VERSION request to MS web service failed.  Assuming VERSIONs did not match, and proceed.")
+        dict_version_latest = {}
+    run_metrics["versions"] = dict_version_latest
+
+    list_instances_changed = []
+    for instance in ms_o365_instances:
+        ms_o365_version_previous = read_version_previous(instance)
+        ms_o365_version_latest = dict_version_latest.get(instance, "")
+        log(2, instance + ": Previous VERSION is " + ms_o365_version_previous)
+        log(2, instance + ": Latest VERSION is " + ms_o365_version_latest)
+        if ms_o365_version_latest != ms_o365_version_previous or force_o365_record_refresh == 1:
+            list_instances_changed.append(instance)
+
+    if not list_instances_changed:
+        log(1, "You already have the latest MS O365 URL/IP Address list: " + ", ".join([instance + " " + dict_version_latest.get(instance, "") for instance in ms_o365_instances]) + ". Aborting operation.")
+        return "unchanged"
+
+    # The VERSION is recorded only once everything is in place, so that a failed run is retried
+    if not update(guid, dict_version_latest, list_instances_changed):
+        return "failed"
+    for instance in list_instances_changed:
+        if dict_version_latest.get(instance, "") != "":
+            write_version(instance, dict_version_latest[instance])
+    return "updated"
+
+def daemon_delay(failures):
+    # Seconds until the next VERSION poll.  Doubled for each consecutive failure, and spread by random jitter
+    # so that many BIG-IPs started at the same time do not poll the web service at the same moment.
+    delay = min(daemon_backoff_max, daemon_poll_interval * (2 ** min(failures, 16)))
+    return delay * random.uniform(1 - daemon_poll_jitter, 1 + daemon_poll_jitter)
+
+def daemon_poll(guid, dict_version_applied):
+    # One poll of the daemon: check the VERSION, and update if an instance has a new one.
+    # dict_version_applied (instance -> VERSION) is updated after a successful update.
+    global force_o365_record_refresh
+
+    pin = read_pin()
+    if pin is not None:
+        log(2, "Pinned to snapshot " + pin["snapshot"] + " by --rollback.  Skipping update until --unpin.")
+        return "unchanged"
+    # A rollback may have changed the applied VERSIONs
+    for instance in ms_o365_instances:
+        dict_version_applied[instance] = read_version_previous(instance)
+
+    dict_version_latest = request_versions(guid)
+    if dict_version_latest is None:
+        log(1, "VERSION request to MS web service failed.")
+        return "failed"
+    run_metrics["versions"] = dict_version_latest
+
+    list_instances_changed = []
+    for instance in ms_o365_instances:
+        if dict_version_latest.get(instance, dict_version_applied[instance]) != dict_version_applied[instance] \
+            or force_o365_record_refresh == 1:
+            list_instances_changed.append(instance)
+    if not list_instances_changed:
+        log(2, "No new MS O365 URL/IP Address list VERSION.")
+        return "unchanged"
+    if not is_active():
+        return "standby"
+
+    log(1, "New MS O365 URL/IP Address list VERSION: " + ", ".join([instance + " " + dict_version_latest.get(instance, "") for instance in list_instances_changed]) + ".")
+    if not update(guid, dict_version_latest, list_instances_changed):
+        return "failed"
+    for instance in list_instances_changed:
+        if dict_version_latest.has_key(instance):
+            dict_version_applied[instance] = dict_version_latest[instance]
+            write_version(instance, dict_version_latest[instance])
+    # Forced refresh applies to the first update only
+    force_o365_record_refresh = 0
+    return "updated"
+
+def daemon():
+    # Stay resident and poll the VERSION only.  The full update runs when an instance has a new VERSION,
+    # and only while this BIG-IP is ACTIVE.
+
+    # Only one daemon at a time
+    if not os.path.isdir(work_directory):
+        os.mkdir(work_directory)
+    # Opened for append, so that the PID of a running daemon is not wiped out before the lock is tried
+    lock = open(file_o365_daemon_lock, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        log(1, "O365 update daemon is already running.  Exiting.")
+        close_log()
+        return
+    lock.truncate(0)
+    lock.write(str(os.getpid()) + "\n")
+    lock.flush()
+
+    guid = get_guid()
+    dict_version_applied = {}
+    for instance in ms_o365_instances:
+        dict_version_applied[instance] = read_version_previous(instance)
+    log(1, "O365 update daemon started.  Polling VERSION every " + str(daemon_poll_interval) + " seconds.")
+
+    failures = 0
+    while True:
+        try:
+            result = run_instrumented(lambda: daemon_poll(guid, dict_version_applied))
+        except Exception:
+            result = "failed"
+            log(1, "O365 update failed: " + traceback.format_exc())
+        if result == "failed":
+            failures += 1
+            log(1, "Consecutive failures: " + str(failures) + ".")
         else:
-            result2 = commands.getoutput("tmsh modify /sys file data-group " + ipv6_dg + "_object source-path file:" + dg_file_name_ip6)
-            log(2, "Data Group File " + ipv6_dg + "_object was found.  Updated from " + dg_file_name_ip6 + ".")
+            failures = 0
 
-        #-----------------------------------------------------------------------
-        # Make sure Data Group exists that corresponds to File update
-        #-----------------------------------------------------------------------
-        # The object appears in WebUI: Local Traffic >> iRules : Data Group List >> (External File) xxx
-        # The object needs to exist, but does not have to be explicitly updated by this script
-
-        result = commands.getoutput("tmsh list /ltm data-group external " + ipv6_dg)
-        if "was not found" in result:
-            result2 = commands.getoutput("tmsh create /ltm data-group external " + ipv6_dg + " external-file-name " + ipv6_dg + "_object")
-            log(2, "Data Group " + ipv6_dg + " was not found.  Creating it from " + ipv6_dg + "_object")
-
-    #-----------------------------------------------------------------------
-    # Save config
-    #-----------------------------------------------------------------------
-    log(1, "Saving BIG-IP Configuration.")
-    result = commands.getoutput("tmsh save /sys config")
-    log(2, result + "\n")
-
-
-    #-----------------------------------------------------------------------
-    # Initiate Config Sync: Device to Group
-    #-----------------------------------------------------------------------
-    if ha_config == 1:
-        log(1, "Initiating Config-Sync.")
-        result = commands.getoutput("tmsh run cm config-sync to-group " + device_group_name)
-        log(2, result + "\n")
-
-    log(1, "Completed O365 URL/IP address update process.")
+        # The connections would be closed by the web service while idle anyway
+        close_web_clients()
+        close_log()
+        time.sleep(daemon_delay(failures))
 
 
 if __name__=='__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Update BIG-IP Data Groups and URL categories from the Office 365 IP Address and URL web service.")
+    parser.add_argument("--daemon", action="store_true", help="stay resident and poll the web service VERSION instead of running once")
+    parser.add_argument("--list-snapshots", action="store_true", help="list the snapshots of the last updates")
+    parser.add_argument("--diff-snapshots", nargs=2, metavar=("SNAPSHOT_A", "SNAPSHOT_B"), help="show the changes between two snapshots")
+    parser.add_argument("--rollback", metavar="SNAPSHOT", help="re-apply a snapshot without the web service, and skip updates until --unpin")
+    parser.add_argument("--unpin", action="store_true", help="resume updates after --rollback")
+    args = parser.parse_args()
+    if args.list_snapshots or args.diff_snapshots or args.rollback:
+        try:
+            if args.list_snapshots:
+                list_snapshots()
+            elif args.diff_snapshots:
+                diff_snapshots(*args.diff_snapshots)
+            elif run_instrumented(lambda: rollback(args.rollback)) != "updated":
+                sys.exit(1)
+        except ValueError, e:
+            parser.error(str(e))
+    elif args.unpin:
+        unpin()
+    elif args.daemon:
+        daemon()
+    else:
+        main()
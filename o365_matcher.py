@@ -0,0 +1,440 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Offline matcher for the Office 365 Data Groups
+#
+# Answers "would this host/IP be bypassed?" without a BIG-IP.  Loads the Data Group files written by
+# o365_ip_url_automation.py (o365_urls.txt, o365_ip4.txt, o365_ip6.txt), or builds the same entries from an
+# endpoint set, and classifies hosts, URLs and addresses read from files or stdin, e.g. to replay proxy logs
+# and check the coverage before a change.
+#
+# Hosts match like "class match $host ends_with" in the iRule, IP addresses like a lookup in an address
+# type Data Group (longest prefix).  With dg_value_mode the value of the matched entry is shown, and the port
+# of the request, if known, is checked against its TCP ports as o365_proxy_bypass_port_irule.tcl does.
+#
+# Usage: python o365_matcher.py [--dg-dir /var/tmp/o365 | --urls F --ip4 F --ip6 F | --endpoints endpoints.json]
+#                               [--field 7] [--print matched|unmatched|all] [log files ...]
+#        python o365_matcher.py --benchmark 1000000
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import bisect
+import argparse
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import o365_ip_url_automation as o365
+
+#-----------------------------------------------------------------------
+# Matcher Options
+#-----------------------------------------------------------------------
+
+cache_size = 100000     # Results of this many distinct targets are cached (proxy logs repeat the same hosts a lot).  0=no cache
+top_count = 20          # Most frequent matched entries and unmatched targets in the summary
+
+
+#-----------------------------------------------------------------------
+# Implementation
+#-----------------------------------------------------------------------
+
+def parse_dg_line(line):
+    # 'office.com := 1,' / '.lync.com := "12;A;443;3478-3481",' / 'network 13.107.6.152/31,' -> (key, value)
+    # Returns None for a blank line.
+    line = line.strip().rstrip(",").strip()
+    if line == "":
+        return None
+    if " := " in line:
+        key, value = line.split(" := ", 1)
+        value = value.strip()
+        if value.startswith('"') and value.endswith('"') and len(value) >= 2:
+            value = value[1:-1]
+    else:
+        key, value = line, ""
+    key = key.strip()
+    if key.startswith("network "):
+        key = key[len("network "):].strip()
+    if key.startswith('"') and key.endswith('"') and len(key) >= 2:
+        key = key[1:-1]
+    return key, value
+
+def address_to_int(address):
+    # "13.107.6.152" -> (integer, 32), "2603:1006::1" -> (integer, 128).  Raises socket.error if it is no address.
+    if ":" in address:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, address))
+        return high << 64 | low, 128
+    return struct.unpack("!I", socket.inet_pton(socket.AF_INET, address))[0], 32
+
+def parse_target(token):
+    # Host or address and port of a log token: "https://host:8443/path", "host:443", "[2603::1]:443", "13.107.6.152"
+    # Returns (target, port).  The port is None if the token does not tell.
+    port = None
+    if "://" in token:
+        scheme, token = token.split("://", 1)
+        port = {"https": 443, "http": 80}.get(scheme.lower())
+    token = token.split("/", 1)[0].rsplit("@", 1)[-1]
+    if token.startswith("["):
+        target, rest = token[1:].split("]", 1)
+        if rest.startswith(":") and rest[1:].isdigit():
+            port = int(rest[1:])
+    elif token.count(":") == 1:
+        target, rest = token.split(":", 1)
+        if rest.isdigit():
+            port = int(rest)
+    else:
+        target = token
+    return target.lower().rstrip("."), port
+
+def port_allowed(value, port):
+    # Data Group value "ids;category;tcpPorts;udpPorts": the request port must be one of the TCP ports.
+    # Values without ports (dg_value_mode = 0), and requests of unknown port, are not checked.
+    list_fields = value.split(";")
+    if port is None or len(list_fields) < 3:
+        return True
+    for first, last in o365.parse_port_ranges(list_fields[2]):
+        if first <= port <= last:
+            return True
+    return False
+
+class HostIndex(object):
+    # Host names matched like "class match $host ends_with" in the iRule, returning the longest entry matched.
+    # Entries are hashed.  A host can only end with an entry whose last label is its own last label, so the
+    # entry lengths are kept per last label, and a lookup tries only those suffixes of the host, longest first.
+
+    def __init__(self, label_boundary=0):
+        self.label_boundary = label_boundary
+        self.dict_entries = {}      # entry -> value
+        self.dict_lengths = None    # last label -> entry lengths, longest first
+
+    def add(self, entry, value):
+        self.dict_entries[entry] = value
+        self.dict_lengths = None
+
+    def build(self):
+        # Entries without a dot can match any host, so their lengths are tried for every host
+        dict_sets = {}
+        set_lengths_any = set()
+        for entry in self.dict_entries:
+            if "." in entry:
+                dict_sets.setdefault(entry.rsplit(".", 1)[1], set()).add(len(entry))
+            else:
+                set_lengths_any.add(len(entry))
+        self.dict_lengths = {None: sorted(set_lengths_any, reverse=True)}
+        for label in dict_sets:
+            self.dict_lengths[label] = sorted(dict_sets[label] | set_lengths_any, reverse=True)
+
+    def lookup(self, host):
+        # Returns (entry, value) of the longest entry the host ends with, or None
+        if self.dict_lengths is None:
+            self.build()
+        if self.label_boundary:
+            # Data group entries are written as ".office.com" for label boundary match
+            host = "." + host
+        list_lengths = self.dict_lengths.get(host.rsplit(".", 1)[-1], self.dict_lengths[None])
+        dict_entries = self.dict_entries
+        length_host = len(host)
+        for length in list_lengths:
+            if length <= length_host:
+                entry = host[length_host - length:]
+                if entry in dict_entries:
+                    return entry, dict_entries[entry]
+        return None
+
+class NetworkIndex(object):
+    # Longest prefix match of the addresses of one family.  The networks are flattened into disjoint address
+    # intervals, each with the most specific network covering it, kept in sorted integer arrays for bisect.
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.dict_networks = {}     # (first address, prefix length) -> (network, value)
+        self.list_starts = None
+        self.list_ends = None
+        self.list_entries = None
+
+    def add(self, network, value):
+        first, prefix_len, bits = o365.ip_network_to_int(network)
+        self.dict_networks[(first, prefix_len)] = (network, value)
+        self.list_starts = None
+
+    def build(self):
+        list_starts = []
+        list_ends = []
+        list_entries = []
+        def emit(first, last, entry):
+            if first <= last:
+                list_starts.append(first)
+                list_ends.append(last)
+                list_entries.append(entry)
+
+        # CIDR blocks are nested or disjoint.  The stack holds the networks containing the cursor, innermost last.
+        list_stack = []
+        cursor = 0
+        for first, prefix_len in sorted(self.dict_networks):
+            last = first + (1 << (self.bits - prefix_len)) - 1
+            while list_stack and list_stack[-1][0] < first:
+                last_closed, entry = list_stack.pop()
+                emit(cursor, last_closed, entry)
+                cursor = last_closed + 1
+            if list_stack:
+                emit(cursor, first - 1, list_stack[-1][1])
+            list_stack.append((last, self.dict_networks[(first, prefix_len)]))
+            cursor = first
+        while list_stack:
+            last_closed, entry = list_stack.pop()
+            emit(cursor, last_closed, entry)
+            cursor = last_closed + 1
+
+        self.list_starts = list_starts
+        self.list_ends = list_ends
+        self.list_entries = list_entries
+
+    def lookup(self, value):
+        # Returns (network, value) of the most specific network containing the address, or None
+        if self.list_starts is None:
+            self.build()
+        index = bisect.bisect_right(self.list_starts, value) - 1
+        if index >= 0 and value <= self.list_ends[index]:
+            return self.list_entries[index]
+        return None
+
+class Matcher(object):
+    # Classifies hosts, URLs and IP addresses against the URL, IPv4 and IPv6 Data Groups.
+
+    def __init__(self, label_boundary=None):
+        # label_boundary None: on if all URL entries start with "." (url_dg_label_boundary = 1)
+        self.label_boundary = label_boundary
+        self.hosts = HostIndex()
+        self.dict_networks = {32: NetworkIndex(32), 128: NetworkIndex(128)}
+        self.cache = {}
+
+    def load_dg(self, content):
+        # Data Group file content.  Lines starting with "network" go to the address indexes.
+        for line in content.splitlines():
+            parsed = parse_dg_line(line)
+            if parsed is None:
+                continue
+            key, value = parsed
+            if line.lstrip().startswith("network"):
+                if ":" in key:
+                    self.dict_networks[128].add(key, value)
+                else:
+                    self.dict_networks[32].add(key, value)
+            else:
+                self.hosts.add(key, value)
+        self.prepare()
+
+    def load_dg_file(self, file_name):
+        f = open(file_name, "r")
+        self.load_dg(f.read())
+        f.close()
+
+    def load_objects(self, objects):
+        # Objects returned by o365_ip_url_automation.build_objects()
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            self.load_dg(dg_content)
+
+    def load_endpoints(self, list_records, version=""):
+        # Endpoint set, turned into Data Group entries with the options of o365_ip_url_automation.py
+        self.load_objects(o365.build_objects("matcher", "", list_records, version, False))
+
+    def prepare(self):
+        if self.label_boundary is None:
+            self.hosts.label_boundary = int(bool(self.hosts.dict_entries) and all([entry.startswith(".") for entry in self.hosts.dict_entries]))
+        else:
+            self.hosts.label_boundary = self.label_boundary
+        self.hosts.build()
+        for index in self.dict_networks.values():
+            index.build()
+        self.cache = {}
+
+    def match(self, target):
+        # Entry and value matched by a host or an address, or None.  Raises socket.error for an invalid address.
+        if ":" in target or target[-1:].isdigit() and target.replace(".", "").isdigit():
+            value, bits = address_to_int(target)
+            return self.dict_networks[bits].lookup(value)
+        return self.hosts.lookup(target)
+
+    def classify(self, token):
+        # Returns (target, port, entry, value, bypass) for a log token.  target is None if the token is unusable.
+        result = self.cache.get(token)
+        if result is not None:
+            return result
+        target, port = parse_target(token)
+        entry = value = None
+        bypass = False
+        if target == "":
+            target = None
+        else:
+            try:
+                matched = self.match(target)
+            except (socket.error, ValueError):
+                target = None
+                matched = None
+            if matched is not None:
+                entry, value = matched
+                bypass = port_allowed(value, port)
+        result = (target, port, entry, value, bypass)
+        if cache_size:
+            if len(self.cache) >= cache_size:
+                self.cache = {}
+            self.cache[token] = result
+        return result
+
+#-----------------------------------------------------------------------
+# Command line
+#-----------------------------------------------------------------------
+
+def load_matcher(args):
+    matcher = Matcher(args.label_boundary)
+    if args.endpoints:
+        # Raw /endpoints list, or a state file of the update script ({"version": ..., "endpoints": [...]})
+        f = open(args.endpoints, "r")
+        data = json.load(f)
+        f.close()
+        version = ""
+        if isinstance(data, dict):
+            version = str(data.get("version", ""))
+            data = data["endpoints"]
+        # The update log is not written to, and all Data Groups are built
+        o365.log_level = 0
+        o365.use_url = o365.use_pac = 0
+        o365.use_url_dg = o365.use_ipv4 = o365.use_ipv6 = 1
+        matcher.load_endpoints(data, version)
+        return matcher
+
+    list_files = [file_name for file_name in (args.urls, args.ip4, args.ip6) if file_name]
+    if not list_files:
+        list_files = [os.path.join(args.dg_dir, os.path.basename(file_name))
+                      for file_name in (o365.dg_file_name_urls, o365.dg_file_name_ip4, o365.dg_file_name_ip6)]
+        list_files = [file_name for file_name in list_files if os.path.isfile(file_name)]
+    if not list_files:
+        raise IOError("No Data Group file found in " + args.dg_dir)
+    for file_name in list_files:
+        matcher.load_dg_file(file_name)
+    return matcher
+
+def replay(matcher, list_files, field, print_mode):
+    # Classify the token in the given whitespace separated field (1 = first) of every line
+    counts = collections.Counter()
+    counter_entries = collections.Counter()
+    counter_unmatched = collections.Counter()
+    time_start = time.time()
+    write = sys.stdout.write
+    for file_name in list_files or ["-"]:
+        if file_name == "-":
+            f = sys.stdin
+        else:
+            f = open(file_name, "r")
+        for line in f:
+            counts["lines"] += 1
+            list_fields = line.split(None, field)
+            if len(list_fields) < field:
+                counts["unusable"] += 1
+                continue
+            token = list_fields[field - 1]
+            target, port, entry, value, bypass = matcher.classify(token)
+            if target is None:
+                counts["unusable"] += 1
+                continue
+            if bypass:
+                counts["bypass"] += 1
+                counter_entries[entry] += 1
+                if print_mode in ("matched", "all"):
+                    write("bypass\t" + token + "\t" + entry + "\t" + value + "\n")
+            else:
+                counts["proxy"] += 1
+                counter_unmatched[target if entry is None else target + ":" + str(port)] += 1
+                if print_mode in ("unmatched", "all"):
+                    write("proxy\t" + token + "\t" + (entry or "") + "\t" + (value or "") + "\n")
+        if f is not sys.stdin:
+            f.close()
+    seconds = time.time() - time_start
+
+    out = sys.stderr if print_mode else sys.stdout
+    classified = counts["bypass"] + counts["proxy"]
+    out.write(str(counts["lines"]) + " lines in %.2f seconds (%d lines/s): " % (seconds, counts["lines"] / max(seconds, 1e-9))
+              + str(counts["bypass"]) + " bypass, " + str(counts["proxy"]) + " proxy, " + str(counts["unusable"]) + " unusable.  "
+              + "Coverage %.1f%%.\n" % (counts["bypass"] * 100.0 / max(classified, 1)))
+    out.write("Most matched entries:\n")
+    for entry, count in counter_entries.most_common(top_count):
+        out.write("%10d  %s\n" % (count, entry))
+    out.write("Most frequent targets not bypassed:\n")
+    for target, count in counter_unmatched.most_common(top_count):
+        out.write("%10d  %s\n" % (count, target))
+
+def benchmark(matcher, num_lookups, seed):
+    # Lookups per second of each index, and of whole tokens through classify(), hits and misses mixed
+    rnd = random.Random(seed)
+    list_hosts = sorted(matcher.hosts.dict_entries)
+    dict_networks = {32: sorted(matcher.dict_networks[32].dict_networks), 128: sorted(matcher.dict_networks[128].dict_networks)}
+    dict_samples = {"host": [], "ipv4": [], "ipv6": []}
+    for i in range(num_lookups):
+        if list_hosts and rnd.random() < 0.5:
+            entry = rnd.choice(list_hosts).lstrip(".")
+            dict_samples["host"].append("x%d.%s" % (i, entry))
+        else:
+            dict_samples["host"].append("x%d.example.net" % i)
+        for family, bits in (("ipv4", 32), ("ipv6", 128)):
+            list_networks = dict_networks[bits]
+            if list_networks and rnd.random() < 0.5:
+                first, prefix_len = rnd.choice(list_networks)
+                dict_samples[family].append(first + rnd.randint(0, (1 << (bits - prefix_len)) - 1))
+            else:
+                dict_samples[family].append(rnd.randint(0, (1 << bits) - 1))
+
+    def measure(name, function, list_samples):
+        time_start = time.time()
+        hits = 0
+        for sample in list_samples:
+            if function(sample) is not None:
+                hits += 1
+        seconds = time.time() - time_start
+        sys.stdout.write("%-32s %10d lookups  %7.3f s  %12d lookups/s  %5.1f%% hits\n"
+                         % (name, len(list_samples), seconds, len(list_samples) / max(seconds, 1e-9), hits * 100.0 / max(len(list_samples), 1)))
+
+    sys.stdout.write("Entries: " + str(len(list_hosts)) + " hosts, " + str(len(matcher.dict_networks[32].dict_networks)) + " IPv4 and "
+                     + str(len(matcher.dict_networks[128].dict_networks)) + " IPv6 networks in "
+                     + str(len(matcher.dict_networks[32].list_starts) + len(matcher.dict_networks[128].list_starts)) + " intervals\n")
+    measure("host index", matcher.hosts.lookup, dict_samples["host"])
+    measure("IPv4 index", matcher.dict_networks[32].lookup, dict_samples["ipv4"])
+    measure("IPv6 index", matcher.dict_networks[128].lookup, dict_samples["ipv6"])
+
+    # Whole log tokens, as replayed from a proxy log: URLs and host:port, a few thousand distinct targets
+    list_tokens = []
+    for i in range(min(num_lookups, 5000)):
+        host = dict_samples["host"][i]
+        list_tokens.extend(["https://" + host + "/path?q=" + str(i), host + ":443"])
+    list_log = [rnd.choice(list_tokens) for i in range(num_lookups)]
+    matcher.cache = {}
+    measure("log tokens (cached)", lambda token: matcher.classify(token)[2], list_log)
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify hosts, URLs and IP addresses against the Office 365 Data Groups, offline.")
+    parser.add_argument("files", nargs="*", help="log files to classify, one target per line (default stdin)")
+    parser.add_argument("--dg-dir", default=o365.work_directory, help="directory of the Data Group files (default " + o365.work_directory + ")")
+    parser.add_argument("--urls", help="URL Data Group file")
+    parser.add_argument("--ip4", help="IPv4 Data Group file")
+    parser.add_argument("--ip6", help="IPv6 Data Group file")
+    parser.add_argument("--endpoints", help="endpoints JSON, or state file of the update script, to build the entries from instead")
+    parser.add_argument("--label-boundary", type=int, choices=[0, 1], help="static::o365_label_boundary of the iRule (default: on if all URL entries start with \".\")")
+    parser.add_argument("--field", type=int, default=1, help="whitespace separated field of each line holding the host, URL or address (default 1, e.g. 7 for Squid access.log)")
+    parser.add_argument("--print", dest="print_mode", choices=["matched", "unmatched", "all"], help="print the classification of these lines (the summary goes to stderr then)")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="measure the lookup throughput with N synthetic lookups instead")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the benchmark data")
+    args = parser.parse_args()
+
+    try:
+        matcher = load_matcher(args)
+    except (IOError, ValueError, KeyError), e:
+        parser.error(str(e))
+    if args.benchmark:
+        benchmark(matcher, args.benchmark, args.seed)
+    else:
+        replay(matcher, args.files, args.field, args.print_mode)
+
+
+if __name__=='__main__':
+    main()
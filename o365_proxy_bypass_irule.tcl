@@ -12,6 +12,10 @@ when RULE_INIT {
   ## Data group containing Office 365 URLs that will bypass the forward proxy
   set static::o365_url_dg "o365_url_dg"
 
+  ## Hostname match on label boundary. Must match url_dg_label_boundary in o365_ip_url_automation.py
+  # 0 = plain ends_with, 1 = ".office.com" entries match office.com and www.office.com, but not xoffice.com
+  set static::o365_label_boundary 0
+
   ## SNAT pool settings
   # 0 = use virtual server settings, 1 = enable SNAT pool for O365 traffic
   set static::o365_snat 0
@@ -33,6 +37,11 @@ when HTTP_PROXY_REQUEST {
 
   # Strip of the port number
   set host [lindex [split [HTTP::host] ":"] 0]
+
+  # Data group entries are written as ".office.com" for label boundary match
+  if { $static::o365_label_boundary } {
+    set host ".$host"
+  }
  
   # If the hostname matches a 0ffice 365 domain, enable the forward proxy on the HTTP profile and bypass the explicit proxy pool members.
   if { [class match $host ends_with $static::o365_url_dg] } {
@@ -0,0 +1,124 @@
+#**
+#** Name   : o365_proxy_bypass_port_irule
+#** Author : brett-at-f5
+#** Description: Office365 proxy bypass based on external data-groups with values (dg_value_mode = 1 in o365_ip_url_automation.py).
+#**              The class lookup returns the endpoint set ids, category and ports of each entry matching the host, and
+#**              the decision is made from those values. Must be applied to an explicit proxy virtual server.
+#**
+
+when RULE_INIT {
+  ## Debug logging control
+  # 0 = no logging, 1 = debug logging (Test/Dev Only).
+  set static::o365_dbg 0
+
+  ## Data groups containing Office 365 URLs and IPv4/IPv6 networks that will bypass the forward proxy
+  set static::o365_url_dg "o365_url_dg"
+  set static::o365_ipv4_dg "o365_ipv4_dg"
+  set static::o365_ipv6_dg "o365_ipv6_dg"
+
+  ## Hostname match on label boundary. Must match url_dg_label_boundary in o365_ip_url_automation.py
+  # 0 = plain ends_with, 1 = ".office.com" entries match office.com and www.office.com, but not xoffice.com.
+  # Entries from "*.office.com" are written as ".office.com" too, so they also match office.com itself.
+  set static::o365_label_boundary 0
+
+  ## Categories to bypass: O = Optimize, A = Allow, D = Default
+  set static::o365_bypass_categories "O A D"
+
+  ## SNAT pool settings
+  # 0 = use virtual server settings, 1 = enable SNAT pool for O365 traffic
+  set static::o365_snat 0
+  set static::o365_snat_pool "o365_snat_pool"
+}
+
+proc o365_log { log_message } {
+  if { $static::o365_dbg } {
+    log local0. "timestamp=[clock clicks -milliseconds],vs=[virtual],$log_message"
+  }
+}
+
+# Returns 1 if port is in the list of ports and port ranges ("80,443,3478-3481")
+proc o365_port_match { port ports } {
+  foreach range [split $ports ","] {
+    set bounds [split $range "-"]
+    if { [llength $bounds] == 1 } {
+      if { $port == $range } {
+        return 1
+      }
+    } elseif { $port >= [lindex $bounds 0] && $port <= [lindex $bounds 1] } {
+      return 1
+    }
+  }
+  return 0
+}
+
+when CLIENT_ACCEPTED {
+  call o365_log "[IP::client_addr]:[TCP::client_port] --> [clientside {IP::local_addr}]:[clientside {TCP::local_port}]"
+}
+
+when HTTP_PROXY_REQUEST {
+  call o365_log "[HTTP::method] [HTTP::host] [HTTP::uri] HTTP/[HTTP::version] [HTTP::header User-Agent]"
+
+  # Split the host and the port number. IPv6 literals are in brackets: [2603:1006::1]:443.
+  # The port defaults to 443 for CONNECT and 80 otherwise.
+  if { [string index [HTTP::host] 0] eq "\[" } {
+    set bracket [string last "\]" [HTTP::host]]
+    set host [string range [HTTP::host] 1 [expr {$bracket - 1}]]
+    set port [string range [HTTP::host] [expr {$bracket + 2}] end]
+  } else {
+    set host [lindex [split [HTTP::host] ":"] 0]
+    set port [lindex [split [HTTP::host] ":"] 1]
+  }
+  if { $port eq "" } {
+    if { [HTTP::method] eq "CONNECT" } {
+      set port 443
+    } else {
+      set port 80
+    }
+  }
+
+  # Values "ids;category;tcpPorts;udpPorts", none when the host is not an Office 365 endpoint.
+  # Address lookups return the longest prefix matched.
+  if { $host contains ":" } {
+    set values [list [class match -value $host equals $static::o365_ipv6_dg]]
+  } elseif { [scan $host {%d.%d.%d.%d%c} a b c d e] == 4 } {
+    set values [list [class match -value $host equals $static::o365_ipv4_dg]]
+  } else {
+    # Data group entries are written as ".office.com" for label boundary match
+    if { $static::o365_label_boundary } {
+      set host ".$host"
+    }
+    # Every entry the host ends with, as the order of the matches is not defined
+    set values [class search -all -value $static::o365_url_dg ends_with $host]
+  }
+
+  set bypass 0
+  foreach value $values {
+    set fields [split $value ";"]
+    if { $value ne "" && [lsearch -exact $static::o365_bypass_categories [lindex $fields 1]] >= 0
+         && [call o365_port_match $port [lindex $fields 2]] } {
+      set bypass 1
+      break
+    }
+  }
+
+  # If the category is bypassed and the port is used by the endpoint sets, enable the forward proxy on the HTTP profile
+  # and bypass the explicit proxy pool members.
+  if { $bypass } {
+    call o365_log "Data group match, endpoint sets [lindex $fields 0], category [lindex $fields 1], port $port. Bypass."
+
+    # Use a SNAT pool?
+    if { $static::o365_snat } {
+      snatpool $static::o365_snat_pool
+    }
+
+    # Use default route and forward proxy the connection.
+    HTTP::proxy enable
+  } else {
+    # Reverse proxy/load balance the request unmodified to the default explicit proxy pool members.
+    HTTP::proxy disable
+  }
+}
+
+when SERVER_CONNECTED {
+  call o365_log "[IP::client_addr]:[TCP::client_port] ([IP::local_addr]:[TCP::local_port]) --> [LB::server addr]:[LB::server port]"
+}
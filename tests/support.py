@@ -0,0 +1,91 @@
+# Shared helpers of the unit tests.  Run from the repository root with Python 2.7:
+#   python -m unittest discover -s tests
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import o365_ip_url_automation as o365
+
+data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Stand-in for tmsh: runs the ";" separated commands of "tmsh -q -c <script>" one by one, like tmsh does.
+# "run util bash -c \"echo X\"" prints X.  The first rule whose pattern is found in a command gives its output;
+# a failing rule stops the process with exit status 1, so the commands after it are not run.
+# Each invocation is appended to the log as a JSON list of its commands.
+fake_tmsh_script = r'''#!%(python)s
+import sys, re, json
+rules = json.load(open(%(rules)r))
+args = sys.argv[1:]
+if args[:1] == ["-q"]:
+    args = args[1:]
+commands = [command.strip() for command in re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)', args[1]) if command.strip()]
+f = open(%(log)r, "a")
+f.write(json.dumps(commands) + "\n")
+f.close()
+for command in commands:
+    match = re.match(r'run util bash -c "echo (\S+)"$', command)
+    if match:
+        sys.stdout.write(match.group(1) + "\n")
+        continue
+    for pattern, output, fail in rules:
+        if re.search(pattern, command):
+            if output:
+                sys.stdout.write(output + "\n")
+            if fail:
+                sys.exit(1)
+            break
+'''
+
+class O365TestCase(unittest.TestCase):
+    # Runs each test in its own work directory.  Options set with set_option() are restored afterwards.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="o365_test_")
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name in dir(o365):
+            value = getattr(o365, name)
+            if isinstance(value, str) and value.startswith("/var/tmp/o365"):
+                self.set_option(name, self.directory + value[len("/var/tmp/o365"):])
+        os.mkdir(o365.directory_o365_snapshots)
+        self.set_option("log_dest_file", os.path.join(self.directory, "o365_update.log"))
+        self.set_option("file_o365_run_log", "")
+        self.set_option("file_o365_prometheus", "")
+        self.addCleanup(o365.close_log)
+        o365.metrics_start()
+
+    def set_option(self, name, value):
+        self.addCleanup(setattr, o365, name, getattr(o365, name))
+        setattr(o365, name, value)
+
+    def fake_tmsh(self, rules=()):
+        # Put the stand-in tmsh in place.  rules holds (pattern, output, fail).
+        file_rules = os.path.join(self.directory, "tmsh_rules.json")
+        self.file_tmsh_log = os.path.join(self.directory, "tmsh_log.json")
+        f = open(file_rules, "w")
+        json.dump(list(rules), f)
+        f.close()
+        file_tmsh = os.path.join(self.directory, "tmsh")
+        f = open(file_tmsh, "w")
+        f.write(fake_tmsh_script % {"python": sys.executable, "rules": file_rules, "log": self.file_tmsh_log})
+        f.close()
+        os.chmod(file_tmsh, 0755)
+        self.set_option("tmsh_command", file_tmsh)
+
+    def tmsh_invocations(self):
+        # Commands of each tmsh process run so far
+        if not os.path.isfile(self.file_tmsh_log):
+            return []
+        f = open(self.file_tmsh_log, "r")
+        list_invocations = [json.loads(line) for line in f]
+        f.close()
+        return list_invocations
+
+def load_data(name):
+    f = open(os.path.join(data_directory, name), "r")
+    data = json.load(f)
+    f.close()
+    return data
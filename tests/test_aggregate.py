@@ -0,0 +1,62 @@
+import random
+import unittest
+
+from support import O365TestCase, o365
+
+def address_ranges(list_networks):
+    # Merged (first, last) address ranges covered by the networks
+    list_ranges = []
+    for network in list_networks:
+        value, prefix_len, bits = o365.ip_network_to_int(network)
+        list_ranges.append((value, value + (1 << (bits - prefix_len)) - 1))
+    list_merged = []
+    for first, last in sorted(list_ranges):
+        if list_merged and first <= list_merged[-1][1] + 1:
+            list_merged[-1] = (list_merged[-1][0], max(list_merged[-1][1], last))
+        else:
+            list_merged.append((first, last))
+    return list_merged
+
+class AggregateNetworksTest(O365TestCase):
+
+    def test_adjacent_and_contained_networks(self):
+        self.assertEqual(o365.aggregate_networks(["10.0.0.0/25", "10.0.0.128/25", "10.0.0.5/32", "10.0.3.0/24", "192.168.1.1"], "IPv4"),
+                         ["10.0.0.0/24", "10.0.3.0/24", "192.168.1.1/32"])
+
+    def test_adjacent_networks_not_aligned(self):
+        # 10.0.1.0/24 and 10.0.2.0/24 are adjacent, but not the halves of one /23
+        self.assertEqual(o365.aggregate_networks(["10.0.1.0/24", "10.0.2.0/24"], "IPv4"), ["10.0.1.0/24", "10.0.2.0/24"])
+
+    def test_ipv6(self):
+        self.assertEqual(o365.aggregate_networks(["2603:1006::/40", "2603:1006:100::/40", "2603:1006::1/128", "2620:1ec:8f8::/46"], "IPv6"),
+                         ["2603:1006::/39", "2620:1ec:8f8::/46"])
+
+    def test_empty(self):
+        self.assertEqual(o365.aggregate_networks([], "IPv4"), [])
+
+    def test_same_addresses_covered(self):
+        generator = random.Random(1)
+        for round in range(20):
+            list_networks = []
+            for count in range(200):
+                prefix_len = generator.randint(20, 32)
+                value = generator.getrandbits(12) << 20 | generator.getrandbits(20) & ~((1 << (32 - prefix_len)) - 1)
+                list_networks.append(o365.ip_int_to_network(value, prefix_len, 32))
+            list_aggregated = o365.aggregate_networks(list_networks, "IPv4")
+            self.assertEqual(address_ranges(list_aggregated), address_ranges(list_networks))
+            self.assertTrue(len(list_aggregated) <= len(set(list_networks)))
+
+    def test_supernets_within_overcoverage(self):
+        list_networks = ["10.0.0.0/24", "10.0.2.0/24", "10.0.8.0/24", "10.0.10.0/24"]
+        self.set_option("ip_aggregate_max_entries", 2)
+        self.assertEqual(o365.aggregate_networks(list_networks, "IPv4"), list_networks)
+
+        # 512 addresses may be added: one /22 over the first two /24s
+        self.set_option("ip_aggregate_max_overcoverage", 0.5)
+        self.assertEqual(o365.aggregate_networks(list_networks, "IPv4"), ["10.0.0.0/22", "10.0.8.0/24", "10.0.10.0/24"])
+
+        self.set_option("ip_aggregate_max_overcoverage", 1.0)
+        self.assertEqual(o365.aggregate_networks(list_networks, "IPv4"), ["10.0.0.0/22", "10.0.8.0/22"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+import fcntl
+import unittest
+
+from support import O365TestCase, o365
+
+class DaemonLockTest(O365TestCase):
+
+    def test_running_daemon_pid_kept(self):
+        # The lock of a running daemon, held on its own open file
+        lock = open(o365.file_o365_daemon_lock, "w")
+        self.addCleanup(lock.close)
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lock.write("12345\n")
+        lock.flush()
+
+        o365.daemon()
+        f = open(o365.file_o365_daemon_lock, "r")
+        self.assertEqual(f.read(), "12345\n")
+        f.close()
+
+if __name__ == "__main__":
+    unittest.main()
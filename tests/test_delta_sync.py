@@ -0,0 +1,136 @@
+import copy
+import json
+import unittest
+
+from support import O365TestCase, o365, load_data
+
+def change(id, endpoint_set_id, disposition, version="2020080100", **kwargs):
+    dict_change = {"id": id, "endpointSetId": endpoint_set_id, "disposition": disposition, "version": version}
+    dict_change.update(kwargs)
+    return dict_change
+
+class ApplyEndpointChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.list_records = load_data("endpoints.json")
+
+    def records_by_id(self, list_records):
+        return dict([(record["id"], record) for record in list_records])
+
+    def test_add_and_remove_entries(self):
+        list_changes = [change(900, 12, "change", add={"urls": ["*.skype.com"], "ips": ["52.113.0.0/16"]}),
+                        change(901, 31, "change", remove={"ips": ["150.171.40.0/22"]}),
+                        change(902, 46, "change", remove={"urls": ["www.office.com"]})]
+        dict_records = self.records_by_id(o365.apply_endpoint_changes(copy.deepcopy(self.list_records), list_changes))
+        self.assertIn("*.skype.com", dict_records[12]["urls"])
+        self.assertIn("52.113.0.0/16", dict_records[12]["ips"])
+        self.assertNotIn("150.171.40.0/22", dict_records[31]["ips"])
+        self.assertNotIn("www.office.com", dict_records[46]["urls"])
+
+    def test_add_and_remove_sets(self):
+        list_changes = [change(903, 64, "remove"),
+                        change(902, 99, "add", current={"serviceArea": "Common", "category": "Default", "required": False, "tcpPorts": "443"},
+                               add={"urls": ["*.newsvc.microsoft.com"]})]
+        list_records = o365.apply_endpoint_changes(copy.deepcopy(self.list_records), list_changes)
+        dict_records = self.records_by_id(list_records)
+        self.assertNotIn(64, dict_records)
+        self.assertEqual(dict_records[99], {"id": 99, "serviceArea": "Common", "category": "Default", "required": False,
+                                            "tcpPorts": "443", "urls": ["*.newsvc.microsoft.com"]})
+        self.assertEqual([record["id"] for record in list_records], sorted(dict_records))
+
+    def test_current_replaces_attributes(self):
+        list_changes = [change(904, 8, "change", current={"category": "Allow", "required": True})]
+        dict_records = self.records_by_id(o365.apply_endpoint_changes(copy.deepcopy(self.list_records), list_changes))
+        self.assertEqual((dict_records[8]["category"], dict_records[8]["required"]), ("Allow", True))
+
+    def test_changes_applied_in_version_order(self):
+        list_changes = [change(906, 12, "change", version="2020090100", remove={"urls": ["*.skype.com"]}),
+                        change(905, 12, "change", version="2020080100", add={"urls": ["*.skype.com"]})]
+        dict_records = self.records_by_id(o365.apply_endpoint_changes(copy.deepcopy(self.list_records), list_changes))
+        self.assertNotIn("*.skype.com", dict_records[12]["urls"])
+
+    def test_changes_not_fitting(self):
+        # Unknown set removed, new set without serviceArea, change of an unknown set, change without disposition
+        for list_changes in ([change(907, 500, "remove")],
+                             [change(908, 501, "add", add={"urls": ["a.example.com"]})],
+                             [change(909, 502, "change", add={"urls": ["b.example.com"]})],
+                             [{"id": 910, "endpointSetId": 12, "version": "2020080100"}]):
+            self.assertEqual(o365.apply_endpoint_changes(copy.deepcopy(self.list_records), list_changes), None)
+
+class GetEndpointSetTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.list_records = load_data("endpoints.json")
+        self.list_requests = []
+        self.dict_responses = {}
+        self.set_option("ms_web_service_get", self.fake_get)
+
+    def fake_get(self, host, uri, use_cache=True, consume=None):
+        # Responses by request method: (status, body)
+        method = uri.split("/")[1]
+        self.list_requests.append(method)
+        status, body = self.dict_responses[method]
+        if status != 200:
+            return status, None
+        return status, consume(iter([json.dumps(body)]))
+
+    def test_stored_set_at_latest_version(self):
+        o365.save_state("Worldwide", "2020070100", self.list_records)
+        self.assertEqual(o365.get_endpoint_set("Worldwide", "guid", "2020070100"), (self.list_records, "2020070100"))
+        self.assertEqual(self.list_requests, [])
+
+    def test_changes_applied_to_stored_set(self):
+        o365.save_state("Worldwide", "2020070100", self.list_records)
+        self.dict_responses["changes"] = (200, [change(900, 12, "change", add={"urls": ["*.skype.com"]})])
+        list_records, version = o365.get_endpoint_set("Worldwide", "guid", "2020080100")
+        self.assertEqual(self.list_requests, ["changes"])
+        self.assertEqual(version, "2020080100")
+        self.assertIn("*.skype.com", [record for record in list_records if record["id"] == 12][0]["urls"])
+
+    def assert_full_request(self, version_latest="2020080100"):
+        self.dict_responses["endpoints"] = (200, self.list_records)
+        self.assertEqual(o365.get_endpoint_set("Worldwide", "guid", version_latest), (self.list_records, version_latest))
+        self.assertEqual(self.list_requests[-1], "endpoints")
+
+    def test_full_request_without_state(self):
+        self.assert_full_request()
+        self.assertEqual(self.list_requests, ["endpoints"])
+
+    def test_full_request_when_changes_fail(self):
+        o365.save_state("Worldwide", "2020070100", self.list_records)
+        self.dict_responses["changes"] = (500, None)
+        self.assert_full_request()
+        self.assertEqual(self.list_requests, ["changes", "endpoints"])
+
+    def test_full_request_when_changes_do_not_reach_latest(self):
+        o365.save_state("Worldwide", "2020070100", self.list_records)
+        self.dict_responses["changes"] = (200, [change(900, 12, "change", add={"urls": ["*.skype.com"]})])
+        self.assert_full_request("2020090100")
+        self.assertEqual(self.list_requests, ["changes", "endpoints"])
+
+    def test_full_request_when_changes_do_not_fit(self):
+        o365.save_state("Worldwide", "2020070100", self.list_records)
+        self.dict_responses["changes"] = (200, [change(907, 500, "remove")])
+        self.assert_full_request()
+        self.assertEqual(self.list_requests, ["changes", "endpoints"])
+
+    def test_full_request_without_delta_sync(self):
+        self.set_option("use_delta_sync", 0)
+        o365.save_state("Worldwide", "2020070100", self.list_records)
+        self.assert_full_request()
+        self.assertEqual(self.list_requests, ["endpoints"])
+
+    def test_unusable_state(self):
+        f = open(o365.file_o365_state % "Worldwide", "w")
+        f.write('{"version": "2020070100", "endpoints": {}}')
+        f.close()
+        self.assert_full_request()
+        self.assertEqual(self.list_requests, ["endpoints"])
+
+    def test_endpoints_request_failed(self):
+        self.dict_responses["endpoints"] = (503, None)
+        self.assertEqual(o365.get_endpoint_set("Worldwide", "guid", "2020080100"), None)
+
+if __name__ == "__main__":
+    unittest.main()
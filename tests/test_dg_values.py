@@ -0,0 +1,97 @@
+import random
+import unittest
+
+from support import O365TestCase, o365, load_data
+
+def parse_value(value):
+    # Data Group value "ids;category;tcpPorts;udpPorts" -> detail
+    ids, category, tcp_ports, udp_ports = value.split(";")
+    return (set([int(id) for id in ids.split(",")]), "OAD".index(category), o365.parse_port_ranges(tcp_ports),
+            o365.parse_port_ranges(udp_ports))
+
+def record(id, category, tcp_ports, urls=(), ips=()):
+    return {"id": id, "serviceArea": "Common", "category": category, "required": True, "tcpPorts": tcp_ports,
+            "urls": list(urls), "ips": list(ips)}
+
+list_records_nested = [record(1, "Allow", "443", urls=["office.com", "a.b.office.com", "*.c.office.com"]),
+                       record(2, "Optimize", "80", urls=["b.office.com", "x.c.office.com"]),
+                       record(3, "Default", "8080", urls=["*.office.com"]),
+                       record(4, "Allow", "443", ips=["10.0.0.0/16", "2603:1006::/40"]),
+                       record(5, "Optimize", "80", ips=["10.0.1.0/24", "10.0.2.0/24", "2603:1006::/48"])]
+
+class DataGroupValuesTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.set_option("dg_value_mode", 1)
+        self.set_option("use_ipv6", 1)
+
+    def build(self, list_records):
+        # Data Group name -> entries and values
+        objects = o365.build_objects("Worldwide", "", list_records, "2020070100", False)
+        dict_dgs = {}
+        for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]:
+            dict_dgs[dg_name] = dict([line.rstrip(",").replace("network ", "").split(" := ") for line in dg_content.splitlines()])
+            for entry in dict_dgs[dg_name]:
+                dict_dgs[dg_name][entry] = dict_dgs[dg_name][entry].strip('"')
+        return dict_dgs
+
+    def assert_covering_values_merged(self, dict_values, list_covering):
+        # The value of each entry already holds the values of the entries covering it, so any one match decides
+        for entry, entry_covering in list_covering:
+            detail = parse_value(dict_values[entry])
+            self.assertEqual(o365.format_detail(o365.merge_details(detail, parse_value(dict_values[entry_covering]))),
+                             dict_values[entry], entry + " covered by " + entry_covering)
+
+    def test_values(self):
+        dict_dgs = self.build(load_data("endpoints.json"))
+        self.assertEqual(dict_dgs["o365_url_dg"]["outlook.office.com"], "1,2,46;O;80,443;")
+        self.assertEqual(dict_dgs["o365_url_dg"]["teams.microsoft.com"], "12;A;443;3478-3481")
+        self.assertEqual(dict_dgs["o365_ipv4_dg"]["52.112.0.0/14"], "11,12;O;443;3478-3481")
+        self.assertEqual(dict_dgs["o365_ipv6_dg"]["2603:1063::/39"], "11;O;;3478-3481")
+
+    def test_url_covering_values(self):
+        for url_dg_reduce in (0, 1):
+            self.set_option("url_dg_reduce", url_dg_reduce)
+            dict_values = self.build(list_records_nested)["o365_url_dg"]
+            list_covering = [(entry, entry_covering) for entry in dict_values for entry_covering in dict_values
+                             if entry != entry_covering and entry.endswith(entry_covering)]
+            self.assertTrue(len(list_covering) >= 3)
+            self.assert_covering_values_merged(dict_values, list_covering)
+
+        # a.b.office.com is dropped, as office.com with the same value covers it.  Its host still matches
+        # b.office.com, which holds the ports of office.com.
+        self.assertNotIn("a.b.office.com", dict_values)
+        self.assertEqual(dict_values["b.office.com"], "1,2,3;O;80,443,8080;")
+
+    def test_ip_covering_values(self):
+        for ip_aggregate in (0, 1):
+            self.set_option("ip_aggregate", ip_aggregate)
+            dict_dgs = self.build(list_records_nested)
+            self.assertEqual(dict_dgs["o365_ipv4_dg"]["10.0.1.0/24"], "4,5;O;80,443;")
+            self.assertEqual(dict_dgs["o365_ipv4_dg"]["10.0.0.0/16"], "4;A;443;")
+            self.assertEqual(dict_dgs["o365_ipv6_dg"]["2603:1006::/48"], "4,5;O;80,443;")
+
+    def test_no_supernets(self):
+        # The entry limit is left alone, so that no address takes in the ports of a network it is not in
+        dict_dgs = self.build(list_records_nested)
+        self.set_option("ip_aggregate_max_entries", 1)
+        self.set_option("ip_aggregate_max_overcoverage", 1.0)
+        self.assertEqual(self.build(list_records_nested), dict_dgs)
+
+    def test_random_url_covering_values(self):
+        generator = random.Random(1)
+        list_labels = ["com", "office", "outlook", "a", "b"]
+        for round in range(20):
+            list_records = []
+            for id in range(1, 9):
+                list_urls = [generator.choice(["", "*."]) + ".".join([generator.choice(list_labels) for index in range(generator.randint(1, 3))])
+                             for count in range(3)]
+                list_records.append(record(id, generator.choice(["Optimize", "Allow", "Default"]), generator.choice(["80", "443", "80,443"]),
+                                           urls=list_urls))
+            dict_values = self.build(list_records)["o365_url_dg"]
+            self.assert_covering_values_merged(dict_values, [(entry, entry_covering) for entry in dict_values for entry_covering in dict_values
+                                                             if entry != entry_covering and entry.endswith(entry_covering)])
+
+if __name__ == "__main__":
+    unittest.main()
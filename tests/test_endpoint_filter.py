@@ -0,0 +1,75 @@
+import unittest
+
+from support import O365TestCase, o365, load_data
+
+class EndpointFilterTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.list_records = load_data("endpoints.json")
+        self.set_option("compiled_endpoint_filter", None)
+
+    def actions(self, list_rules):
+        # Action of the first matching rule for each endpoint set id, None if no rule matches
+        self.set_option("endpoint_filter_rules", list_rules)
+        list_filter = o365.compile_endpoint_filter()
+        dict_actions = {}
+        for record in self.list_records:
+            dict_actions[record["id"]] = None
+            for description, action, list_tests in list_filter:
+                if all([test(record) for test in list_tests]):
+                    dict_actions[record["id"]] = action
+                    break
+        return dict_actions
+
+    def ids(self, dict_actions, action):
+        return sorted([id for id in dict_actions if dict_actions[id] == action])
+
+    def records_where(self, function):
+        return sorted([record["id"] for record in self.list_records if function(record)])
+
+    def test_first_match_decides(self):
+        dict_actions = self.actions([{"serviceArea": ["Exchange"], "action": "exclude"},
+                                     {"category": ["Optimize", "Allow"]}])
+        self.assertEqual(self.ids(dict_actions, "exclude"), self.records_where(lambda record: record["serviceArea"] == "Exchange"))
+        self.assertEqual(self.ids(dict_actions, "include"),
+                         self.records_where(lambda record: record["serviceArea"] != "Exchange" and record["category"] in ("Optimize", "Allow")))
+        self.assertEqual(self.ids(dict_actions, None),
+                         self.records_where(lambda record: record["serviceArea"] != "Exchange" and record["category"] == "Default"))
+
+        # The same rules the other way around: Exchange Optimize & Allow sets are included first
+        dict_actions = self.actions([{"category": ["Optimize", "Allow"]},
+                                     {"serviceArea": ["Exchange"], "action": "exclude"}])
+        self.assertEqual(self.ids(dict_actions, "include"), self.records_where(lambda record: record["category"] in ("Optimize", "Allow")))
+
+    def test_exclude_then_include_all(self):
+        dict_actions = self.actions([{"required": False, "action": "exclude"}, {}])
+        self.assertEqual(self.ids(dict_actions, "exclude"), self.records_where(lambda record: not record.get("required", False)))
+        self.assertEqual(self.ids(dict_actions, None), [])
+
+    def test_port_ranges(self):
+        self.list_records.append({"id": 99, "serviceArea": "Common", "category": "Default", "required": False, "tcpPorts": "443,8000-8100"})
+        self.assertEqual(self.ids(self.actions([{"tcpPorts": [8080]}]), "include"), [99])
+        self.assertEqual(self.ids(self.actions([{"tcpPorts": [8101, 7999]}]), "include"), [])
+        self.assertEqual(self.ids(self.actions([{"udpPorts": [3479]}]), "include"), [11, 12])
+
+        # Any of the ports is enough, and all keys of the rule must match
+        self.assertEqual(self.ids(self.actions([{"tcpPorts": [80, 8000]}]), "include"), [1, 2, 8, 31, 46, 99])
+        self.assertEqual(self.ids(self.actions([{"tcpPorts": [80], "serviceArea": ["Exchange"]}]), "include"), [1, 2, 8])
+
+    def test_care_options_without_rules(self):
+        self.set_option("care_skype", 0)
+        self.set_option("care_yammer", 0)
+        dict_actions = self.actions([])
+        self.assertEqual(self.ids(dict_actions, "include"),
+                         self.records_where(lambda record: record["serviceArea"] in ("Common", "Exchange", "SharePoint")))
+        self.assertEqual(self.ids(dict_actions, "exclude"), [])
+
+    def test_invalid_rules(self):
+        for rule in ({"category": "Optimize"}, {"serviceArea": "Exchange"}, {"tcpPorts": 443},
+                     {"action": "drop"}, {"categories": ["Optimize"]}):
+            self.set_option("endpoint_filter_rules", [rule])
+            self.assertRaises(ValueError, o365.compile_endpoint_filter)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# Tests of the incremental JSON parser, and of the objects built from an endpoint list against golden files.
+# After an intended change of the output, regenerate the golden file and review its diff:
+#   python tests/test_endpoint_stream.py --update
+import sys
+import json
+import hashlib
+import itertools
+import os
+import unittest
+
+from support import O365TestCase, o365, data_directory
+
+file_golden = os.path.join(data_directory, "build_golden.json")
+list_golden_options = ["dg_value_mode", "url_dg_reduce", "url_dg_label_boundary", "ip_aggregate", "use_pac"]
+
+def chunked(text, size):
+    return [text[position:position + size] for position in range(0, len(text), size)]
+
+def build_golden(module, records):
+    # Objects built with each combination of list_golden_options: {"combos": {combination: {object: hash}},
+    # "contents": {hash: content}}.  records() returns the endpoint sets for each build.
+    dict_golden = {"combos": {}, "contents": {}}
+    dict_saved = dict([(name, getattr(module, name)) for name in list_golden_options + ["use_url", "use_ipv6"]])
+    try:
+        module.use_url = module.use_ipv6 = 1
+        for values in itertools.product((0, 1), repeat=len(list_golden_options)):
+            for name, value in zip(list_golden_options, values):
+                setattr(module, name, value)
+            objects = module.build_objects("Worldwide", "", records(), "2020070100", False)
+            dict_contents = dict([(dg_name, dg_content) for dg_name, dg_type, dg_file_name, dg_content in objects["dgs"]])
+            dict_url_category = objects["url_category_entries"]
+            dict_contents["url_category"] = "".join([url + " " + dict_url_category[url] + "\n" for url in sorted(dict_url_category)])
+            if objects["pac"] is not None:
+                dict_contents["pac"] = objects["pac"][1]
+            dict_combo = {}
+            for key in dict_contents:
+                digest = hashlib.sha1(dict_contents[key]).hexdigest()
+                dict_golden["contents"][digest] = dict_contents[key]
+                dict_combo[key] = digest
+            dict_golden["combos"][",".join(["%s=%d" % item for item in zip(list_golden_options, values)])] = dict_combo
+    finally:
+        for name in dict_saved:
+            setattr(module, name, dict_saved[name])
+    return dict_golden
+
+def read_endpoints_golden():
+    f = open(os.path.join(data_directory, "endpoints_golden.json"), "r")
+    text = f.read()
+    f.close()
+    return text
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    def test_every_chunk_size(self):
+        text = read_endpoints_golden()
+        list_expected = json.loads(text)
+        for size in range(1, 40) + [4096, len(text)]:
+            self.assertEqual(list(o365.iter_json_array(chunked(text, size))), list_expected, size)
+
+    def test_every_split_position(self):
+        text = ' [ {"a": "x,]\\"y"}, 12.5e3 , -7, true,null ,"\\u00e9", [1, [2]], {} ] '
+        for position in range(len(text) + 1):
+            self.assertEqual(o365.read_json_array([text[:position], text[position:]]), json.loads(text), position)
+
+    def test_empty_array(self):
+        self.assertEqual(o365.read_json_array(["[", " ", "]"]), [])
+        self.assertEqual(o365.read_json_array(["[]"]), [])
+
+    def test_elements_before_end(self):
+        # Elements are yielded as soon as they are complete, before the rest arrives
+        elements = o365.iter_json_array(iter(['[{"id": 1}, {"id"', ': 2}', ']']))
+        self.assertEqual(next(elements), {"id": 1})
+        self.assertEqual(next(elements), {"id": 2})
+        self.assertEqual(list(elements), [])
+
+    def test_malformed(self):
+        for text in ('{"id": 1}', '[{"id": 1} {"id": 2}]', '[{"id": 1},, {"id": 2}]', '[{"id": }]', 'x', '[1, 2',
+                     '[{"id": 1}', '', '[', '["abc'):
+            for size in (1, 3, 100):
+                self.assertRaises(ValueError, o365.read_json_array, chunked(text, size))
+
+class BuildGoldenTest(O365TestCase):
+
+    def test_objects_match_golden(self):
+        f = open(file_golden, "r")
+        dict_expected = json.load(f)
+        f.close()
+        # The endpoint list is parsed as it arrives in small chunks
+        dict_golden = build_golden(o365, lambda: o365.iter_json_array(chunked(read_endpoints_golden(), 7)))
+        self.assertEqual(sorted(dict_golden["combos"]), sorted(dict_expected["combos"]))
+        for combo in sorted(dict_expected["combos"]):
+            dict_objects = dict_golden["combos"][combo]
+            dict_objects_expected = dict_expected["combos"][combo]
+            self.assertEqual(sorted(dict_objects), sorted(dict_objects_expected), combo)
+            for key in sorted(dict_objects_expected):
+                self.assertEqual(dict_golden["contents"][dict_objects[key]], dict_expected["contents"][dict_objects_expected[key]],
+                                 combo + ": " + key)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--update"]:
+        o365.log_dest_file = os.devnull
+        dict_golden = build_golden(o365, lambda: json.loads(read_endpoints_golden()))
+        f = open(file_golden, "w")
+        json.dump(dict_golden, f, indent=1, sort_keys=True)
+        f.write("\n")
+        f.close()
+        print "Wrote " + file_golden + ": " + str(len(dict_golden["combos"])) + " combinations, " + str(len(dict_golden["contents"])) + " distinct objects"
+    else:
+        unittest.main()
@@ -0,0 +1,82 @@
+import copy
+import unittest
+
+from support import O365TestCase, o365, load_data
+
+class ApplyObjectsFingerprintTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.fake_tmsh()
+        self.set_option("use_url", 1)
+        self.set_option("ha_config", 1)
+        self.list_records = load_data("endpoints.json")
+
+    def build(self, version="2020070100", list_records=None):
+        if list_records is None:
+            list_records = self.list_records
+        return [o365.build_objects("Worldwide", "", copy.deepcopy(list_records), version)]
+
+    def apply(self, list_objects):
+        # Commands other than the existence checks, run by apply_objects()
+        count_invocations = len(self.tmsh_invocations())
+        o365.metrics_start()
+        o365.save_url_category_state(o365.apply_objects(list_objects))
+        list_commands = []
+        for list_invocation_commands in self.tmsh_invocations()[count_invocations:]:
+            list_commands.extend([command for command in list_invocation_commands
+                                  if not command.startswith("list ") and not command.startswith("run util bash")])
+        return list_commands
+
+    def commands_starting(self, list_commands, prefix):
+        return [command for command in list_commands if command.startswith(prefix)]
+
+    def test_unchanged_skips_import_save_and_sync(self):
+        list_commands = self.apply(self.build())
+        self.assertEqual(len(self.commands_starting(list_commands, "modify sys file data-group ")), 2)
+        self.assertTrue(self.commands_starting(list_commands, "modify sys url-db url-category "))
+        self.assertEqual(self.commands_starting(list_commands, "save sys config"), ["save sys config"])
+        self.assertEqual(len(self.commands_starting(list_commands, "run cm config-sync ")), 1)
+
+        self.assertEqual(self.apply(self.build()), [])
+
+    def test_version_entry_alone_leaves_category(self):
+        self.apply(self.build("2020070100"))
+        list_commands = self.apply(self.build("2020080100"))
+        self.assertEqual(self.commands_starting(list_commands, "modify sys url-db url-category "), [])
+
+    def test_changed_data_group_imported_alone(self):
+        self.apply(self.build())
+        list_records = copy.deepcopy(self.list_records)
+        list_records[0]["ips"].append("198.51.100.0/24")
+        list_commands = self.apply(self.build(list_records=list_records))
+        self.assertEqual(self.commands_starting(list_commands, "modify sys file data-group "),
+                         ["modify sys file data-group o365_ipv4_dg_object source-path file:" + o365.dg_file_name_ip4])
+        self.assertEqual(self.commands_starting(list_commands, "modify sys url-db url-category "), [])
+        self.assertEqual(self.commands_starting(list_commands, "save sys config"), ["save sys config"])
+
+    def test_forced_refresh_imports_again(self):
+        self.apply(self.build())
+        self.set_option("force_o365_record_refresh", 1)
+        list_commands = self.apply(self.build())
+        self.assertEqual(len(self.commands_starting(list_commands, "modify sys file data-group ")), 2)
+        self.assertTrue([command for command in list_commands if "replace-all-with" in command])
+        self.assertEqual(self.commands_starting(list_commands, "save sys config"), ["save sys config"])
+
+    def test_failed_save_clears_fingerprints(self):
+        self.apply(self.build())
+        self.assertTrue(o365.load_fingerprints())
+
+        list_records = copy.deepcopy(self.list_records)
+        list_records[0]["ips"].append("198.51.100.0/24")
+        self.fake_tmsh([("save sys config", "01070711:3: Caught exception saving configuration", True)])
+        self.apply(self.build(list_records=list_records))
+        self.assertEqual(o365.load_fingerprints(), {})
+
+        # Everything is imported again by the next run
+        self.fake_tmsh()
+        list_commands = self.apply(self.build(list_records=list_records))
+        self.assertEqual(len(self.commands_starting(list_commands, "modify sys file data-group ")), 2)
+
+if __name__ == "__main__":
+    unittest.main()
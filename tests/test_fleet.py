@@ -0,0 +1,127 @@
+import json
+import threading
+import unittest
+
+from support import O365TestCase, o365, load_data
+import o365_fleet
+import o365_benchmark
+
+class DeviceHandler(o365_benchmark.IControlRestHandler):
+    # The stand-in device of the benchmark, counting the requests, with a settable failover status
+    # and requests made to fail: server.fail holds (method, path) -> status
+
+    def handle_rest(self, method):
+        server = self.server
+        path = self.path.split("?")[0]
+        with server.lock:
+            server.requests.append((method, path))
+        if (method, path) in server.fail:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            return self.reply(server.fail[(method, path)], {"code": server.fail[(method, path)], "message": "Failed for the test"})
+        if method == "GET" and path == "/mgmt/tm/cm/failover-status":
+            return self.reply(200, {"entries": {"https://localhost/mgmt/tm/cm/failover-status/0": {
+                "nestedStats": {"entries": {"status": {"description": server.failover_status}}}}}})
+        o365_benchmark.IControlRestHandler.handle_rest(self, method)
+
+class FleetTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.set_option("use_url", 1)
+        self.addCleanup(setattr, o365_fleet, "fleet_scheme", o365_fleet.fleet_scheme)
+        self.addCleanup(setattr, o365_fleet, "file_fleet_state", o365_fleet.file_fleet_state)
+        o365_fleet.fleet_scheme = "http"
+        o365_fleet.file_fleet_state = self.directory + "/o365_fleet_state.json"
+        self.list_objects = [o365.build_objects("Worldwide", "", load_data("endpoints.json"), "2020070100", False)]
+
+    def device(self, failover_status="ACTIVE", **kwargs):
+        server = o365_benchmark.IControlRestStandIn(0)
+        server.RequestHandlerClass = DeviceHandler
+        server.requests = []
+        server.fail = {}
+        server.failover_status = failover_status
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        device = {"host": "127.0.0.1:" + str(server.server_address[1]), "user": "admin", "password": "secret"}
+        device.update(kwargs)
+        return device, server
+
+    def test_first_push_creates_objects(self):
+        device, server = self.device()
+        result = o365_fleet.push_device(device, self.list_objects, {})
+        self.assertEqual((result["result"], result["error"]), ("updated", None))
+        self.assertEqual(sorted(result["objects"]), ["Office365", "o365_ipv4_dg", "o365_ipv4_dg_object", "o365_url_dg", "o365_url_dg_object"])
+        self.assertIn(("POST", "/mgmt/tm/sys/config"), server.requests)
+
+        # The uploaded files hold the Data Group content, the URL category the entries
+        for dg_name, dg_type, dg_file_name, dg_content in self.list_objects[0]["dgs"]:
+            self.assertEqual(server.dict_files[dg_file_name.rsplit("/", 1)[1]], dg_content)
+            self.assertEqual(server.dict_collections["/mgmt/tm/ltm/data-group/external"][dg_name]["externalFileName"], dg_name + "_object")
+        dict_category = server.dict_collections["/mgmt/tm/sys/url-db/url-category"]["Office365"]
+        self.assertEqual(dict([(item["name"], item["type"]) for item in dict_category["urls"]]), self.list_objects[0]["url_category_entries"])
+
+    def test_unchanged_objects_skipped(self):
+        device, server = self.device()
+        result = o365_fleet.push_device(device, self.list_objects, {})
+        del server.requests[:]
+        result = o365_fleet.push_device(device, self.list_objects, result["fingerprints"])
+        self.assertEqual((result["result"], result["objects"]), ("unchanged", []))
+        self.assertEqual([method for method, path in server.requests], ["GET", "GET", "GET"])
+
+    def test_version_entry_alone_not_pushed(self):
+        device, server = self.device()
+        result = o365_fleet.push_device(device, self.list_objects, {})
+        list_objects = [o365.build_objects("Worldwide", "", load_data("endpoints.json"), "2020080100", False)]
+        self.assertEqual(o365.url_category_fingerprint(list_objects[0]), o365.url_category_fingerprint(self.list_objects[0]))
+        result = o365_fleet.push_device(device, list_objects, result["fingerprints"])
+        self.assertEqual(result["result"], "unchanged")
+
+    def test_standby_member_skipped(self):
+        device, server = self.device("STANDBY", device_group="device-group1")
+        result = o365_fleet.push_device(device, self.list_objects, {})
+        self.assertEqual(result["result"], "standby")
+        self.assertEqual(server.requests, [("GET", "/mgmt/tm/cm/failover-status")])
+
+    def test_active_member_synced(self):
+        device, server = self.device(device_group="device-group1")
+        self.assertEqual(o365_fleet.push_device(device, self.list_objects, {})["result"], "updated")
+        self.assertEqual(server.requests[-1], ("POST", "/mgmt/tm/cm"))
+
+    def test_failed_save_keeps_fingerprints(self):
+        device, server = self.device()
+        server.fail[("POST", "/mgmt/tm/sys/config")] = 500
+        result = o365_fleet.push_device(device, self.list_objects, {})
+        self.assertEqual(result["result"], "failed")
+        self.assertIn("Configuration save failed: HTTP 500", result["error"])
+        self.assertEqual(result["fingerprints"], {})
+
+    def test_fleet_update(self):
+        list_records = load_data("endpoints.json")
+
+        def fake_get(host, uri, use_cache=True, consume=None):
+            if uri.startswith(o365.uri_ms_o365_version):
+                body = json.dumps([{"instance": "Worldwide", "latest": "2020070100"}])
+            else:
+                body = json.dumps(list_records)
+            if consume is None:
+                return 200, body
+            return 200, consume(iter([body]))
+        self.set_option("ms_web_service_get", fake_get)
+
+        device_ok, server_ok = self.device()
+        device_failed, server_failed = self.device()
+        server_failed.fail[("POST", "/mgmt/tm/sys/config")] = 500
+        list_results = o365_fleet.fleet_update([device_ok, device_failed])
+        self.assertEqual([result["result"] for result in list_results], ["updated", "failed"])
+
+        # Only the device updated has the fingerprints of its objects.  The endpoint list is kept for the next run.
+        dict_state = o365_fleet.load_fleet_state()
+        self.assertEqual(len(dict_state[device_ok["host"]]), 3)
+        self.assertEqual(dict_state[device_failed["host"]], {})
+        self.assertEqual(o365.load_state("Worldwide")["endpoints"], list_records)
+
+if __name__ == "__main__":
+    unittest.main()
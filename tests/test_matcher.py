@@ -0,0 +1,137 @@
+import random
+import socket
+import struct
+import unittest
+
+from support import O365TestCase, o365, load_data
+import o365_matcher
+
+def ends_with_match(host, list_entries, label_boundary):
+    # Longest entry the host ends with, as "class match $host ends_with" finds it
+    if label_boundary:
+        host = "." + host
+    list_matched = [entry for entry in list_entries if host.endswith(entry)]
+    if not list_matched:
+        return None
+    return max(list_matched, key=len)
+
+def int_to_address(value, bits):
+    if bits == 32:
+        return socket.inet_ntop(socket.AF_INET, struct.pack("!I", value))
+    return socket.inet_ntop(socket.AF_INET6, struct.pack("!QQ", value >> 64, value & (1 << 64) - 1))
+
+def ports_match(ports, port):
+    for part in ports.split(","):
+        first, last = (part.split("-") + [part])[:2]
+        if int(first) <= port <= int(last):
+            return True
+    return False
+
+class HostIndexTest(unittest.TestCase):
+
+    def test_same_hosts_matched(self):
+        generator = random.Random(1)
+        list_labels = ["com", "office", "outlook", "a", "b", "xoffice", "net"]
+        for label_boundary in (0, 1):
+            for round in range(50):
+                index = o365_matcher.HostIndex(label_boundary)
+                list_entries = []
+                for count in range(30):
+                    entry = ".".join([generator.choice(list_labels) for position in range(generator.randint(1, 4))])
+                    entry = (generator.choice(["", "."]) if not label_boundary else ".") + entry
+                    list_entries.append(entry)
+                    index.add(entry, str(count))
+                for count in range(50):
+                    host = ".".join([generator.choice(list_labels) for position in range(generator.randint(1, 5))])
+                    entry = ends_with_match(host, list_entries, label_boundary)
+                    matched = index.lookup(host)
+                    self.assertEqual(matched and matched[0], entry, host)
+
+    def test_label_boundary(self):
+        index = o365_matcher.HostIndex(1)
+        index.add(".office.com", "1")
+        self.assertEqual(index.lookup("office.com"), (".office.com", "1"))
+        self.assertEqual(index.lookup("www.office.com"), (".office.com", "1"))
+        self.assertEqual(index.lookup("xoffice.com"), None)
+
+        # Without the label boundary, "office.com" is a plain suffix
+        index = o365_matcher.HostIndex(0)
+        index.add("office.com", "1")
+        self.assertEqual(index.lookup("xoffice.com"), ("office.com", "1"))
+        self.assertEqual(index.lookup("office.com.example"), None)
+
+class NetworkIndexTest(unittest.TestCase):
+
+    def check_longest_prefix(self, bits, base, span, prefix_min):
+        generator = random.Random(bits)
+        for round in range(30):
+            index = o365_matcher.NetworkIndex(bits)
+            dict_networks = {}
+            for count in range(generator.randint(1, 40)):
+                prefix_len = generator.randint(prefix_min, bits)
+                network = int_to_address(base + generator.randint(0, span), bits) + "/" + str(prefix_len)
+                index.add(network, str(count))
+                first, prefix_len, network_bits = o365.ip_network_to_int(network)
+                dict_networks[(first, prefix_len)] = (network, str(count))
+            index.build()
+            for count in range(200):
+                value = base + generator.randint(-16, span + 16)
+                list_matched = [key for key in dict_networks if value >> (bits - key[1]) == key[0] >> (bits - key[1])]
+                expected = dict_networks[max(list_matched, key=lambda key: key[1])] if list_matched else None
+                self.assertEqual(index.lookup(value), expected, int_to_address(value, bits))
+
+    def test_ipv4(self):
+        self.check_longest_prefix(32, o365.ip_network_to_int("10.0.0.0")[0], 1 << 12, 18)
+
+    def test_ipv6(self):
+        self.check_longest_prefix(128, o365.ip_network_to_int("2603:1006::")[0], 1 << 12, 114)
+
+class ParseTargetTest(unittest.TestCase):
+
+    def test_tokens(self):
+        for token, expected in (("https://Outlook.Office.com:8443/owa?x=1", ("outlook.office.com", 8443)),
+                                ("https://outlook.office.com/owa", ("outlook.office.com", 443)),
+                                ("http://user@www.office.com/", ("www.office.com", 80)),
+                                ("outlook.office.com:443", ("outlook.office.com", 443)),
+                                ("outlook.office.com.", ("outlook.office.com", None)),
+                                ("[2603:1006::1]:443", ("2603:1006::1", 443)),
+                                ("2603:1006::1", ("2603:1006::1", None)),
+                                ("13.107.6.152", ("13.107.6.152", None)),
+                                ("13.107.6.152:80", ("13.107.6.152", 80)),
+                                ("host:notaport", ("host", None))):
+            self.assertEqual(o365_matcher.parse_target(token), expected, token)
+
+class PortAllowedTest(unittest.TestCase):
+
+    def test_same_ports_allowed(self):
+        generator = random.Random(1)
+        for round in range(100):
+            list_parts = []
+            for count in range(generator.randint(1, 4)):
+                first = generator.randint(1, 100)
+                list_parts.append(str(first) if generator.random() < 0.5 else str(first) + "-" + str(first + generator.randint(0, 10)))
+            ports = ",".join(list_parts)
+            value = "12;Optimize;" + ports + ";3478-3481"
+            for port in range(0, 120):
+                self.assertEqual(o365_matcher.port_allowed(value, port), ports_match(ports, port), value + " " + str(port))
+
+    def test_not_checked(self):
+        self.assertTrue(o365_matcher.port_allowed("1", 8443))
+        self.assertTrue(o365_matcher.port_allowed("12;Optimize;443;", None))
+
+class MatcherTest(O365TestCase):
+
+    def test_endpoints(self):
+        self.set_option("use_url", 0)
+        self.set_option("use_url_dg", 1)
+        self.set_option("use_ipv4", 1)
+        self.set_option("use_ipv6", 1)
+        matcher = o365_matcher.Matcher()
+        matcher.load_endpoints(load_data("endpoints.json"), "2020070100")
+        self.assertTrue(matcher.classify("https://www.office.com/")[4])
+        self.assertTrue(matcher.classify("13.107.6.153")[4])
+        self.assertFalse(matcher.classify("https://www.example.com/")[4])
+        self.assertEqual(matcher.classify("999.1.1.1")[0], None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import os
+import sys
+import copy
+import json
+import unittest
+import StringIO
+
+from support import O365TestCase, o365, load_data
+
+def change(id, endpoint_set_id, disposition, version="2020080100", **kwargs):
+    dict_change = {"id": id, "endpointSetId": endpoint_set_id, "disposition": disposition, "version": version}
+    dict_change.update(kwargs)
+    return dict_change
+
+class SnapshotTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.fake_tmsh()
+        self.set_option("ms_o365_instances", ["Worldwide"])
+        self.list_records = load_data("endpoints.json")
+
+    def build(self, list_records, version):
+        objects = o365.build_objects("Worldwide", "", copy.deepcopy(list_records), version)
+        return [objects], {"Worldwide": (list_records, version)}
+
+    def create(self, list_records, version):
+        list_objects, dict_endpoint_sets = self.build(list_records, version)
+        return o365.snapshot_create(list_objects, dict_endpoint_sets)
+
+    def blobs(self):
+        return set(os.listdir(os.path.join(o365.directory_o365_snapshots, "objects")))
+
+    def records_changed(self):
+        list_records = copy.deepcopy(self.list_records)
+        list_records[0]["ips"] = list_records[0].get("ips", []) + ["198.51.100.0/24"]
+        return list_records
+
+    def test_restore(self):
+        self.set_option("use_url", 1)
+        list_objects, dict_endpoint_sets = self.build(self.list_records, "2020070100")
+        snapshot_id = o365.snapshot_create(list_objects, dict_endpoint_sets)
+        manifest = o365.snapshot_load(snapshot_id)
+        self.assertEqual(manifest["result"], "built")
+        self.assertEqual(manifest["versions"], {"Worldwide": "2020070100"})
+        list_objects_restored, dict_endpoint_sets_restored = o365.snapshot_restore(manifest)
+        self.assertEqual(dict_endpoint_sets_restored, dict_endpoint_sets)
+        for name in ("label", "url_category", "url_category_entries", "dgs"):
+            self.assertEqual(list_objects_restored[0][name], list_objects[0][name])
+        self.assertTrue(list_objects_restored[0]["url_category_entries"])
+
+    def test_prune_unreferenced_blobs(self):
+        self.set_option("snapshot_keep", 2)
+        snapshot_id_first = self.create(self.list_records, "2020070100")
+        set_blobs_first = self.blobs()
+        list_records = self.records_changed()
+        snapshot_id_second = self.create(list_records, "2020080100")
+        set_blobs_second = self.blobs() - set_blobs_first
+        list_records = copy.deepcopy(list_records)
+        list_records[0]["ips"].append("203.0.113.0/24")
+        snapshot_id_third = self.create(list_records, "2020090100")
+        self.assertEqual([manifest["id"] for manifest in o365.snapshot_list()], [snapshot_id_second, snapshot_id_third])
+
+        # The blobs only the first snapshot referred to are gone, those shared with the others are kept
+        set_blobs = self.blobs()
+        self.assertTrue(set_blobs_second <= set_blobs)
+        set_digests = set()
+        for manifest in o365.snapshot_list():
+            o365.snapshot_restore(manifest)
+            set_digests.update(manifest["endpoints"].values())
+            for snapshot_objects in manifest["objects"]:
+                set_digests.update([dg["content"] for dg in snapshot_objects["dgs"]])
+        self.assertEqual(set_blobs, set([digest + ".gz" for digest in set_digests]))
+        self.assertTrue(set_blobs_first - set_blobs)
+        self.assertTrue(set_blobs_first & set_blobs)
+
+    def test_load_missing_or_ambiguous(self):
+        self.create(self.list_records, "2020070100")
+        self.create(self.records_changed(), "2020080100")
+        with self.assertRaises(ValueError) as context:
+            o365.snapshot_load("19990101")
+        self.assertIn("not found", str(context.exception))
+        with self.assertRaises(ValueError) as context:
+            o365.snapshot_load("")
+        self.assertIn("ambiguous", str(context.exception))
+        self.assertRaises(ValueError, o365.rollback, "19990101")
+
+    def test_diff(self):
+        snapshot_id_a = self.create(self.list_records, "2020070100")
+        snapshot_id_b = self.create(self.records_changed(), "2020080100")
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            o365.diff_snapshots(snapshot_id_a, snapshot_id_b)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn("Worldwide: VERSION 2020070100 -> 2020080100\n", output)
+        self.assertIn("  Endpoint sets added: none\n", output)
+        self.assertIn("  Endpoint sets changed: " + str(self.list_records[0]["id"]) + "\n", output)
+        self.assertIn("  + network 198.51.100.0/24\n", output)
+        self.assertNotIn("  - ", output)
+
+class RollbackTest(O365TestCase):
+    # update -> update -> rollback -> skipped while pinned -> unpin -> delta update
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.fake_tmsh()
+        self.set_option("ms_o365_instances", ["Worldwide"])
+        self.set_option("ms_web_service_get", self.fake_get)
+        self.list_records = load_data("endpoints.json")
+        self.list_changes = [change(900, self.list_records[0]["id"], "change", add={"ips": ["198.51.100.0/24"]})]
+        self.version_latest = "2020070100"
+        self.list_requests = []
+
+    def fake_get(self, host, uri, use_cache=True, consume=None):
+        method = uri.split("/")[1].split("?")[0]
+        self.list_requests.append(method)
+        if method == "version":
+            body = [{"instance": "Worldwide", "latest": self.version_latest}]
+        elif method == "endpoints":
+            body = self.list_records if self.version_latest == "2020070100" else o365.apply_endpoint_changes(copy.deepcopy(self.list_records), self.list_changes)
+        else:
+            body = self.list_changes
+        if consume is None:
+            return 200, json.dumps(body)
+        return 200, consume(iter([json.dumps(body)]))
+
+    def state_version(self):
+        f = open(o365.file_o365_state % "Worldwide", "r")
+        version = json.load(f)["version"]
+        f.close()
+        return version
+
+    def update_once(self):
+        o365.metrics_start()
+        del self.list_requests[:]
+        return o365.update_once()
+
+    def test_rollback_and_unpin(self):
+        self.assertEqual(self.update_once(), "updated")
+        self.version_latest = "2020080100"
+        self.assertEqual(self.update_once(), "updated")
+        self.assertEqual(self.list_requests, ["version", "changes"])
+        list_manifests = o365.snapshot_list()
+        self.assertEqual([manifest["result"] for manifest in list_manifests], ["applied", "applied"])
+        self.assertEqual([manifest["versions"]["Worldwide"] for manifest in list_manifests], ["2020070100", "2020080100"])
+
+        # Rolled back to the first snapshot, which is pinned
+        o365.metrics_start()
+        self.assertEqual(o365.rollback(list_manifests[0]["id"][:17]), "updated")
+        self.assertEqual(o365.read_pin()["snapshot"], list_manifests[0]["id"])
+        self.assertEqual(o365.read_version_previous("Worldwide"), "2020070100")
+        self.assertEqual(self.state_version(), "2020070100")
+        list_objects = o365.snapshot_restore(list_manifests[0])[0]
+        for dg_name, dg_type, dg_file_name, dg_content in list_objects[0]["dgs"]:
+            f = open(dg_file_name, "r")
+            self.assertEqual(f.read(), dg_content)
+            f.close()
+
+        # No update while pinned
+        count_invocations = len(self.tmsh_invocations())
+        self.assertEqual(self.update_once(), "unchanged")
+        self.assertEqual(self.list_requests, [])
+        self.assertEqual(len(self.tmsh_invocations()), count_invocations)
+
+        # Unpinned, the next run updates to the latest VERSION with the changes since the rolled back one
+        o365.unpin()
+        self.assertEqual(o365.read_pin(), None)
+        self.assertEqual(self.update_once(), "updated")
+        self.assertEqual(self.list_requests, ["version", "changes"])
+        self.assertEqual(o365.read_version_previous("Worldwide"), "2020080100")
+        self.assertEqual(self.state_version(), "2020080100")
+
+if __name__ == "__main__":
+    unittest.main()
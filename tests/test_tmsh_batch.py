@@ -0,0 +1,69 @@
+import unittest
+
+from support import O365TestCase, o365
+
+class TmshBatchTest(O365TestCase):
+
+    def run_batch(self, list_commands):
+        batch = o365.TmshBatch()
+        list_ops = [batch.add(command) for command in list_commands]
+        batch.run()
+        return batch, list_ops
+
+    def test_output_split_per_command(self):
+        self.fake_tmsh([("list ltm data-group external a", "ltm data-group external a { }", False),
+                        ("list ltm data-group external b", "ltm data-group external b { }", False)])
+        batch, list_ops = self.run_batch(["list ltm data-group external a", "save sys config", "list ltm data-group external b"])
+        self.assertEqual([batch.ok(op) for op in list_ops], [True, True, True])
+        self.assertEqual([batch.output(op) for op in list_ops], ["ltm data-group external a { }", "", "ltm data-group external b { }"])
+        self.assertEqual(len(self.tmsh_invocations()), 1)
+
+    def test_failed_command_and_rest_run_again(self):
+        # tmsh stops at the failing command: it has no marker, and the commands after it go to the next process
+        self.fake_tmsh([("list sys url-db url-category missing", "01020036:3: The requested object was not found.", True)])
+        batch, list_ops = self.run_batch(["save sys config", "list sys url-db url-category missing", "save sys config"])
+        self.assertEqual([batch.ok(op) for op in list_ops], [True, False, True])
+        self.assertTrue(batch.output(list_ops[1]).startswith("01020036:3:"))
+        list_invocations = self.tmsh_invocations()
+        self.assertEqual(len(list_invocations), 2)
+        self.assertEqual(list_invocations[1], ["save sys config", 'run util bash -c "echo __o365_tmsh_2__"'])
+
+    def test_error_in_output_of_completed_command(self):
+        # Some commands print an error and let tmsh go on: the marker follows, the command still failed
+        self.fake_tmsh([("load sys config", "Syntax Error: \"bad\" unknown property", False)])
+        batch, list_ops = self.run_batch(["load sys config", "save sys config"])
+        self.assertEqual([batch.ok(op) for op in list_ops], [False, True])
+        self.assertEqual(len(self.tmsh_invocations()), 1)
+
+    def test_one_process_per_command_without_batching(self):
+        self.set_option("tmsh_batch", 0)
+        self.fake_tmsh([("modify bad", "01070712:3: Values specified are invalid", True)])
+        batch, list_ops = self.run_batch(["save sys config", "modify bad", "save sys config"])
+        self.assertEqual([batch.ok(op) for op in list_ops], [True, False, True])
+        self.assertEqual(self.tmsh_invocations(), [["save sys config"], ["modify bad"], ["save sys config"]])
+
+    def test_command_line_size_bound(self):
+        self.set_option("tmsh_max_script_bytes", 120)
+        self.fake_tmsh()
+        batch, list_ops = self.run_batch(["save sys config"] * 5)
+        self.assertEqual([batch.ok(op) for op in list_ops], [True] * 5)
+        list_invocations = self.tmsh_invocations()
+        self.assertTrue(len(list_invocations) > 1)
+        self.assertEqual(sum([len(commands) for commands in list_invocations]), 10)
+
+    def test_tmsh_failed(self):
+        self.assertTrue(o365.tmsh_failed("01020036:3: The requested URL category (/Common/x) was not found."))
+        self.assertTrue(o365.tmsh_failed("some output\nSyntax Error: \"urls\" unexpected argument"))
+        self.assertTrue(o365.tmsh_failed("Data Input Error: Invalid glob pattern"))
+        self.assertFalse(o365.tmsh_failed("sys url-db url-category Office365 {\n    display-name Office365\n}"))
+        self.assertFalse(o365.tmsh_failed(""))
+
+    def test_url_category_command_quotes_glob_entries(self):
+        command = o365.url_category_command("Office365", [("add", "https://*.lync.com/", "glob-match"),
+                                                          ("add", "https://outlook.office.com/", "exact-match"),
+                                                          ("delete", "https://*.teams.microsoft.com", "glob-match")])
+        self.assertEqual(command, 'modify sys url-db url-category Office365 urls add { "https://\\*.lync.com/" { type glob-match } }'
+                         ' urls add { https://outlook.office.com/ { type exact-match } } urls delete { "https://\\*.teams.microsoft.com" }')
+
+if __name__ == "__main__":
+    unittest.main()
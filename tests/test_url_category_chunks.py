@@ -0,0 +1,57 @@
+import unittest
+
+from support import O365TestCase, o365
+
+def changes(count, bad=()):
+    return [("add", "https://host%d.office.com/" % index if index not in bad else "https://badurl%d/" % index, "exact-match")
+            for index in range(count)]
+
+class UrlCategoryChunksTest(O365TestCase):
+
+    def test_entry_bound(self):
+        self.set_option("url_category_chunk_entries", 3)
+        list_chunks = o365.url_category_chunks(changes(8))
+        self.assertEqual([len(chunk) for chunk in list_chunks], [3, 3, 2])
+        self.assertEqual(sum(list_chunks, []), changes(8))
+
+    def test_byte_bound(self):
+        self.set_option("url_category_chunk_bytes", 200)
+        list_chunks = o365.url_category_chunks(changes(20))
+        self.assertEqual(sum(list_chunks, []), changes(20))
+        for chunk in list_chunks:
+            self.assertTrue(len(o365.url_category_command("Office365", chunk)) - len("modify sys url-db url-category Office365 ") <= 200)
+
+    def test_oversized_entry_alone(self):
+        self.set_option("url_category_chunk_bytes", 10)
+        self.assertEqual(o365.url_category_chunks(changes(2)), [[change] for change in changes(2)])
+
+class RetryUrlCategoryChunksTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.fake_tmsh([("badurl", "01070712:3: Values (BADURL) specified for url category are invalid", True)])
+
+    def test_rejected_entries_isolated(self):
+        list_changes = changes(8, bad=(2, 5))
+        list_applied, list_rejected = o365.retry_url_category_chunks([("Office365", list_changes)])
+        self.assertEqual(list_rejected, [("Office365", list_changes[2]), ("Office365", list_changes[5])])
+        list_entries_applied = sorted(sum([chunk for category_name, chunk in list_applied], []))
+        self.assertEqual(list_entries_applied, sorted([change for index, change in enumerate(list_changes) if index not in (2, 5)]))
+
+        # Halves of 4, 2 and 1 entries, one round each.  tmsh stops at each failing chunk, and the chunks after it
+        # run in the next process: 2 + 3 + 2 processes.
+        self.assertEqual(len(self.tmsh_invocations()), 2 + 3 + 2)
+
+    def test_failed_chunk_applied_in_halves(self):
+        # A chunk that failed once, e.g. while another object was changed, applies in halves
+        list_applied, list_rejected = o365.retry_url_category_chunks([("Office365", changes(4))])
+        self.assertEqual(list_rejected, [])
+        self.assertEqual(list_applied, [("Office365", changes(4)[:2]), ("Office365", changes(4)[2:])])
+
+    def test_single_entry_rejected_without_retry(self):
+        list_applied, list_rejected = o365.retry_url_category_chunks([("Office365", changes(1, bad=(0,)))])
+        self.assertEqual((list_applied, list_rejected), ([], [("Office365", changes(1, bad=(0,))[0])]))
+        self.assertEqual(self.tmsh_invocations(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import random
+import unittest
+
+from support import O365TestCase, o365, load_data
+
+def label_boundary_match(host, entry):
+    # "office.com" matches office.com and its subdomains, ".office.com" the subdomains only
+    if entry.startswith("."):
+        return host.endswith(entry)
+    return host == entry or host.endswith("." + entry)
+
+class ReduceUrlSuffixesTest(O365TestCase):
+
+    def test_covered_entries_dropped(self):
+        self.assertEqual(o365.reduce_url_suffixes(["office.com", "outlook.office.com", ".office.com", "a.b.office.com", "xoffice.com"]),
+                         ["office.com", "xoffice.com"])
+
+    def test_subdomains_entry_does_not_cover_domain(self):
+        self.assertEqual(o365.reduce_url_suffixes([".office.com", "office.com"]), ["office.com"])
+        self.assertEqual(o365.reduce_url_suffixes([".office.com", "a.office.com", "office.com.example"]), [".office.com", "office.com.example"])
+        self.assertEqual(o365.reduce_url_suffixes(["a.office.com", ".a.office.com", "b.a.office.com"]), ["a.office.com"])
+
+    def test_empty_entries_ignored(self):
+        self.assertEqual(o365.reduce_url_suffixes(["", ".", "com"]), ["com"])
+
+    def test_same_hosts_matched(self):
+        generator = random.Random(1)
+        list_labels = ["com", "office", "outlook", "a", "b", "xoffice", "net"]
+        for round in range(50):
+            list_entries = []
+            for count in range(30):
+                entry = ".".join([generator.choice(list_labels) for index in range(generator.randint(1, 4))])
+                list_entries.append(generator.choice(["", "."]) + entry)
+            list_reduced = o365.reduce_url_suffixes(list_entries)
+            self.assertTrue(set(list_reduced) <= set(list_entries))
+            for count in range(50):
+                host = ".".join([generator.choice(list_labels) for index in range(generator.randint(1, 5))])
+                self.assertEqual(any([label_boundary_match(host, entry) for entry in list_entries]),
+                                 any([label_boundary_match(host, entry) for entry in list_reduced]), host)
+
+    def test_url_data_group(self):
+        self.set_option("use_ipv4", 0)
+        objects = o365.build_objects("Worldwide", "", load_data("endpoints.json"), "2020070100", False)
+        list_entries = [line.split(" := ")[0] for line in objects["dgs"][0][3].splitlines()]
+        self.assertIn("office.com", list_entries)
+        self.assertIn(".outlook.com", list_entries)
+        self.assertNotIn("www.office.com", list_entries)
+        self.assertNotIn(".office.com", list_entries)
+
+        # Label boundary: office.com and *.office.com are both written as .office.com
+        self.set_option("url_dg_label_boundary", 1)
+        objects = o365.build_objects("Worldwide", "", load_data("endpoints.json"), "2020070100", False)
+        list_entries = [line.split(" := ")[0] for line in objects["dgs"][0][3].splitlines()]
+        self.assertTrue(all([entry.startswith(".") for entry in list_entries]))
+        self.assertEqual(list_entries.count(".office.com"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
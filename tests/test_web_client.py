@@ -0,0 +1,181 @@
+import gzip
+import os
+import json
+import threading
+import unittest
+import BaseHTTPServer
+import StringIO
+
+from support import O365TestCase, o365
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves server.responses in turn: (status, body, headers), or a function returning them.
+    # The request headers are kept in server.requests.
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        response = self.server.responses.pop(0)
+        if callable(response):
+            response = response()
+        status, body, dict_headers = response
+        if "gzip" in self.headers.get("Accept-Encoding", "") and body:
+            buffer = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buffer, mode="w")
+            f.write(body)
+            f.close()
+            body = buffer.getvalue()
+            dict_headers = dict(dict_headers, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        for key in dict_headers:
+            self.send_header(key, dict_headers[key])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class WebClientTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.responses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.set_option("ms_o365_scheme", "http")
+        self.set_option("http_backoff", 0)
+        self.set_option("http_timeout", 5)
+        self.client = o365.MsWebServiceClient("127.0.0.1:" + str(self.server.server_address[1]))
+        self.addCleanup(self.client.close)
+
+    def test_gzip_and_connection_reused(self):
+        body = json.dumps([{"id": index, "urls": ["host%d.office.com" % index]} for index in range(1000)])
+        self.server.responses = [(200, body, {}), (200, body, {})]
+        self.assertEqual(self.client.get("/endpoints/Worldwide", False), (200, body))
+        self.assertEqual(self.client.get("/endpoints/Worldwide", False, o365.read_json_array), (200, json.loads(body)))
+        self.assertEqual(self.server.requests[0]["accept-encoding"], "gzip")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_not_modified_returns_cached_body(self):
+        body = '[{"id": 1, "urls": ["outlook.office.com"]}]'
+        self.server.responses = [(200, body, {"ETag": '"v1"'}), (304, "", {})]
+        self.assertEqual(self.client.get("/endpoints/Worldwide"), (200, body))
+        http_not_modified = o365.http_stats["not_modified"]
+        self.assertEqual(self.client.get("/endpoints/Worldwide", True, o365.read_json_array), (200, json.loads(body)))
+        self.assertEqual(self.server.requests[1]["if-none-match"], '"v1"')
+        self.assertEqual(o365.http_stats["not_modified"], http_not_modified + 1)
+
+    def test_cached_body_missing(self):
+        body = '[{"id": 1}]'
+        self.server.responses = [(200, body, {"ETag": '"v1"'}), (200, body, {"ETag": '"v1"'})]
+        self.client.get("/version")
+        os.remove(o365.load_http_cache()["/version"]["body_file"])
+        self.assertEqual(self.client.get("/version"), (200, body))
+        self.assertNotIn("if-none-match", self.server.requests[1])
+
+    def test_not_modified_after_cached_body_removed(self):
+        # The body file goes away while the request is on its way: the body is requested again, once
+        body = '[{"id": 1}]'
+        def not_modified():
+            os.remove(o365.load_http_cache()["/version"]["body_file"])
+            return (304, "", {})
+        self.server.responses = [(200, body, {"ETag": '"v1"'}), not_modified, (200, body, {"ETag": '"v2"'}), (304, "", {})]
+        self.client.get("/version")
+        self.assertEqual(self.client.get("/version"), (200, body))
+        self.assertEqual(self.server.requests[1]["if-none-match"], '"v1"')
+        self.assertNotIn("if-none-match", self.server.requests[2])
+        self.assertEqual(o365.load_http_cache()["/version"]["etag"], '"v2"')
+        self.assertEqual(self.client.get("/version"), (200, body))
+
+    def test_no_cache_without_use_cache(self):
+        self.server.responses = [(200, "[]", {"ETag": '"v1"'}), (200, "[]", {})]
+        self.client.get("/changes/Worldwide/2020070100", False)
+        self.client.get("/changes/Worldwide/2020070100", False)
+        self.assertNotIn("if-none-match", self.server.requests[1])
+        self.assertEqual(o365.load_http_cache(), {})
+
+    def test_retry_on_server_error(self):
+        self.server.responses = [(503, "busy", {}), (500, "error", {}), (200, "[]", {})]
+        self.assertEqual(self.client.get("/version", False), (200, "[]"))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_exhausted(self):
+        self.set_option("http_retries", 1)
+        self.server.responses = [(503, "busy", {}), (503, "busy", {})]
+        self.assertEqual(self.client.get("/version", False)[0], 503)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_client_error_not_retried(self):
+        self.server.responses = [(400, "bad request", {})]
+        self.assertEqual(self.client.get("/version", False), (400, "bad request"))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_response(self):
+        self.set_option("http_retries", 1)
+        client = o365.MsWebServiceClient("127.0.0.1:1")
+        self.assertEqual(client.get("/version", False)[0], 0)
+
+class HttpCacheTest(O365TestCase):
+
+    def test_concurrent_saves_kept(self):
+        list_uris = ["/endpoints/instance%d?ClientRequestId=guid" % index for index in range(40)]
+        def save(uri):
+            file_body = os.path.join(self.directory, "body" + str(list_uris.index(uri)))
+            open(file_body, "w").close()
+            o365.save_http_cache(uri, '"' + uri + '"', None, file_body)
+        o365.run_concurrently(save, list_uris, 8)
+        dict_cache = o365.load_http_cache()
+        self.assertEqual(sorted(dict_cache), sorted(list_uris))
+        self.assertTrue(all([os.path.isfile(dict_cache[uri]["body_file"]) for uri in list_uris]))
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class RunConcurrentlyTest(O365TestCase):
+
+    def test_single_item_in_this_thread(self):
+        self.assertEqual(o365.run_concurrently(lambda arg: threading.current_thread(), ["Worldwide"], 5), [threading.current_thread()])
+        self.assertEqual(o365.run_concurrently(lambda arg: threading.current_thread(), ["Worldwide", "China"], 1),
+                         [threading.current_thread()] * 2)
+
+    def test_workers(self):
+        list_clients = []
+        def function(arg):
+            # A connection of the worker thread, as ms_web_service_get opens it
+            client = FakeClient()
+            if not hasattr(o365.web_clients, "clients"):
+                o365.web_clients.clients = {}
+            o365.web_clients.clients["host" + str(arg)] = client
+            list_clients.append(client)
+            return arg * 2, threading.current_thread()
+        list_results = o365.run_concurrently(function, range(6), 3)
+        self.assertEqual([result for result, thread in list_results], [0, 2, 4, 6, 8, 10])
+        self.assertNotIn(threading.current_thread(), [thread for result, thread in list_results])
+        self.assertTrue(all([client.closed for client in list_clients]))
+
+    def test_error_raised(self):
+        def function(arg):
+            if arg == 2:
+                raise KeyError(arg)
+            return arg
+        self.assertRaises(KeyError, o365.run_concurrently, function, range(4), 2)
+        self.assertRaises(KeyError, o365.run_concurrently, function, [2], 2)
+
+if __name__ == "__main__":
+    unittest.main()